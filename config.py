@@ -32,6 +32,9 @@ class Settings(BaseSettings):
     # === БД ===
     database_url: str = ""
     use_postgres: bool = os.getenv("USE_POSTGRES", "1").strip() == "1"
+    # миграции при старте (под advisory lock); 0 — только python scripts/migrate.py
+    # (Render: Pre-Deploy Command), отстающая схема тогда валит старт и health check
+    db_auto_migrate: bool = True
 
     @property
     def async_database_url(self) -> str:
@@ -67,6 +70,46 @@ class Settings(BaseSettings):
     # === Админ ===
     admin_id: int = 0
 
+    # === Приём апдейтов (webhook ingress) ===
+    ingress_max_queue: int = 1000
+    ingress_overflow_policy: str = "reject"  # reject (503, Telegram повторит) | drop_oldest | drop_new
+    ingress_dedup_window: int = 5000         # сколько последних update_id помним для отсева дублей
+    ingress_lanes: int = 8                   # параллельные полосы обработки (шардирование по user_id)
+    webhook_inline_reply: bool = False       # отдавать первый вызов Bot API прямо в ответе webhook
+    webhook_reply_wait_ms: int = 30          # сколько webhook ждёт этот вызов от хендлера
+
+    # === Холодный старт ===
+    cold_start_target_sec: float = 10.0      # цель для таймлайна старта (Render sleep/wake)
+    warmup_db_connections: int = 3           # сколько соединений пула открыть заранее
+    warmup_timeout_sec: float = 10.0         # лимит на каждый шаг warm-up
+
+    # === Состояние диалога (context.user_data / chat_data) ===
+    persistence_backend: str = "memory"      # memory (один процесс) | db (таблица bot_state, несколько воркеров)
+    persistence_flush_sec: float = 1.0       # write-behind: как часто PTB сбрасывает изменения в БД
+    persistence_refresh_sec: float = 0.0     # 0 — сверять версию с БД на каждом апдейте
+    db_request_scope: bool = True            # одна сессия / транзакция БД на весь апдейт
+    activity_flush_sec: float = 30.0         # как часто last_active_at пишется в БД пачкой
+    activity_buffer_max: int = 5000          # столько user_id в буфере → flush досрочно
+    activity_pending_max: int = 50000        # жёсткий предел буфера (БД недоступна) — сверх него отметки теряются
+    user_cache_size: int = 10000             # снимки пользователей в памяти (LRU)
+    user_cache_ttl_sec: float = 30.0         # TTL снимка; при нескольких воркерах держать небольшим
+
+    # === Генерации (резерв кредита) ===
+    credit_reservation_ttl_sec: float = 1800.0  # резерв старше (узел упал посреди генерации) → возврат
+
+    # === Архив *_raw (retention, задача лидера) ===
+    raw_retention_months: int = 0            # сколько полных месяцев держать в *_raw; 0 — не архивировать
+    raw_archive_dir: str = "archive/raw"     # <dir>/<table>/<YYYY-MM>.jsonl.gz
+    raw_retention_batch: int = 5000          # строк за одно чтение / DELETE
+    raw_retention_interval_sec: float = 86400.0
+
+    # === Лидер кластера (webhook, dashboard, периодические задачи) ===
+    leader_lock_id: int = 7_240_001          # ключ pg advisory lock
+    leader_poll_sec: float = 5.0             # как часто ведомые пытаются забрать лидерство
+
+    # === Остановка (drain) ===
+    shutdown_drain_sec: float = 25.0         # сколько ждём апдейты и генерации (Render даёт ~30 сек после SIGTERM)
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -75,5 +118,3 @@ class Settings(BaseSettings):
 
 
 settings = Settings()
-
-print("✅ Using Postgres (Production)" if settings.use_postgres else "🧩 Using SQLite (Local Mode)")
@@ -0,0 +1,133 @@
+# db/credits.py
+# =========================================================
+# Кредиты генераций: reserve → (провайдер) → commit / refund.
+#
+# 🧩 Зачем: раньше баланс проверялся в do_animate, а списывался в Python
+#    уже после отправки видео — двойной клик запускал две платные задачи
+#    у провайдера на один кредит.
+#
+# ⚙️ Как работает (каждый шаг — своя короткая транзакция, закоммиченная сразу):
+#   - reserve(user_id): строка credit_reservations (status=reserved) +
+#     списание через журнал (db/ledger.py): UPDATE users SET balance =
+#     balance - 1 WHERE balance - 1 >= 0 RETURNING + запись balance_ledger.
+#     Частичный уникальный индекс (user_id WHERE status='reserved') не даёт
+#     занять второй кредит, пока идёт первая генерация → BUSY;
+#   - commit(reservation, ...): видео доставлено — committed, total_generations + 1,
+#     строка generations_raw;
+#   - refund(reservation): не доставлено — refunded, balance + 1 (тоже в журнал).
+#     Переход из reserved делается условным UPDATE — вернуть дважды нельзя.
+#   - резерв старше CREDIT_RESERVATION_TTL_SEC (узел упал посреди генерации)
+#     возвращается при следующем reserve() этого пользователя.
+# =========================================================
+import datetime as dt
+
+from sqlalchemy import func, update
+
+from config import settings
+from db import ledger
+from db.database import dialect_insert, get_session
+from db.models import CreditReservation, GenerationRaw, User, ts_now
+from db.repo import _Snapshot
+
+RESERVED, COMMITTED, REFUNDED = "reserved", "committed", "refunded"
+
+# результат reserve()
+OK = "ok"
+NO_CREDITS = "no_credits"
+BUSY = "busy"               # у пользователя уже идёт генерация
+
+
+class Reservation(_Snapshot):
+    __slots__ = ("id", "user_id", "balance_after")
+
+
+async def _finish(session, reservation_id: int, status: str) -> int | None:
+    """reserved → status. user_id или None, если резерв уже завершён."""
+    return (await session.execute(
+        update(CreditReservation)
+        .where(CreditReservation.id == reservation_id, CreditReservation.status == RESERVED)
+        .values(status=status, finished_at=ts_now())
+        .returning(CreditReservation.user_id)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+
+
+async def _refund_stale(session, user_id: int) -> int:
+    cutoff = ts_now() - dt.timedelta(seconds=settings.credit_reservation_ttl_sec)
+    stale = (await session.execute(
+        update(CreditReservation)
+        .where(
+            CreditReservation.user_id == user_id,
+            CreditReservation.status == RESERVED,
+            CreditReservation.created_at < cutoff,
+        )
+        .values(status=REFUNDED, finished_at=ts_now())
+        .returning(CreditReservation.id)
+        .execution_options(synchronize_session=False)
+    )).scalars().all()
+    if stale:
+        await ledger.apply_delta(session, user_id, len(stale), "generation_refund_stale",
+                                 ref=",".join(f"reservation:{rid}" for rid in stale))
+        print(f"↩️ Возвращено зависших резервов: {len(stale)} (user {user_id})")
+    return len(stale)
+
+
+# === API ===
+async def reserve(user_id: int) -> tuple[str, Reservation | None]:
+    """Атомарно занять 1 генерацию. (OK, Reservation) / (NO_CREDITS, None) / (BUSY, None)."""
+    async with get_session(isolated=True) as session:
+        await _refund_stale(session, user_id)
+
+        stmt = dialect_insert()(CreditReservation).values(user_id=user_id, status=RESERVED, created_at=ts_now())
+        reservation_id = (await session.execute(
+            stmt.on_conflict_do_nothing(
+                index_elements=[CreditReservation.user_id],
+                index_where=CreditReservation.status == RESERVED,
+            ).returning(CreditReservation.id)
+        )).scalar_one_or_none()
+        if reservation_id is None:
+            await session.commit()  # зависшие резервы (если были) всё равно возвращаем
+            return BUSY, None
+
+        change = await ledger.apply_delta(session, user_id, -1, "generation_reserve",
+                                          ref=f"reservation:{reservation_id}", require_funds=True)
+        if change is None:
+            await session.rollback()
+            return NO_CREDITS, None
+
+        await session.commit()
+    return OK, Reservation(id=reservation_id, user_id=user_id, balance_after=change[1])
+
+
+async def commit(reservation: Reservation, prompt: str, file_id: str) -> bool:
+    """Генерация доставлена. False — резерв уже был возвращён (например, по TTL)."""
+    async with get_session(isolated=True) as session:
+        if await _finish(session, reservation.id, COMMITTED) is None:
+            print(f"⚠️ Резерв {reservation.id} уже завершён — генерацию не фиксируем")
+            return False
+        await session.execute(
+            update(User)
+            .where(User.id == reservation.user_id)
+            .values(total_generations=func.coalesce(User.total_generations, 0) + 1)
+            .execution_options(synchronize_session=False)
+        )
+        session.add(GenerationRaw(
+            user_id=reservation.user_id,
+            price_rub=float(settings.price_rub),
+            input_type="photo",
+            prompt=(prompt or "")[:1024],
+            file_id=file_id,
+        ))
+        await session.commit()
+    return True
+
+
+async def refund(reservation: Reservation) -> int | None:
+    """Вернуть кредит. Новый баланс или None, если резерв уже завершён."""
+    async with get_session(isolated=True) as session:
+        user_id = await _finish(session, reservation.id, REFUNDED)
+        if user_id is None:
+            return None
+        change = await ledger.apply_delta(session, user_id, 1, "generation_refund", ref=f"reservation:{reservation.id}")
+        await session.commit()
+    return change[1] if change else None
@@ -4,98 +4,250 @@ import ssl, asyncio, logging, os
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from contextlib import asynccontextmanager
-from sqlalchemy import inspect
+from contextvars import ContextVar
+from sqlalchemy import inspect, text
 from config import settings
 
 
+Base = declarative_base()
+
+_engine = None
+_session_factory = None
+
+
 # === 1. Определяем окружение ===
-db_url = os.getenv("DATABASE_URL", "") or settings.async_database_url
-is_sqlite = "sqlite" in db_url.lower()
-is_render = "onrender.com" in db_url or os.getenv("RENDER")
-is_railway = "railway" in db_url
+def _resolve_url() -> tuple[str, bool, bool, bool]:
+    db_url = os.getenv("DATABASE_URL", "") or settings.async_database_url
+    is_sqlite = "sqlite" in db_url.lower()
+    is_render = bool("onrender.com" in db_url or os.getenv("RENDER"))
+    is_railway = "railway" in db_url
+
+    # === 2. Настраиваем URL и SSL ===
+    if is_render:
+        # Render: убираем sslmode, asyncpg не понимает его
+        if "sslmode" in db_url:
+            db_url = db_url.split("?")[0]
+            print("⚙️ Render detected — удаляем sslmode из DATABASE_URL")
+
+    elif is_railway:
+        # Railway: добавляем sslmode=require если его нет
+        if "sslmode" not in db_url:
+            db_url += "?sslmode=require"
+            print("⚙️ Railway detected — добавляем sslmode=require")
+
+    os.environ["DATABASE_URL"] = db_url
+    return db_url, is_sqlite, is_render, is_railway
+
+
+# === 3-4. Движок создаётся при первом обращении (импорт модуля ничего не подключает) ===
+def get_engine():
+    global _engine, _session_factory
+    if _engine is not None:
+        return _engine
+
+    db_url, is_sqlite, is_render, is_railway = _resolve_url()
+
+    # === SSL настройки ===
+    connect_args = {}
+    if not is_sqlite:
+        ssl_context = ssl.create_default_context()
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+        connect_args = {"ssl": ssl_context}
+
+    # SQLite работает без QueuePool — параметры пула передаём только для Postgres
+    pool_args = {} if is_sqlite else dict(
+        pool_size=20,
+        max_overflow=10,
+        pool_timeout=15,
+        pool_recycle=300,
+    )
+    _engine = create_async_engine(
+        db_url,
+        echo=False,
+        pool_pre_ping=True,
+        connect_args=connect_args,
+        **pool_args,
+    )
+    _session_factory = async_sessionmaker(bind=_engine, class_=AsyncSession, expire_on_commit=False)
+
+    # === 5. Логирование старта ===
+    env = (
+        "Render 🌐" if is_render else
+        "Railway 🚄" if is_railway else
+        "Local 💻"
+    )
+    db_type = "SQLite" if is_sqlite else "Postgres"
+    print(f"✅ Using {db_type} ({env})")
+    print(f"🔗 DATABASE_URL: {db_url}")
+    return _engine
+
+
+def dialect_insert():
+    """insert() с on_conflict_do_update для текущей БД (Postgres / SQLite)."""
+    if get_engine().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def __getattr__(name: str):
+    # обратная совместимость: `from db.database import engine, SessionLocal`
+    if name == "engine":
+        return get_engine()
+    if name == "SessionLocal":
+        get_engine()
+        return _session_factory
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# === 2. Настраиваем URL и SSL ===
-if is_render:
-    # Render: убираем sslmode, asyncpg не понимает его
-    if "sslmode" in db_url:
-        db_url = db_url.split("?")[0]
-        print("⚙️ Render detected — удаляем sslmode из DATABASE_URL")
 
-elif is_railway:
-    # Railway: добавляем sslmode=require если его нет
-    if "sslmode" not in db_url:
-        db_url += "?sslmode=require"
-        print("⚙️ Railway detected — добавляем sslmode=require")
+# === 6. Контекст сессий ===
+# Внутри request_scope() (обработка одного апдейта) все get_session() получают
+# одну и ту же сессию: одно соединение из пула и одна транзакция на апдейт.
+# commit() в хендлерах превращается во flush(), настоящий commit — в конце
+# (или раньше — end_scope() перед внешним I/O: API оплаты, sleep, отправка видео).
+# Задачи, созданные через create_task, наследуют contextvar, но не владеют
+# сессией (другой task) — им выдаётся обычная отдельная сессия.
+class _RequestScope:
+    __slots__ = ("owner", "session", "after_commit")
 
-os.environ["DATABASE_URL"] = db_url
+    def __init__(self, owner: asyncio.Task | None):
+        self.owner = owner
+        self.session: AsyncSession | None = None
+        self.after_commit: list = []
 
 
-# === 3. SSL настройки ===
-connect_args = {}
-if not is_sqlite:
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-    connect_args = {"ssl": ssl_context}
+_scope: ContextVar[_RequestScope | None] = ContextVar("db_request_scope", default=None)
 
 
-# === 4. Создаём движок ===
-Base = declarative_base()
+class RequestSession:
+    """Общая сессия апдейта: commit() → flush(), close() ничего не делает."""
+
+    __slots__ = ("_session",)
 
-engine = create_async_engine(
-    db_url,
-    echo=False,
-    pool_pre_ping=True,
-    connect_args=connect_args,
-    pool_size=20 if not is_sqlite else None,
-    max_overflow=10 if not is_sqlite else None,
-    pool_timeout=15 if not is_sqlite else None,
-    pool_recycle=300 if not is_sqlite else None,
-)
+    def __init__(self, session: AsyncSession):
+        self._session = session
 
-SessionLocal = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    def __getattr__(self, name):
+        return getattr(self._session, name)
 
+    async def commit(self) -> None:
+        await self._session.flush()
 
-# === 5. Логирование старта ===
-env = (
-    "Render 🌐" if is_render else
-    "Railway 🚄" if is_railway else
-    "Local 💻"
-)
-db_type = "SQLite" if is_sqlite else "Postgres"
-print(f"✅ Using {db_type} ({env})")
-print(f"🔗 DATABASE_URL: {db_url}")
+    async def close(self) -> None:
+        pass
 
 
-# === 6. Контекст сессий ===
 @asynccontextmanager
-async def get_session() -> AsyncGenerator[AsyncSession, None]:
-    async with SessionLocal() as session:
-        yield session
+async def request_scope():
+    """Сессия на весь апдейт: commit при успехе, rollback при исключении."""
+    if not settings.db_request_scope:
+        yield
+        return
+
+    get_engine()
+    scope = _RequestScope(asyncio.current_task())
+    token = _scope.set(scope)
+    try:
+        yield
+        if scope.session is not None:
+            await scope.session.commit()
+        for callback in scope.after_commit:
+            callback()
+    except BaseException:
+        if scope.session is not None:
+            await scope.session.rollback()
+        raise
+    finally:
+        _scope.reset(token)
+        if scope.session is not None:
+            await scope.session.close()
+
+
+async def end_scope() -> None:
+    """Досрочно завершить транзакцию апдейта: commit, колбэки on_commit, соединение — в пул.
+
+    Звать перед долгим внешним I/O (API оплаты, sleep, send_video), чтобы не держать
+    транзакцию и блокировки строк, пока ждём сеть. Следующий get_session() в этом же
+    апдейте откроет новую. Ошибка commit пробрасывается — колбэки не вызываются.
+    """
+    scope = _scope.get()
+    if scope is None or scope.owner is not asyncio.current_task():
+        return
+    session, scope.session = scope.session, None
+    callbacks, scope.after_commit = scope.after_commit, []
+    if session is not None:
+        try:
+            await session.commit()
+        finally:
+            await session.close()
+    for callback in callbacks:
+        callback()
+
+
+def on_commit(callback) -> None:
+    """Вызвать callback() после commit апдейта (вне request_scope — сразу)."""
+    scope = _scope.get()
+    if scope is not None and scope.owner is asyncio.current_task():
+        scope.after_commit.append(callback)
+    else:
+        callback()
+
+
+@asynccontextmanager
+async def get_session(isolated: bool = False) -> AsyncGenerator[AsyncSession, None]:
+    """isolated=True — своя транзакция даже внутри request_scope (commit сразу, не в конце апдейта)."""
+    get_engine()
+    scope = _scope.get()
+    if isolated or scope is None or scope.owner is not asyncio.current_task():
+        async with _session_factory() as session:
+            yield session
+        return
+
+    if scope.session is None:
+        scope.session = _session_factory()
+    try:
+        yield RequestSession(scope.session)
+    except BaseException:
+        # ошибка в блоке → откатываем транзакцию апдейта, следующий блок начнёт новую
+        await scope.session.rollback()
+        raise
 
 
 # === 7. Отладка пула ===
 async def debug_pool_status():
     try:
-        pool = inspect(engine).get_pool()
+        pool = inspect(get_engine()).get_pool()
         print(f"📊 Pool: size={pool.size()}, checked_out={pool.checkedout()}, overflow={pool.overflow()}")
     except Exception:
         pass
 
 
-# === 8. Инициализация базы ===
-async def init_db(retries: int = 5, delay: int = 3):
-    """Создаёт таблицы при старте, с повторами при ошибках"""
-    from . import models
+# === 8. Инициализация базы (миграции — db/migrations.py) ===
+async def init_db(retries: int = 5, delay: int = 3, migrate: bool | None = None):
+    """Сверяет версию схемы при старте (один запрос), с повторами при ошибках.
+
+    migrate=None — миграции по DB_AUTO_MIGRATE (по умолчанию включены);
+    скрипты, которым нужна актуальная схема в любом случае, передают migrate=True.
+    Схема отстаёт и мигрировать нельзя — SchemaBehindError сразу, без повторов.
+    """
+    from .migrations import SchemaBehindError, ensure_schema, state
     for attempt in range(1, retries + 1):
         try:
-            async with engine.begin() as conn:
-                await conn.run_sync(Base.metadata.create_all)
+            result = await ensure_schema(auto_migrate=migrate)
+            if result["applied"]:
+                logging.info(f"🧱 Применены миграции: {', '.join(result['applied'])}")
             logging.info("✅ Database initialized successfully")
             return
+        except SchemaBehindError as e:
+            logging.critical(f"❌ {e}")
+            raise
         except Exception as e:
             logging.error(f"❌ DB init failed ({attempt}/{retries}): {e}")
             if attempt < retries:
                 await asyncio.sleep(delay)
             else:
+                state["status"] = "error"
+                state["error"] = str(e)
                 raise
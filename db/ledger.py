@@ -0,0 +1,106 @@
+# db/ledger.py
+# =========================================================
+# Журнал баланса генераций: append-only balance_ledger + снимок users.balance.
+#
+# 🧩 Зачем: баланс менялся присваиванием user.balance в хендлерах, а история
+#    жила только в balances_raw (Google Sheets), которую дашборд перечитывает
+#    целиком. Понять, откуда взялся баланс, можно было только перебором.
+#
+# ⚙️ Как работает:
+#   - любое изменение — apply_delta() / set_balance() в транзакции вызывающего:
+#       UPDATE users SET balance = balance + :delta ... RETURNING balance
+#       + INSERT balance_ledger (delta, balance_after, reason, ref);
+#     строки журнала не меняются и не удаляются;
+#   - текущий баланс: users.balance — одна строка по PK (снимок);
+#   - история: balance_ledger по индексу (user_id, id) — range scan;
+#   - сверка: users.balance == balance_after последней записи пользователя
+#     (find_drift, scripts/reconcile_balances.py) — без пересчёта всех строк.
+#
+# Легаси-счётчики (users.generations_balance, SQLite billing_core) баланс
+# для списаний не определяют и журналом не покрываются.
+# =========================================================
+from sqlalchemy import func, insert, literal, select, update
+
+from db.models import BalanceEntry, User, ts_now
+from db.repo import invalidate_user
+
+
+async def apply_delta(session, user_id: int, delta: int, reason: str, ref: str | None = None,
+                      *, require_funds: bool = False) -> tuple[int, int] | None:
+    """Изменить баланс на delta и записать в журнал. Коммитит вызывающий.
+
+    require_funds=True — не уводить баланс в минус (списание).
+    Возвращает (old, new) или None: пользователя нет / не хватает баланса.
+    """
+    stmt = update(User).where(User.id == user_id)
+    if require_funds:
+        stmt = stmt.where(User.balance + delta >= 0)
+    new = (await session.execute(
+        stmt.values(balance=User.balance + delta)
+        .returning(User.balance)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+    if new is None:
+        return None
+
+    await session.execute(insert(BalanceEntry).values(
+        user_id=user_id, delta=delta, balance_after=new, reason=reason, ref=ref, ts=ts_now(),
+    ))
+    invalidate_user(user_id)
+    return new - delta, new
+
+
+async def set_balance(session, user_id: int, value: int, reason: str, ref: str | None = None) -> tuple[int, int] | None:
+    """Выставить баланс (сброс) — в журнал уходит разница."""
+    old = (await session.execute(
+        select(User.balance).where(User.id == user_id).with_for_update()
+    )).scalar_one_or_none()
+    if old is None:
+        return None
+    if old == value:
+        return old, old
+    return await apply_delta(session, user_id, value - old, reason, ref)
+
+
+# === Чтение ===
+async def history(session, user_id: int, limit: int = 20, before_id: int | None = None) -> list[BalanceEntry]:
+    """Последние записи пользователя (новые сверху); before_id — следующая страница."""
+    stmt = select(BalanceEntry).where(BalanceEntry.user_id == user_id)
+    if before_id is not None:
+        stmt = stmt.where(BalanceEntry.id < before_id)
+    stmt = stmt.order_by(BalanceEntry.id.desc()).limit(limit)
+    return list((await session.execute(stmt)).scalars())
+
+
+def _last_balance(user_id_col):
+    return (
+        select(BalanceEntry.balance_after)
+        .where(BalanceEntry.user_id == user_id_col)
+        .order_by(BalanceEntry.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+async def find_drift(session, user_ids: list[int] | None = None) -> list:
+    """Пользователи, у которых снимок не совпадает с последней записью журнала.
+
+    Строки: (id, balance, ledger_balance); ledger_balance = None — записей нет.
+    """
+    last = _last_balance(User.id)
+    stmt = select(User.id, User.balance, last.label("ledger_balance")).where(
+        func.coalesce(last, 0) != func.coalesce(User.balance, 0)
+    )
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+    return list((await session.execute(stmt.order_by(User.id))).all())
+
+
+# === Начальные записи ===
+def open_balances_stmt():
+    """Журнал только что появился: по записи opening_balance на каждый ненулевой баланс."""
+    return insert(BalanceEntry).from_select(
+        ["user_id", "delta", "balance_after", "reason", "ts"],
+        select(User.id, User.balance, User.balance, literal("opening_balance"), func.now())
+        .where(User.balance != 0),
+    )
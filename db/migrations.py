@@ -0,0 +1,396 @@
+# db/migrations.py
+# =========================================================
+# Версионные миграции схемы.
+#
+# 🧩 Как устроено:
+#   - schema_migrations(version, name, applied_at) — что уже применено;
+#   - MIGRATIONS — упорядоченный список (version, name, fn); migrate() применяет
+#     те, что новее записанной версии. Каждая миграция — своя транзакция вместе
+#     со строкой в schema_migrations: упала — откатилась целиком, следующий
+#     запуск начнёт её заново;
+#   - на Postgres транзакция берёт pg_advisory_xact_lock — несколько воркеров,
+#     стартующих одновременно, применяют миграцию ровно один раз;
+#   - миграции заморожены: таблицы, колонки и индексы описаны в самой миграции,
+#     а не берутся из db/models.py (модели — итоговая схема, они меняются).
+#     0001 — схема до серии, каждая новая таблица / колонка / набор индексов —
+#     своей миграцией. Все шаги идемпотентны (checkfirst / проверка колонки):
+#     базы, где это уже создано раньше, проходят их без изменений.
+#
+# 🚀 Старт приложения (init_db → ensure_schema): один SELECT max(version).
+#    Совпала с LATEST — никакого DDL и обхода каталога. Отстаёт — миграции
+#    применяются тут же под тем же advisory lock (несколько воркеров — ровно
+#    один раз). DB_AUTO_MIGRATE=0 — не мигрировать при старте: отстающая схема
+#    тогда ошибка старта (/ отвечает 503), а не строчка в логе.
+#    Отдельный шаг деплоя, до старта воркеров:
+#        python scripts/migrate.py
+#    Render: Settings → Pre-Deploy Command; Heroku-подобные — release в Procfile.
+#
+# ➕ Новая миграция: функция fn(conn) (sync Connection, внутри run_sync) +
+#    строка в MIGRATIONS со следующим номером. Выпущенные миграции не меняем.
+# =========================================================
+import logging
+import time
+
+from sqlalchemy import (
+    BigInteger, Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text,
+    func, inspect, select, text,
+)
+from sqlalchemy.exc import DBAPIError
+
+from config import settings
+from db.database import get_engine
+
+MIGRATION_LOCK_ID = 7_240_002  # pg advisory lock (рядом с LEADER_LOCK_ID)
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String(128), nullable=False),
+    Column("applied_at", DateTime(timezone=True), server_default=func.now()),
+)
+
+
+# === Помощники ===
+def _index(conn, name: str, table: str, *columns: str, unique: bool = False, **kw) -> None:
+    """CREATE INDEX по именам колонок (заглушка таблицы — не зависит от моделей)."""
+    stub = Table(table, MetaData(), *[Column(c) for c in columns])
+    Index(name, *[stub.c[c] for c in columns], unique=unique, **kw).create(conn, checkfirst=True)
+    logging.info(f"🗂 Индекс {name}")
+
+
+def _add_column(conn, table: str, column: str, ddl: str) -> bool:
+    """ALTER TABLE ... ADD COLUMN, если колонки ещё нет. True — добавлена."""
+    if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    logging.info(f"🧩 Колонка {table}.{column}")
+    return True
+
+
+def _create_table(conn, table: Table) -> bool:
+    """CREATE TABLE, если её ещё нет. True — создана."""
+    if inspect(conn).has_table(table.name):
+        return False
+    table.create(conn)
+    logging.info(f"🧱 Таблица {table.name}")
+    return True
+
+
+def _users_stub(metadata: MetaData) -> Table:
+    # цель внешних ключей новых таблиц (сама users не создаётся)
+    return Table("users", metadata, Column("id", BigInteger, primary_key=True))
+
+
+# === 0001: схема до миграций (как её создавал create_all исходного релиза) ===
+def _baseline_metadata() -> MetaData:
+    md = MetaData()
+    Table(
+        "users", md,
+        Column("id", BigInteger, primary_key=True),
+        Column("username", String, nullable=True),
+        Column("full_name", String, nullable=True),
+        Column("balance", Integer, nullable=False, server_default="0"),
+        Column("generations_balance", Integer, nullable=False, server_default="0"),
+        Column("total_spent", Integer, nullable=False, server_default="0"),
+        Column("total_generations", Integer, nullable=False, server_default="0"),
+        Column("last_payment_at", String, nullable=True),
+        Column("last_active_at", String, nullable=True),
+        Column("free_trial_used", Boolean, nullable=False, server_default="0"),
+        Column("referrals_count", Integer, nullable=False, server_default="0"),
+        Column("consent_accepted", Boolean, nullable=False, server_default="0"),
+        Column("referred_by", Integer, nullable=True),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    )
+    Table(
+        "referrals", md,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("inviter_id", BigInteger, ForeignKey("users.id"), nullable=False),
+        Column("invited_id", BigInteger, ForeignKey("users.id"), unique=True, nullable=False),
+        Column("bonus_awarded", Boolean, nullable=False, server_default="0"),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    )
+    Table(
+        "payments", md,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("user_id", BigInteger, ForeignKey("users.id"), nullable=False, index=True),
+        Column("amount", Float, nullable=False),
+        Column("provider_payment_id", String(255), unique=True, nullable=False),
+        Column("status", String(64), nullable=False),
+        Column("provider", String(32), nullable=False),
+        Column("mode", String(32), nullable=True),
+        Column("payment_url", String(1024), nullable=True),
+        Column("order_id", String(255), nullable=True),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Column("updated_at", DateTime(timezone=True), nullable=False),
+    )
+
+    def raw(name, *columns):
+        Table(
+            name, md,
+            Column("id", Integer, primary_key=True, autoincrement=True),
+            Column("ts", DateTime(timezone=True), nullable=False, server_default=func.now()),
+            *columns,
+        )
+
+    raw("payments_raw",
+        Column("user_id", BigInteger, nullable=False),
+        Column("amount_rub", Float, nullable=False),
+        Column("order_id", String(255), nullable=True),
+        Column("mode", String(255), nullable=True),
+        Column("payment_url", String(1024), nullable=True))
+    raw("results_raw",
+        Column("user_id", BigInteger, nullable=False),
+        Column("payment_id", String(255), nullable=True),
+        Column("status", String(255), nullable=True),
+        Column("amount_rub", Float, nullable=True))
+    raw("generations_raw",
+        Column("user_id", BigInteger, nullable=False),
+        Column("price_rub", Float, nullable=False),
+        Column("input_type", String(64), nullable=True),
+        Column("prompt", String(1024), nullable=True),
+        Column("file_id", String(255), nullable=True))
+    raw("balances_raw",
+        Column("user_id", BigInteger, nullable=False),
+        Column("old_balance", Integer, nullable=False),
+        Column("delta", Integer, nullable=False),
+        Column("new_balance", Integer, nullable=False),
+        Column("total_generations", Integer, nullable=True),
+        Column("reason", String(255), nullable=True))
+    raw("referrals_raw",
+        Column("referrer_id", BigInteger, nullable=False),
+        Column("new_user_id", BigInteger, nullable=False),
+        Column("status", String(255), nullable=True))
+    raw("referrals_summary",
+        Column("user_id", BigInteger, nullable=False),
+        Column("invited_total", Integer, nullable=False),
+        Column("invited_paid", Integer, nullable=False),
+        Column("bonus_total", Integer, nullable=False))
+
+    Table(
+        "dashboard_cache", md,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("total_users", Integer, nullable=False),
+        Column("total_payments", Float, nullable=False),
+        Column("total_generations", Integer, nullable=False),
+        Column("total_orders", Integer, nullable=False),
+        Column("total_referrals", Integer, nullable=False),
+        Column("updated_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+    )
+    return md
+
+
+def m0001_baseline(conn) -> None:
+    """Схема до миграций. На базах исходного релиза таблицы уже есть — ничего не делает."""
+    _baseline_metadata().create_all(conn, checkfirst=True)
+
+
+# === 0002: bot_state (PTB persistence, db/persistence.py) ===
+def m0002_bot_state(conn) -> None:
+    md = MetaData()
+    _create_table(conn, Table(
+        "bot_state", md,
+        Column("kind", String(8), primary_key=True),
+        Column("key", BigInteger, primary_key=True),
+        Column("data", Text, nullable=False, server_default="{}"),
+        Column("version", Integer, nullable=False, server_default="1"),
+        Column("updated_at", DateTime(timezone=True), nullable=False),
+    ))
+
+
+# === 0003: счётчики рефералки на users + индекс referrals.inviter_id ===
+def m0003_referral_counters(conn) -> None:
+    added = _add_column(conn, "users", "invited_total", "INTEGER NOT NULL DEFAULT 0")
+    added |= _add_column(conn, "users", "invited_paid", "INTEGER NOT NULL DEFAULT 0")
+    _index(conn, "ix_referrals_inviter_id", "referrals", "inviter_id")
+    if added:
+        # счётчики только что появились — заполняем из referrals
+        rows = conn.execute(text(
+            "UPDATE users SET "
+            "invited_total = (SELECT COUNT(*) FROM referrals r WHERE r.inviter_id = users.id), "
+            "invited_paid = (SELECT COUNT(*) FROM referrals r WHERE r.inviter_id = users.id AND r.bonus_awarded)"
+        )).rowcount
+        logging.info(f"🤝 Счётчики рефералки заполнены: {rows} юзеров")
+
+
+# === 0004: credit_reservations (reserve / commit / refund, db/credits.py) ===
+def m0004_credit_reservations(conn) -> None:
+    md = MetaData()
+    _users_stub(md)
+    _create_table(conn, Table(
+        "credit_reservations", md,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("user_id", BigInteger, ForeignKey("users.id"), nullable=False),
+        Column("status", String(16), nullable=False),
+        Column("created_at", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Column("finished_at", DateTime(timezone=True), nullable=True),
+    ))
+    # не больше одного незавершённого резерва на пользователя
+    active = text("status = 'reserved'")
+    _index(conn, "uq_credit_reservations_active", "credit_reservations", "user_id",
+           unique=True, postgresql_where=active, sqlite_where=active)
+
+
+# === 0005: balance_ledger (журнал баланса, db/ledger.py) ===
+def m0005_balance_ledger(conn) -> None:
+    md = MetaData()
+    _users_stub(md)
+    created = _create_table(conn, Table(
+        "balance_ledger", md,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("ts", DateTime(timezone=True), nullable=False, server_default=func.now()),
+        Column("user_id", BigInteger, ForeignKey("users.id"), nullable=False),
+        Column("delta", Integer, nullable=False),
+        Column("balance_after", Integer, nullable=False),
+        Column("reason", String(64), nullable=False),
+        Column("ref", String(255), nullable=True),
+    ))
+    _index(conn, "ix_balance_ledger_user_id_id", "balance_ledger", "user_id", "id")
+    if created:
+        # журнал только что появился — открываем его текущими балансами
+        rows = conn.execute(text(
+            "INSERT INTO balance_ledger (user_id, delta, balance_after, reason, ts) "
+            "SELECT id, balance, balance, 'opening_balance', CURRENT_TIMESTAMP FROM users WHERE balance != 0"
+        )).rowcount
+        logging.info(f"📒 Журнал баланса открыт: {rows} записей opening_balance")
+
+
+# === 0006: индексы под горячие запросы (см. scripts/explain_hot_queries.py) ===
+def m0006_hot_query_indexes(conn) -> None:
+    _index(conn, "ix_payments_status_created_at", "payments", "status", "created_at")
+    _index(conn, "ix_payments_raw_user_id_ts", "payments_raw", "user_id", "ts")
+    _index(conn, "ix_results_raw_user_id_ts", "results_raw", "user_id", "ts")
+    _index(conn, "ix_generations_raw_user_id_ts", "generations_raw", "user_id", "ts")
+    _index(conn, "ix_balances_raw_user_id_ts", "balances_raw", "user_id", "ts")
+    _index(conn, "ix_referrals_raw_referrer_id_ts", "referrals_raw", "referrer_id", "ts")
+    _index(conn, "ix_referrals_raw_new_user_id", "referrals_raw", "new_user_id")
+    _index(conn, "ix_referrals_summary_user_id_ts", "referrals_summary", "user_id", "ts")
+
+
+# === 0007: BRIN по ts в *_raw ===
+def m0007_raw_ts_brin(conn) -> None:
+    """Диапазоны по времени (retention, отчёты) без полного прохода.
+    ts растёт вместе с id (строки только дописываются), поэтому BRIN занимает
+    несколько страниц вместо btree размером с таблицу. На SQLite — обычный индекс."""
+    for table in ("payments_raw", "results_raw", "generations_raw",
+                  "balances_raw", "referrals_raw", "referrals_summary"):
+        _index(conn, f"ix_{table}_ts_brin", table, "ts", postgresql_using="brin")
+
+
+MIGRATIONS = [
+    (1, "baseline", m0001_baseline),
+    (2, "bot_state", m0002_bot_state),
+    (3, "referral_counters", m0003_referral_counters),
+    (4, "credit_reservations", m0004_credit_reservations),
+    (5, "balance_ledger", m0005_balance_ledger),
+    (6, "hot_query_indexes", m0006_hot_query_indexes),
+    (7, "raw_ts_brin", m0007_raw_ts_brin),
+]
+LATEST = MIGRATIONS[-1][0]
+
+
+# === Применение ===
+def _current_version(conn) -> int:
+    return conn.execute(select(func.coalesce(func.max(schema_migrations.c.version), 0))).scalar_one()
+
+
+def _lock(conn) -> None:
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+
+def _create_version_table(conn) -> None:
+    # под локом: два воркера не создают schema_migrations одновременно
+    _lock(conn)
+    schema_migrations.create(conn, checkfirst=True)
+
+
+def _apply_next(conn) -> tuple[int, str] | None:
+    """Одна транзакция: лок → версия → следующая миграция → запись. None — применять нечего."""
+    _lock(conn)
+    current = _current_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > current]
+    if not pending:
+        return None
+    version, name, fn = pending[0]
+    fn(conn)
+    conn.execute(schema_migrations.insert().values(version=version, name=name))
+    return version, name
+
+
+async def migrate() -> list[str]:
+    """Применить все новые миграции. Возвращает список применённых."""
+    engine = get_engine()
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_version_table)
+
+    applied = []
+    while True:
+        t0 = time.perf_counter()
+        async with engine.begin() as conn:
+            step = await conn.run_sync(_apply_next)
+        if step is None:
+            break
+        version, name = step
+        applied.append(f"{version:04d}_{name}")
+        logging.info(f"🧱 Миграция {version:04d}_{name} применена за {time.perf_counter() - t0:.2f} сек")
+    return applied
+
+
+async def stored_version() -> int:
+    """Версия схемы в базе — один запрос. Таблицы ещё нет — 0."""
+    try:
+        async with get_engine().connect() as conn:
+            return await conn.run_sync(_current_version)
+    except DBAPIError as e:
+        if "schema_migrations" not in str(e):
+            raise  # не «нет таблицы», а, например, нет соединения
+        return 0
+
+
+# === Проверка при старте ===
+state = {"version": None, "latest": LATEST, "status": "unknown", "applied": [], "error": None}
+
+
+def auto_migrate_enabled() -> bool:
+    return settings.db_auto_migrate
+
+
+class SchemaBehindError(RuntimeError):
+    """Схема в базе старее кода, а мигрировать при старте запрещено."""
+
+
+async def ensure_schema(auto_migrate: bool | None = None) -> dict:
+    """Сверить версию схемы; при необходимости (и если разрешено) применить миграции."""
+    if auto_migrate is None:
+        auto_migrate = auto_migrate_enabled()
+
+    version = await stored_version()
+    state["version"] = version
+    if version == LATEST:
+        state["status"] = "ok"
+        logging.info(f"✅ Схема актуальна (v{version}) — DDL пропущен")
+    elif version > LATEST:
+        # база уже мигрирована более новым релизом (например, во время отката)
+        state["status"] = "ahead"
+        logging.warning(f"⚠️ Схема v{version} новее кода (v{LATEST}) — DDL не трогаем")
+    elif auto_migrate:
+        state["applied"] = await migrate()
+        state["version"] = await stored_version()
+        state["status"] = "ok"
+    else:
+        state["status"] = "behind"
+        state["error"] = (
+            f"Схема v{version} отстаёт от кода (v{LATEST}): "
+            f"запустите python scripts/migrate.py или уберите DB_AUTO_MIGRATE=0"
+        )
+        raise SchemaBehindError(state["error"])
+    return dict(state)
+
+
+def healthy() -> bool:
+    """Для health check: схема не отстаёт и старт не упал (unknown — init ещё идёт)."""
+    return state["status"] not in ("behind", "error")
+
+
+def snapshot() -> dict:
+    return dict(state)
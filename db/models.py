@@ -2,7 +2,7 @@
 import datetime as dt
 from zoneinfo import ZoneInfo
 
-from sqlalchemy import BigInteger, Boolean, DateTime, Float, ForeignKey, Integer, String, Text, func
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, ForeignKey, Index, Integer, String, Text, func, text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from .database import Base
@@ -43,6 +43,9 @@ class User(Base):
     last_active_at: Mapped[str | None] = mapped_column(String, nullable=True)
     free_trial_used: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
     referrals_count: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    # счётчики рефералки (обновляются вместе с referrals, пересчёт — scripts/repair_referral_counters.py)
+    invited_total: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    invited_paid: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
     consent_accepted: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
     referred_by: Mapped[int | None] = mapped_column(Integer, nullable=True)
     created_at: Mapped[dt.datetime] = mapped_column(
@@ -51,12 +54,13 @@ class User(Base):
         server_default=func.now(),
     )
 
-    # 🧩 ДОБАВЬ ЭТИ СВЯЗИ ВНУТРЬ КЛАССА
+    # 🧩 Связи грузятся только по требованию (lazy="select").
+    # Где нужна история — selectinload(...) явно в запросе (см. get_balance).
     payments = relationship(
         "Payment",
         backref="user",
         cascade="all, delete-orphan",
-        lazy="selectin"
+        lazy="select"
     )
 
     referrals_as_inviter = relationship(
@@ -64,7 +68,7 @@ class User(Base):
         foreign_keys="[Referral.inviter_id]",
         backref="inviter",
         cascade="all, delete-orphan",
-        lazy="selectin"
+        lazy="select"
     )
 
     referrals_as_invited = relationship(
@@ -72,7 +76,7 @@ class User(Base):
         foreign_keys="[Referral.invited_id]",
         backref="invited",
         cascade="all, delete-orphan",
-        lazy="selectin"
+        lazy="select"
     )
 
     @property
@@ -87,7 +91,7 @@ class Referral(Base):
     __tablename__ = "referrals"
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    inviter_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False)
+    inviter_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False, index=True)
     invited_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), unique=True, nullable=False)
     bonus_awarded: Mapped[bool] = mapped_column(Boolean, default=False, server_default="0")
     created_at: Mapped[dt.datetime] = mapped_column(
@@ -107,6 +111,10 @@ class Referral(Base):
 # === PAYMENTS (core) ===
 class Payment(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        # проверка зависших / PENDING платежей — по статусу и возрасту
+        Index("ix_payments_status_created_at", "status", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False, index=True)
@@ -137,10 +145,52 @@ class Payment(Base):
         return format_moscow(self.updated_at)
 
 
+# === CREDIT_RESERVATIONS (генерация: reserve → commit / refund, см. db/credits.py) ===
+class CreditReservation(Base):
+    __tablename__ = "credit_reservations"
+    __table_args__ = (
+        # не больше одного незавершённого резерва на пользователя — защита от двойного клика
+        Index(
+            "uq_credit_reservations_active", "user_id", unique=True,
+            postgresql_where=text("status = 'reserved'"),
+            sqlite_where=text("status = 'reserved'"),
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False)
+    status: Mapped[str] = mapped_column(String(16), default="reserved")  # reserved / committed / refunded
+    created_at: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
+    finished_at: Mapped[dt.datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
+
+# === BALANCE_LEDGER (append-only журнал баланса, снимок — users.balance; см. db/ledger.py) ===
+class BalanceEntry(Base):
+    __tablename__ = "balance_ledger"
+    __table_args__ = (
+        # история пользователя — range scan по индексу, без перебора всего журнала
+        Index("ix_balance_ledger_user_id_id", "user_id", "id"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
+    user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.id"), nullable=False)
+    delta: Mapped[int] = mapped_column(Integer, nullable=False)
+    balance_after: Mapped[int] = mapped_column(Integer, nullable=False)
+    reason: Mapped[str] = mapped_column(String(64), nullable=False)
+    ref: Mapped[str | None] = mapped_column(String(255), nullable=True)  # pay_id, reservation:<id>, ...
+
+    @property
+    def ts_moscow(self) -> str:
+        return format_moscow(self.ts)
+
 
 # === PAYMENTS_RAW ===
 class PaymentRaw(Base):
     __tablename__ = "payments_raw"
+    __table_args__ = (
+        Index("ix_payments_raw_user_id_ts", "user_id", "ts"),
+        Index("ix_payments_raw_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -158,6 +208,10 @@ class PaymentRaw(Base):
 # === RESULTS_RAW ===
 class ResultRaw(Base):
     __tablename__ = "results_raw"
+    __table_args__ = (
+        Index("ix_results_raw_user_id_ts", "user_id", "ts"),
+        Index("ix_results_raw_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -174,6 +228,10 @@ class ResultRaw(Base):
 # === GENERATIONS_RAW ===
 class GenerationRaw(Base):
     __tablename__ = "generations_raw"
+    __table_args__ = (
+        Index("ix_generations_raw_user_id_ts", "user_id", "ts"),
+        Index("ix_generations_raw_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -191,6 +249,10 @@ class GenerationRaw(Base):
 # === BALANCES_RAW ===
 class BalanceRaw(Base):
     __tablename__ = "balances_raw"
+    __table_args__ = (
+        Index("ix_balances_raw_user_id_ts", "user_id", "ts"),
+        Index("ix_balances_raw_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -209,6 +271,11 @@ class BalanceRaw(Base):
 # === REFERRALS_RAW ===
 class ReferralRaw(Base):
     __tablename__ = "referrals_raw"
+    __table_args__ = (
+        Index("ix_referrals_raw_referrer_id_ts", "referrer_id", "ts"),
+        Index("ix_referrals_raw_new_user_id", "new_user_id"),
+        Index("ix_referrals_raw_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -224,6 +291,10 @@ class ReferralRaw(Base):
 # === REFERRALS_SUMMARY ===
 class ReferralSummary(Base):
     __tablename__ = "referrals_summary"
+    __table_args__ = (
+        Index("ix_referrals_summary_user_id_ts", "user_id", "ts"),
+        Index("ix_referrals_summary_ts_brin", "ts", postgresql_using="brin"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     ts: Mapped[dt.datetime] = mapped_column(DateTime(timezone=True), default=ts_now, server_default=func.now())
@@ -257,3 +328,17 @@ class DashboardCache(Base):
     def updated_at_moscow(self) -> str:
         return format_moscow(self.updated_at)
 
+
+# === BOT_STATE (context.user_data / chat_data для PTB persistence) ===
+class BotState(Base):
+    __tablename__ = "bot_state"
+
+    kind: Mapped[str] = mapped_column(String(8), primary_key=True)  # user | chat
+    key: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    data: Mapped[str] = mapped_column(Text, default="{}", server_default="{}")
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+    updated_at: Mapped[dt.datetime] = mapped_column(
+        DateTime(timezone=True),
+        default=ts_now,
+        onupdate=ts_now,
+    )
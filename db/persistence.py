@@ -0,0 +1,245 @@
+# db/persistence.py
+# =========================================================
+# PTB persistence для context.user_data / chat_data в таблице bot_state.
+#
+# 🧩 Зачем: состояние сценария (last_photo_path, prompt, last_message_id)
+#    живёт в user_data. В памяти одного процесса — значит только один
+#    uvicorn-воркер. С PERSISTENCE_BACKEND=db апдейты одного пользователя
+#    могут попадать в любой воркер / инстанс.
+#
+# ⚙️ Как работает:
+#   - запись (write-behind): PTB сам копит изменённые user_id и раз в
+#     PERSISTENCE_FLUSH_SEC вызывает update_user_data → compare-and-swap:
+#     UPDATE ... SET version = version + 1 WHERE version = :known. 0 строк —
+#     другой воркер успел записать: перечитываем, накладываем поверх его
+#     данных только свои изменённые ключи (сверка с базой — последней
+#     известной версией) и повторяем. Последний записавший не затирает чужое;
+#   - чтение: перед каждым апдейтом PTB вызывает refresh_user_data → в БД
+#     уходит только сверка версии; данные тянутся, если их изменил другой
+#     воркер (in-process кэш = сам context.user_data + известная версия),
+#     и сливаются так же, как при конфликте записи: ещё не сброшенные
+#     локальные изменения не затираются;
+#   - при старте ничего не грузим — состояние подтягивается по требованию;
+#   - таблица bot_state создаётся миграциями (db/migrations.py), не здесь.
+#
+# 🚀 Несколько воркеров (Procfile):
+#        PERSISTENCE_BACKEND=db WEB_CONCURRENCY=4
+#    Нужен Postgres (SQLite — только локально, один воркер). Локальные файлы
+#    не переживают переход между воркерами: фото хранится и как file_id,
+#    и handlers.photo перекачивает его, если временного файла нет.
+#    Очередь ingress, кэши и метрики — свои в каждом воркере.
+# =========================================================
+import json
+import time
+
+from sqlalchemy import select, delete, update
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import settings
+from db.database import dialect_insert, get_session
+from db.models import BotState, ts_now
+
+USER, CHAT = "user", "chat"
+WRITE_ATTEMPTS = 5
+_MISSING = object()
+
+
+def _insert_new(kind: str, key: int, payload: str):
+    """Первая запись: строки ещё нет. None — её успел создать другой воркер."""
+    stmt = dialect_insert()(BotState).values(kind=kind, key=key, data=payload, version=1, updated_at=ts_now())
+    return stmt.on_conflict_do_nothing(index_elements=[BotState.kind, BotState.key]).returning(BotState.version)
+
+
+def _update_if(kind: str, key: int, payload: str, known: int):
+    """Compare-and-swap по версии. None — версия в БД уже другая."""
+    return (
+        update(BotState)
+        .where(BotState.kind == kind, BotState.key == key, BotState.version == known)
+        .values(data=payload, version=BotState.version + 1, updated_at=ts_now())
+        .returning(BotState.version)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _merge(base: dict, local: dict, remote: dict) -> dict:
+    """Поверх remote — только ключи, которые мы поменяли / удалили относительно base."""
+    merged = dict(remote)
+    for k in set(base) | set(local):
+        mine, was = local.get(k, _MISSING), base.get(k, _MISSING)
+        if mine == was:
+            continue  # не трогали — остаётся версия другого воркера
+        if mine is _MISSING:
+            merged.pop(k, None)
+        else:
+            merged[k] = mine
+    return merged
+
+
+class DbPersistence(BasePersistence):
+    """user_data / chat_data в таблице bot_state. bot_data, callback_data и диалоги не храним."""
+
+    def __init__(self, update_interval: float | None = None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=update_interval if update_interval is not None else settings.persistence_flush_sec,
+        )
+        self._versions: dict[tuple[str, int], int] = {}   # последняя известная версия
+        self._base: dict[tuple[str, int], dict] = {}      # данные этой версии (для слияния)
+        self._checked: dict[tuple[str, int], float] = {}  # когда сверялись с БД
+        self.stats = {"refresh_checks": 0, "refresh_loads": 0, "writes": 0, "conflicts": 0, "errors": 0}
+
+    # === Чтение ===
+    async def _refresh(self, kind: str, key: int, data: dict) -> None:
+        ident = (kind, key)
+        now = time.monotonic()
+        if now - self._checked.get(ident, float("-inf")) < settings.persistence_refresh_sec:
+            return
+        self._checked[ident] = now
+
+        known = self._versions.get(ident, 0)
+        try:
+            async with get_session() as session:
+                row = (await session.execute(
+                    select(BotState.version, BotState.data).where(
+                        BotState.kind == kind, BotState.key == key, BotState.version > known,
+                    )
+                )).first()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"⚠️ Persistence: не удалось прочитать {kind}:{key}: {e}")
+            return
+
+        self.stats["refresh_checks"] += 1
+        if row is None:
+            return  # у нас актуальная версия
+
+        self.stats["refresh_loads"] += 1
+        remote = json.loads(row.data or "{}")
+        base = self._base.get(ident, {})
+        local = json.loads(json.dumps(data, ensure_ascii=False, default=str))
+        # 🧩 то же слияние, что в _write: ещё не записанные изменения этого воркера
+        # (отличия от base) остаются, остальные ключи берём из версии другого воркера
+        for k in set(base) | set(local) | set(remote):
+            if local.get(k, _MISSING) != base.get(k, _MISSING):
+                continue  # наше изменение — уйдёт в БД следующим _write (CAS поверх remote)
+            if k in remote:
+                data[k] = remote[k]
+            else:
+                data.pop(k, None)
+        self._versions[ident] = row.version
+        self._base[ident] = remote
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._refresh(CHAT, chat_id, chat_data)
+
+    async def get_user_data(self) -> dict:
+        return {}  # грузим лениво, в refresh_user_data
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    # === Запись (write-behind, вызывается PTB раз в update_interval) ===
+    async def _write(self, kind: str, key: int, data: dict) -> None:
+        ident = (kind, key)
+        payload = json.dumps(data, ensure_ascii=False, default=str)
+        local = mine = json.loads(payload)
+        base = self._base.get(ident, {})
+        try:
+            # isolated: запись состояния не должна зависеть от транзакции апдейта
+            async with get_session(isolated=True) as session:
+                for _ in range(WRITE_ATTEMPTS):
+                    known = self._versions.get(ident, 0)
+                    stmt = _insert_new(kind, key, payload) if known == 0 else _update_if(kind, key, payload, known)
+                    version = (await session.execute(stmt)).scalar_one_or_none()
+                    if version is not None:
+                        await session.commit()
+                        break
+
+                    # другой воркер записал раньше — сливаем и пробуем снова
+                    self.stats["conflicts"] += 1
+                    row = (await session.execute(
+                        select(BotState.version, BotState.data).where(BotState.kind == kind, BotState.key == key)
+                    )).first()
+                    await session.rollback()
+                    remote = json.loads(row.data or "{}") if row else {}
+                    local = _merge(self._base.get(ident, {}), local, remote)
+                    payload = json.dumps(local, ensure_ascii=False, default=str)
+                    self._versions[ident] = row.version if row else 0
+                    self._base[ident] = remote
+                else:
+                    raise RuntimeError(f"не удалось записать за {WRITE_ATTEMPTS} попыток (конкурентные записи)")
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"⚠️ Persistence: не удалось сохранить {kind}:{key}: {e}")
+            return
+        self.stats["writes"] += 1
+        self._versions[ident] = version
+        self._base[ident] = local
+        if local is not mine:
+            # после слияния: в context.user_data — ключи, записанные другим воркером
+            for k in set(data) | set(local):
+                if mine.get(k, _MISSING) != base.get(k, _MISSING):
+                    continue  # наше изменение — объект в data и так актуален
+                if k in local:
+                    data[k] = local[k]
+                else:
+                    data.pop(k, None)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._write(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._write(CHAT, chat_id, data)
+
+    async def _drop(self, kind: str, key: int) -> None:
+        async with get_session() as session:
+            await session.execute(delete(BotState).where(BotState.kind == kind, BotState.key == key))
+            await session.commit()
+        self._versions.pop((kind, key), None)
+        self._base.pop((kind, key), None)
+        self._checked.pop((kind, key), None)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop(USER, user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop(CHAT, chat_id)
+
+    # === Не храним ===
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name, key, new_state) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # PTB перед flush() вызывает update_persistence() — всё уже записано
+        print(f"💾 Persistence flushed: {self.stats}")
+
+
+def build_persistence() -> DbPersistence | None:
+    """Persistence по PERSISTENCE_BACKEND: None — состояние только в памяти процесса."""
+    backend = settings.persistence_backend.lower()
+    if backend == "db":
+        return DbPersistence()
+    if backend != "memory":
+        print(f"⚠️ PERSISTENCE_BACKEND={backend!r} не поддерживается — состояние в памяти")
+    return None
@@ -1,7 +1,9 @@
-from sqlalchemy import select, func, and_, text
+from sqlalchemy import select, func, text, update
+from sqlalchemy.orm import aliased
+from cachetools import TTLCache
 
 from db.models import User, Referral
-from db.database import get_session
+from db.database import dialect_insert, get_session, on_commit
 from datetime import datetime
 from config import settings
 
@@ -9,6 +11,160 @@ BONUS_PER_FRIEND = settings.bonus_per_friend  # 👈 правильно, про
 
 
 
+# === Снимки пользователя (только чтение) ===
+# Экраны, которым нужно 2–3 колонки, не грузят ORM-объект User целиком:
+# select только нужных колонок → компактный объект на __slots__.
+class _Snapshot:
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} только для чтения")
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class UserBalance(_Snapshot):
+    """Главное меню, инструкция, проверка генераций."""
+    __slots__ = ("id", "balance", "free_trial_used")
+
+
+class UserProfile(_Snapshot):
+    """Результат upsert_user: /start, ensure_user, оплата."""
+    __slots__ = ("id", "username", "full_name", "balance", "consent_accepted")
+
+
+class UserStats(_Snapshot):
+    """Меню, пополнение, /balance: баланс + рефералка + кто пригласил."""
+    __slots__ = (
+        "id", "username", "balance", "free_trial_used",
+        "invited_total", "invited_paid", "referrer_username",
+    )
+
+
+# === Кэш снимков (TTL + LRU) ===
+# Ключ — (класс снимка, user_id). Снимки неизменяемые, поэтому их можно
+# отдавать из кэша как есть. Любое изменение баланса / согласия / рефералки
+# обязано вызвать invalidate_user(). Кэш свой в каждом процессе — при
+# нескольких воркерах свежесть ограничена USER_CACHE_TTL_SEC.
+_user_cache: TTLCache = TTLCache(maxsize=max(1, settings.user_cache_size), ttl=settings.user_cache_ttl_sec)
+_cached_kinds: set[type] = set()
+cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def _drop_cached(user_ids: tuple[int, ...]) -> None:
+    for user_id in user_ids:
+        for kind in _cached_kinds:
+            _user_cache.pop((kind, user_id), None)
+
+
+def invalidate_user(*user_ids: int) -> None:
+    """Сбросить снимки пользователей: сразу и ещё раз после commit апдейта
+    (чтобы параллельное чтение старых данных не вернуло их в кэш)."""
+    cache_stats["invalidations"] += len(user_ids)
+    _drop_cached(user_ids)
+    on_commit(lambda: _drop_cached(user_ids))
+
+
+async def _cached(kind: type, user_id: int, load):
+    key = (kind, user_id)
+    snap = _user_cache.get(key)
+    if snap is not None:
+        cache_stats["hits"] += 1
+        return snap
+    cache_stats["misses"] += 1
+    snap = await load()
+    if snap is not None:
+        _cached_kinds.add(kind)
+        _user_cache[key] = snap
+    return snap
+
+
+def user_cache_snapshot() -> dict:
+    total = cache_stats["hits"] + cache_stats["misses"]
+    return {
+        **cache_stats,
+        "hit_rate": round(cache_stats["hits"] / total, 3) if total else 0.0,
+        "size": len(_user_cache),
+        "maxsize": _user_cache.maxsize,
+        "ttl_sec": _user_cache.ttl,
+    }
+
+
+async def get_user_snapshot(user_id: int, snapshot_cls: type[_Snapshot]):
+    """Одна строка users, только колонки snapshot_cls.__slots__. None — если юзера нет."""
+    async def load():
+        columns = [getattr(User, name) for name in snapshot_cls.__slots__]
+        async with get_session() as session:
+            row = (await session.execute(select(*columns).where(User.id == user_id))).first()
+        return snapshot_cls(**row._mapping) if row else None
+
+    return await _cached(snapshot_cls, user_id, load)
+
+
+
+# === Создание / обновление пользователя одним запросом ===
+async def upsert_user(user_id: int, username: str | None = None, full_name: str | None = None) -> UserProfile:
+    """INSERT ... ON CONFLICT (id) DO UPDATE ... RETURNING — один round trip.
+
+    Пустые username / full_name не затирают сохранённые значения.
+    """
+    stmt = dialect_insert()(User).values(
+        id=user_id,
+        username=username or None,
+        full_name=full_name or None,
+        balance=0,
+        consent_accepted=False,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={
+            "username": func.coalesce(stmt.excluded.username, User.username),
+            "full_name": func.coalesce(stmt.excluded.full_name, User.full_name),
+        },
+    ).returning(*[getattr(User, name) for name in UserProfile.__slots__])
+
+    async with get_session() as session:
+        row = (await session.execute(stmt)).one()
+        await session.commit()
+    invalidate_user(user_id)
+    return UserProfile(**row._mapping)
+
+
+# === Баланс + рефералка одним запросом ===
+async def get_user_stats(user_id: int) -> UserStats | None:
+    """users (со счётчиками рефералки) + username пригласившего — один SQL-запрос."""
+    invited_by = aliased(Referral)  # кто пригласил user_id
+    referrer = aliased(User)
+
+    stmt = (
+        select(
+            User.id,
+            User.username,
+            User.balance,
+            User.free_trial_used,
+            func.coalesce(User.invited_total, 0).label("invited_total"),
+            func.coalesce(User.invited_paid, 0).label("invited_paid"),
+            referrer.username.label("referrer_username"),
+        )
+        .select_from(User)
+        .outerjoin(invited_by, invited_by.invited_id == User.id)
+        .outerjoin(referrer, referrer.id == invited_by.inviter_id)
+        .where(User.id == user_id)
+    )
+    async def load():
+        async with get_session() as session:
+            row = (await session.execute(stmt)).first()
+        return UserStats(**row._mapping) if row else None
+
+    return await _cached(UserStats, user_id, load)
+
+
 # === Добавление реферала ===
 async def add_referral(inviter_id: int, invited_id: int):
     async with get_session() as session:
@@ -27,39 +183,86 @@ async def add_referral(inviter_id: int, invited_id: int):
             created_at=datetime.utcnow()
         ))
 
-        # 🧩 === UPDATE REFERRER ===
+        # 🧩 === UPDATE REFERRER === (в той же транзакции, что и вставка)
         await session.execute(text("""
             UPDATE users
-            SET referrals_count = COALESCE(referrals_count, 0) + 1
+            SET referrals_count = COALESCE(referrals_count, 0) + 1,
+                invited_total = COALESCE(invited_total, 0) + 1
             WHERE id = :referrer_id
         """), {"referrer_id": inviter_id})
 
         await session.commit()
+    invalidate_user(inviter_id)
+
+
+# === Бонус за оплату друга ===
+async def mark_referral_paid(session, invited_id: int) -> int | None:
+    """Помечает бонус выданным и увеличивает invited_paid пригласившего.
+
+    Вызывающий коммитит сам — оба UPDATE попадают в одну транзакцию.
+    Возвращает inviter_id или None, если бонус уже выдан / реферала нет.
+    """
+    inviter_id = (await session.execute(
+        update(Referral)
+        .where(Referral.invited_id == invited_id, Referral.bonus_awarded.is_(False))
+        .values(bonus_awarded=True)
+        .returning(Referral.inviter_id)
+        .execution_options(synchronize_session=False)
+    )).scalar_one_or_none()
+
+    if inviter_id is not None:
+        await session.execute(
+            update(User)
+            .where(User.id == inviter_id)
+            .values(invited_paid=func.coalesce(User.invited_paid, 0) + 1)
+            .execution_options(synchronize_session=False)
+        )
+        invalidate_user(inviter_id)
+    return inviter_id
+
+
+# === Пересчёт счётчиков из referrals ===
+def recount_referrals_stmt(user_ids: list[int] | None = None):
+    """UPDATE users: invited_total / invited_paid = COUNT по referrals (без сброса кэша)."""
+    total = (
+        select(func.count(Referral.id))
+        .where(Referral.inviter_id == User.id)
+        .scalar_subquery()
+    )
+    paid = (
+        select(func.count(Referral.id))
+        .where(Referral.inviter_id == User.id, Referral.bonus_awarded.is_(True))
+        .scalar_subquery()
+    )
+    stmt = update(User).values(invited_total=total, invited_paid=paid)
+    if user_ids is not None:
+        stmt = stmt.where(User.id.in_(user_ids))
+    return stmt.execution_options(synchronize_session=False)
+
+
+async def recount_referrals(session, user_ids: list[int] | None = None) -> int:
+    """invited_total / invited_paid = COUNT по referrals (для всех или для user_ids)."""
+    result = await session.execute(recount_referrals_stmt(user_ids))
+    if user_ids is None:
+        _user_cache.clear()
+    else:
+        invalidate_user(*user_ids)
+    return result.rowcount
 
 
 # === Статистика по рефералам ===
 async def get_referral_stats(user_id: int):
     async with get_session() as session:
-        total = await session.scalar(
-            select(func.count(Referral.id)).where(Referral.inviter_id == user_id)
-        )
-        paid = await session.scalar(
-            select(func.count(Referral.id)).where(
-                and_(Referral.inviter_id == user_id, Referral.bonus_awarded.is_(True))
-            )
-        )
-        return total or 0, paid or 0
+        row = (await session.execute(
+            select(User.invited_total, User.invited_paid).where(User.id == user_id)
+        )).first()
+        if not row:
+            return 0, 0
+        return row.invited_total or 0, row.invited_paid or 0
 
 # === Проверка, есть ли доступные генерации ===
 async def has_generations(user_id: int) -> bool:
-    async with get_session() as session:
-        user = await session.get(User, user_id)
-        if not user:
-            return False
-
-        trial_left = 0 if user.free_trial_used else 1
-        invited_total, invited_paid = await get_referral_stats(user_id)
-        referral_bonus = invited_paid * settings.bonus_per_friend
-        total_available = int(user.balance) + trial_left + referral_bonus
-
-        return total_available > 0
+    """То же правило, что в credits.reserve: списывается только users.balance.
+    Бонус за друзей уже зачислен в balance (ledger, referral_bonus) — отдельно не прибавляем."""
+    user = await get_user_snapshot(user_id, UserBalance)
+    return bool(user) and int(user.balance or 0) > 0
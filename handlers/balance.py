@@ -6,12 +6,13 @@ from db.models import User, Referral, Payment
 import asyncio
 
 from config import settings
-from db.database import get_session
+from db.database import end_scope, get_session
 
 from sqlalchemy.orm import selectinload
 
 from services import yookassa as yk
-from db.repo import get_referral_stats
+from db.repo import get_referral_stats, get_user_stats, mark_referral_paid, recount_referrals, invalidate_user
+from db import ledger
 from services.performance_logger import measure_time
 
 
@@ -50,28 +51,24 @@ def _make_test_link(amount: int, user_id: int, description: str):
 # ============ Временное пополнение генераций ============
 async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = 5  # сколько генераций добавить
+    user_id = update.effective_user.id
     async with get_session() as session:
-
-        result = await session.execute(select(User).where(User.id == update.effective_user.id))
-        user = result.scalar_one()
-        old = int(user.balance)
-        user.balance = int(user.balance) + amount
-        session.add(user)
+        old, new = await ledger.apply_delta(session, user_id, amount, "manual_add_balance")
         await session.commit()
 
-        # лог в таблицу
-        asyncio.create_task(log_balance_change(
-            user_id=user.id,
-            old_balance=old,
-            delta=amount,
-            new_balance=int(user.balance),
-            reason="manual_add_balance",
-        ))
+    # лог в таблицу
+    asyncio.create_task(log_balance_change(
+        user_id=user_id,
+        old_balance=old,
+        delta=amount,
+        new_balance=new,
+        reason="manual_add_balance",
+    ))
 
-        await update.message.reply_text(
-            f"✅ Баланс пополнен на {amount} генераций\n"
-            f"💳 Текущий баланс: {user.balance:.0f} генераций"
-        )
+    await update.message.reply_text(
+        f"✅ Баланс пополнен на {amount} генераций\n"
+        f"💳 Текущий баланс: {new:.0f} генераций"
+    )
 
 # ============ Главное меню пополнения ============
 
@@ -83,79 +80,74 @@ async def open_balance(update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
-    async with get_session() as session:
-
-        result = await session.execute(select(User).where(User.id == q.from_user.id))
-
-        user = result.scalar_one_or_none()
-        if not user:
-            return await send_or_replace_text(update, context, "⚠️ Пользователь не найден, попробуйте /start")
+    user = await get_user_stats(q.from_user.id)
+    if not user:
+        return await send_or_replace_text(update, context, "⚠️ Пользователь не найден, попробуйте /start")
 
 
-        # лог в Google Sheets
-        asyncio.create_task(gsheets.log_user_event(
-            user_id=user.id,
-            username=user.username,
-            event="open_balance",
-            meta={"balance": user.balance}
-        ))
-
-        gen_price = settings.price_rub
-        packs = settings.packs  # [5, 15, 30, 50] = кол-во генераций
+    # лог в Google Sheets
+    asyncio.create_task(gsheets.log_user_event(
+        user_id=user.id,
+        username=user.username,
+        event="open_balance",
+        meta={"balance": user.balance}
+    ))
 
-        # ---- считаем баланс (платный + рефералка) ----
-        paid_balance = int(user.balance)
-        invited_total, invited_paid = await get_referral_stats(user.id)
-        referral_bonus = invited_paid * settings.bonus_per_friend
-        total_available = paid_balance + referral_bonus
+    gen_price = settings.price_rub
+    packs = settings.packs  # [5, 15, 30, 50] = кол-во генераций
 
-        # ---- текст ----
-        text = (
-            "💎 <b>ТАРИФЫ ГЕНЕРАЦИЙ</b>\n\n"
-            f"💡 1 оживление = 1 генерация = <b>{gen_price} ₽</b>\n\n"
-            f"🎉 Баланс: <b>{total_available}</b> генераций\n"
-            "📌 Генерации <i>не сгорают</i> и копятся на аккаунте ✨\n\n"
-            "⬇️ <b>ВЫБЕРИТЕ ПАКЕТ:</b>\n\n"
-            f"🎁 За каждые 10 генераций → +{settings.bonus_per_10} в подарок!\n"
-            f"🤝 За каждого приглашённого друга → +{settings.bonus_per_friend} в подарок!\n\n"
-        )
+    # ---- считаем баланс (платный + рефералка) ----
+    paid_balance = int(user.balance)
+    referral_bonus = user.invited_paid * settings.bonus_per_friend
+    total_available = paid_balance + referral_bonus
 
-        # #пробник: выводим тарифы по 2 в ряд
-        buttons = []
-        row = []
-        for i, base in enumerate(packs):
-            amount_rub = base * gen_price
-            gens_total = calc_generations(base)
-            bonus = gens_total - base
-            label = f"{base} ген = {amount_rub} ₽"
-            if bonus > 0:
-                label += f" (+{bonus}🎁)"
-            
-            row.append(InlineKeyboardButton(label, callback_data=f"topup:{amount_rub}"))
-            if len(row) == 2 or i == len(packs) - 1:
-                buttons.append(row)
-                row = []
+    # ---- текст ----
+    text = (
+        "💎 <b>ТАРИФЫ ГЕНЕРАЦИЙ</b>\n\n"
+        f"💡 1 оживление = 1 генерация = <b>{gen_price} ₽</b>\n\n"
+        f"🎉 Баланс: <b>{total_available}</b> генераций\n"
+        "📌 Генерации <i>не сгорают</i> и копятся на аккаунте ✨\n\n"
+        "⬇️ <b>ВЫБЕРИТЕ ПАКЕТ:</b>\n\n"
+        f"🎁 За каждые 10 генераций → +{settings.bonus_per_10} в подарок!\n"
+        f"🤝 За каждого приглашённого друга → +{settings.bonus_per_friend} в подарок!\n\n"
+    )
 
-        # кнопки внизу
-        buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_menu")])
-        kb = InlineKeyboardMarkup(buttons)
+    # #пробник: выводим тарифы по 2 в ряд
+    buttons = []
+    row = []
+    for i, base in enumerate(packs):
+        amount_rub = base * gen_price
+        gens_total = calc_generations(base)
+        bonus = gens_total - base
+        label = f"{base} ген = {amount_rub} ₽"
+        if bonus > 0:
+            label += f" (+{bonus}🎁)"
+        
+        row.append(InlineKeyboardButton(label, callback_data=f"topup:{amount_rub}"))
+        if len(row) == 2 or i == len(packs) - 1:
+            buttons.append(row)
+            row = []
+
+    # кнопки внизу
+    buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_menu")])
+    kb = InlineKeyboardMarkup(buttons)
 
-        try:
-            if q.message and (q.message.video or q.message.photo):
-                await q.message.edit_caption(
-                    caption=text, parse_mode="HTML", reply_markup=kb
-                )
-            else:
-                await q.message.edit_text(
-                    text=text, parse_mode="HTML", reply_markup=kb
-                )
-        except Exception:
-            await context.bot.send_message(
-                chat_id=q.message.chat_id,
-                text=text,
-                parse_mode="HTML",
-                reply_markup=kb
+    try:
+        if q.message and (q.message.video or q.message.photo):
+            await q.message.edit_caption(
+                caption=text, parse_mode="HTML", reply_markup=kb
             )
+        else:
+            await q.message.edit_text(
+                text=text, parse_mode="HTML", reply_markup=kb
+            )
+    except Exception:
+        await context.bot.send_message(
+            chat_id=q.message.chat_id,
+            text=text,
+            parse_mode="HTML",
+            reply_markup=kb
+        )
 
 # ===== Создание ссылки на оплату =====
 @measure_time
@@ -167,10 +159,11 @@ async def create_topup(update, context: ContextTypes.DEFAULT_TYPE, amount: int):
         pass
 
     # 🧩 Гарантируем, что пользователь есть в БД перед оплатой
-    from services.billing_core import upsert_user
+    from db.repo import upsert_user
     user_id = q.from_user.id
-    username = q.from_user.username or ""
-    await upsert_user(user_id, username)
+    await upsert_user(user_id, q.from_user.username, q.from_user.full_name)
+    # 🔓 фиксируем и отпускаем строку users до запроса к API оплаты (до 30 сек)
+    await end_scope()
 
 
 
@@ -237,8 +230,9 @@ async def create_topup(update, context: ContextTypes.DEFAULT_TYPE, amount: int):
     else:
         # Tinkoff
         try:
-            pay_id, url, order_id = tinkoff_create(
-                amount, description, q.from_user.id, order_id=order_id
+            # requests синхронный — уводим в поток, чтобы не стопорить других пользователей
+            pay_id, url, order_id = await asyncio.to_thread(
+                tinkoff_create, amount, description, q.from_user.id, order_id=order_id
             )
             asyncio.create_task(log_payment_attempt(
                 user_id=q.from_user.id,
@@ -266,6 +260,9 @@ async def create_topup(update, context: ContextTypes.DEFAULT_TYPE, amount: int):
     if not pay_id:
         pay_id = order_id
 
+    # 💾 платёж в базе до того, как пользователь увидит «Проверить оплату»
+    await end_scope()
+
     # Кнопки
     kb = InlineKeyboardMarkup([
         [InlineKeyboardButton(f"💳 Оплатить {amount} ₽", url=url)],
@@ -307,18 +304,21 @@ async def check_payment(update, context: ContextTypes.DEFAULT_TYPE):
             
         )).scalar_one_or_none()
 
-        if not payment:
-            await send_or_replace_text(update, context, "⚠️ Платёж не найден в базе.")
-            return
+        if payment:
+            provider = getattr(payment, "provider", settings.payment_provider).upper()
+            amount_for_log = float(payment.amount)
 
-        provider = getattr(payment, "provider", settings.payment_provider).upper()
-        amount_for_log = float(payment.amount)
+    # 🔓 транзакцию апдейта закрываем до запроса статуса (to_thread, до 30 сек)
+    await end_scope()
+    if not payment:
+        await send_or_replace_text(update, context, "⚠️ Платёж не найден в базе.")
+        return
 
     # проверяем статус по провайдеру
     if provider == "YOOKASSA":
         status = await asyncio.to_thread(yk.get_payment_status, pay_id)
     else:
-        status = tinkoff_status(pay_id)
+        status = await asyncio.to_thread(tinkoff_status, pay_id)
 
 
     # логируем событие
@@ -340,6 +340,8 @@ async def check_payment(update, context: ContextTypes.DEFAULT_TYPE):
 
     # успешный платёж
     if status in ["CONFIRMED", "AUTHORIZED", "SUCCEEDED"]:
+        changes = []       # (user_id, old, delta, new, reason) — в лог после commit
+        ref_user = None
 
         async with get_session() as session:
             payment = (await session.execute(
@@ -348,72 +350,58 @@ async def check_payment(update, context: ContextTypes.DEFAULT_TYPE):
 
             if payment and payment.status not in ["CONFIRMED", "AUTHORIZED", "SUCCEEDED"]:
                 payment.status = status
-                user = (await session.execute(
-                    select(User).where(User.id == q.from_user.id)
-                )).scalar_one()
-                old = int(user.balance)
 
                 base = int(payment.amount) // settings.price_rub
                 gens_total = calc_generations(base)
-                user.balance += gens_total
+                reason = f"{provider.lower()}_payment_confirmed"
+                old, new = await ledger.apply_delta(session, q.from_user.id, gens_total, reason, ref=pay_id)
+                changes.append((q.from_user.id, old, gens_total, new, reason))
 
-                await session.commit()
-
-                asyncio.create_task(log_balance_change(
-                    user_id=user.id,
-                    old_balance=old,
-                    delta=gens_total,
-                    new_balance=int(user.balance),
-                    reason=f"{provider.lower()}_payment_confirmed",
-                ))
-                
                 # === РЕФЕРАЛКА ===
-                from db.models import Referral
-
-                referral = (await session.execute(
-                    select(Referral).where(
-                        Referral.invited_id == q.from_user.id,
-                        Referral.bonus_awarded.is_(False)
-                    )
-                )).scalar_one_or_none()
-
-                if referral:
-                    # помечаем бонус выданным
-                    referral.bonus_awarded = True
-                    await session.commit()
+                # флаг бонуса, счётчик invited_paid и баланс пригласившего — одна транзакция
+                inviter_id = await mark_referral_paid(session, q.from_user.id)
 
+                if inviter_id is not None:
                     # --- пригласившему +3 ---
                     ref_user = (await session.execute(
-                        select(User).where(User.id == referral.inviter_id)
+                        select(User).where(User.id == inviter_id)
                     )).scalar_one_or_none()
-
                     if ref_user:
-                        old = int(ref_user.balance)
-                        ref_user.balance = old + settings.bonus_per_friend
-                        await session.commit()
-
-                        asyncio.create_task(log_balance_change(
-                            user_id=ref_user.id,
-                            old_balance=old,
-                            delta=settings.bonus_per_friend,
-                            new_balance=int(ref_user.balance),
-                            reason="referral_bonus"
-                        ))
-                        inv_total, inv_paid = await get_referral_stats(ref_user.id)
-                        bonus_total = inv_paid * settings.bonus_per_friend
-                        asyncio.create_task(gsheets.update_referrals_summary(ref_user.id, inv_total, inv_paid, bonus_total))
-                        # 💬 Уведомляем пригласителя о бонусе
-                        try:
-                            await context.bot.send_message(
-                                chat_id=ref_user.id,
-                                text=f"🎉 Ваш друг оплатил! Вам начислена +{settings.bonus_per_friend} генерация 💎"
-                            )
-                        except Exception as e:
-                            print(f"⚠️ Не удалось отправить уведомление пригласителю {ref_user.id}: {e}")
+                        old, new = await ledger.apply_delta(
+                            session, inviter_id, settings.bonus_per_friend, "referral_bonus", ref=pay_id
+                        )
+                        changes.append((inviter_id, old, settings.bonus_per_friend, new, "referral_bonus"))
+
+                await session.commit()
+
+        # ✅ настоящий commit — только после него логи и сообщения о зачислении
+        await end_scope()
+
+        for user_id, old, delta, new, reason in changes:
+            asyncio.create_task(log_balance_change(
+                user_id=user_id,
+                old_balance=old,
+                delta=delta,
+                new_balance=new,
+                reason=reason,
+            ))
+
+        if ref_user:
+            inv_total, inv_paid = ref_user.invited_total, ref_user.invited_paid
+            bonus_total = inv_paid * settings.bonus_per_friend
+            asyncio.create_task(gsheets.update_referrals_summary(ref_user.id, inv_total, inv_paid, bonus_total))
+            # 💬 Уведомляем пригласителя о бонусе
+            try:
+                await context.bot.send_message(
+                    chat_id=ref_user.id,
+                    text=f"🎉 Ваш друг оплатил! Вам начислена +{settings.bonus_per_friend} генерация 💎"
+                )
+            except Exception as e:
+                print(f"⚠️ Не удалось отправить уведомление пригласителю {ref_user.id}: {e}")
 
 
         # ещё раз берём актуального юзера из БД, чтобы баланс был свежий
-        async with get_session() as session:
+        async with get_session(isolated=True) as session:
 
             user = (await session.execute(
                 select(User).where(User.id == q.from_user.id)
@@ -434,24 +422,21 @@ async def check_payment(update, context: ContextTypes.DEFAULT_TYPE):
 
 # ============ Обнуление генераций ============
 async def reset_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
     async with get_session() as session:
-        result = await session.execute(select(User).where(User.id == update.effective_user.id))
-
-        user = result.scalar_one()
-        old = int(user.balance)  # старое количество генераций
-        user.balance = 0  # обнуляем
+        old, _ = await ledger.set_balance(session, user_id, 0, "reset_generations")  # обнуляем
         await session.commit()
 
-        # логируем в таблицу
-        asyncio.create_task(log_balance_change(
-            user_id=user.id,
-            old_balance=old,
-            delta=-old,
-            new_balance=0,
-            reason="reset_generations",
-        ))
+    # логируем в таблицу
+    asyncio.create_task(log_balance_change(
+        user_id=user_id,
+        old_balance=old,
+        delta=-old,
+        new_balance=0,
+        reason="reset_generations",
+    ))
 
-        await update.message.reply_text("🔄 Баланс генераций обнулён. Теперь у Вас 0 генераций.")
+    await update.message.reply_text("🔄 Баланс генераций обнулён. Теперь у Вас 0 генераций.")
 
 # ============ Компенсация генераций через техподдержку ============
 async def compensate(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -473,31 +458,29 @@ async def compensate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     async with get_session() as session:
-        user = (await session.execute(
-            select(User).where(User.id == user_id)
-        )).scalar_one_or_none()
-
-        if not user:
-            await update.message.reply_text(f"❌ Пользователь с ID {user_id} не найден")
-            return
-
-        old = int(user.balance)
-        user.balance = int(user.balance) + gens_to_add
+        change = await ledger.apply_delta(
+            session, user_id, gens_to_add, "compensate_generations", ref=f"admin:{update.effective_user.id}"
+        )
         await session.commit()
 
-        # лог
-        asyncio.create_task(log_balance_change(
-            user_id=user.id,
-            old_balance=old,
-            delta=gens_to_add,
-            new_balance=int(user.balance),
-            reason="compensate_generations",
-        ))
+    if change is None:
+        await update.message.reply_text(f"❌ Пользователь с ID {user_id} не найден")
+        return
+    old, new = change
 
-        await update.message.reply_text(
-            f"✅ Пользователю {user_id} добавлено {gens_to_add} генераций\n"
-            f"🎉 Новый баланс: {user.balance} генераций"
-        )
+    # лог
+    asyncio.create_task(log_balance_change(
+        user_id=user_id,
+        old_balance=old,
+        delta=gens_to_add,
+        new_balance=new,
+        reason="compensate_generations",
+    ))
+
+    await update.message.reply_text(
+        f"✅ Пользователю {user_id} добавлено {gens_to_add} генераций\n"
+        f"🎉 Новый баланс: {new} генераций"
+    )
 
 
 # ============ Проверка баланса пользователя (для админа) ============
@@ -554,6 +537,16 @@ async def get_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             pay_info = "💳 Платежей пока нет\n\n"
 
+        # ==== Последние движения баланса (журнал, индекс user_id + id) ====
+        entries = await ledger.history(session, user.id, limit=5)
+        if entries:
+            ledger_info = "📒 Движения баланса:\n" + "".join(
+                f"• {e.ts.strftime('%d.%m %H:%M')} {e.delta:+d} → {e.balance_after} ({e.reason})\n"
+                for e in entries
+            ) + "\n"
+        else:
+            ledger_info = ""
+
         # ==== Рефералы ====
         invited_count = len(user.referrals_as_inviter)
         invited_by_count = len(user.referrals_as_invited)
@@ -568,6 +561,7 @@ async def get_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"👥 Пригласил: {invited_count} пользователей\n"
             f"📥 Был приглашён: {invited_by_count}\n\n"
             f"{pay_info}"
+            f"{ledger_info}"
         )
 
         await update.message.reply_text(text, parse_mode="HTML")
@@ -583,26 +577,17 @@ async def cmd_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or "—"
     invite_link = f"https://t.me/Photo_AliveBot?start=ref{user_id}"
 
-    async with get_session() as session:
-        user = (await session.execute(
-            select(User).where(User.id == user_id)
-
-        )).scalar_one_or_none()
-
-        if not user:
-            await update.message.reply_text("❌ Пользователь не найден.")
-            return
+    # баланс, рефералка и пригласивший — один запрос
+    user = await get_user_stats(user_id)
+    if not user:
+        await update.message.reply_text("❌ Пользователь не найден.")
+        return
 
-        balance = int(user.balance)
-        invited_total, invited_paid = await get_referral_stats(user_id)
-        bonus_total = invited_paid * settings.bonus_per_friend
-        total_generations = balance + bonus_total
-
-        referrer_username = (await session.execute(
-            select(User.username)
-            .join_from(User, Referral, Referral.inviter_id == User.id)
-            .where(Referral.invited_id == user_id)
-        )).scalar_one_or_none()
+    balance = int(user.balance)
+    invited_total, invited_paid = user.invited_total, user.invited_paid
+    bonus_total = invited_paid * settings.bonus_per_friend
+    total_generations = balance + bonus_total
+    referrer_username = user.referrer_username
 
     # лог в Google Sheets
     asyncio.create_task(gsheets.log_user_event(
@@ -697,16 +682,23 @@ async def reset_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"❌ Пользователь {user_id} не найден")
             return
 
-        # обнуляем баланс
-        user.balance = 0
-    
+        # обнуляем баланс (через журнал)
+        await ledger.set_balance(session, user.id, 0, "reset_all", ref=f"admin:{update.effective_user.id}")
+
+
+        # кто пригласил этого юзера — его счётчики тоже изменятся
+        inviter_ids = (await session.execute(
+            select(Referral.inviter_id).where(Referral.invited_id == user.id)
+        )).scalars().all()
 
         # удаляем все рефералы (и как пригласивший, и как приглашённый)
         await session.execute(delete(Referral).where(
             (Referral.inviter_id == user.id) | (Referral.invited_id == user.id)
         ))
+        await recount_referrals(session, [user.id, *inviter_ids])
 
         await session.commit()
+        invalidate_user(user.id, *inviter_ids)
 
         if user_id == update.effective_user.id:
             await update.message.reply_text(
@@ -1,14 +1,11 @@
 # handlers/instruction.py
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
-import aiohttp
 
 from config import settings
 from .utils import send_or_replace_text
 from services.billing_core import calc_generations
-from db.database import get_session
-from db.models import User
-from sqlalchemy import select
+from db.repo import get_user_snapshot, UserBalance
 
 async def show_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -18,11 +15,8 @@ async def show_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pass
 
     # баланс юзера
-    async with get_session() as session:
-
-        result = await session.execute(select(User).where(User.id == q.from_user.id))
-        user = result.scalar_one_or_none()
-        balance = user.balance if user else 0
+    user = await get_user_snapshot(q.from_user.id, UserBalance)
+    balance = user.balance if user else 0
 
     price = settings.price_rub
     packs = settings.packs
@@ -67,6 +61,7 @@ async def show_instruction(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # при наличии видеоинструкции — прикрепляем видео отдельным сообщением
     video_url = getattr(settings, "instruction_video_url", "").strip()
     if video_url:
+        import aiohttp
         async with aiohttp.ClientSession() as sess:
             try:
                 async with sess.get(video_url) as resp:
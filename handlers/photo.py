@@ -13,7 +13,9 @@ from db.models import User
 from services.replicate_kling import generate_video_from_photo
 from .utils import send_or_replace_text, delete_message_safe
 from services import gsheets
-from db.repo import get_referral_stats, has_generations  # добавь импорт вверху файла
+from services import background_jobs
+from db.repo import get_referral_stats
+from db import credits
 import time
 
 
@@ -22,6 +24,7 @@ import time
 PHOTO_KEY = "photo_bytes"
 PROMPT_KEY = "prompt"
 LAST_MSG_ID = "last_message_id"
+PHOTO_FILE_ID_KEY = "last_photo_file_id"
 
 
 _delete_message_safe = delete_message_safe
@@ -67,6 +70,8 @@ async def on_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         photo_path = temp_file.name
 
     context.user_data["last_photo_path"] = photo_path
+    # file_id — на случай, если следующий апдейт попадёт в другой воркер (без этого файла)
+    context.user_data[PHOTO_FILE_ID_KEY] = update.message.photo[-1].file_id
 
     try:
         await update.message.delete()
@@ -155,7 +160,7 @@ async def on_prompt_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ))
     
 
-async def on_animate_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def on_animate_click(update: Update, context: ContextTypes.DEFAULT_TYPE, reservation: credits.Reservation):
     q = update.callback_query
     try:
         await q.answer()
@@ -171,22 +176,48 @@ async def on_animate_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ))
 
     if "last_photo_path" not in context.user_data or PROMPT_KEY not in context.user_data:
+        await credits.refund(reservation)
         await q.message.reply_text("⚠️ Сначала загрузите фото и напишите, как оживить!")
         return
 
     # быстрый ответ пользователю
-    await q.message.edit_caption(
-        "🎬 Генерация видео началась!\n"
-        "⏳ Это займёт около 30–60 секунд.\n\n"
-        "👉 Можете пока закрыть бота — я пришлю готовое видео автоматически 🙌"
-    )
+    try:
+        await q.message.edit_caption(
+            "🎬 Генерация видео началась!\n"
+            "⏳ Это займёт около 30–60 секунд.\n\n"
+            "👉 Можете пока закрыть бота — я пришлю готовое видео автоматически 🙌"
+        )
+    except Exception:
+        await credits.refund(reservation)
+        raise
 
     # 🚀 запускаем генерацию в фоне
-    asyncio.create_task(run_generation_task(update, context))
+    # через реестр — при остановке узла генерацию дождутся, а не отменят
+    background_jobs.track(run_generation_task(update, context, reservation), name=f"generation:{q.from_user.id}")
+
+
 
+async def ensure_local_photo(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    """Путь к фото на диске этого воркера; если файла нет — скачиваем заново по file_id."""
+    photo_path = context.user_data.get("last_photo_path")
+    if photo_path and os.path.isfile(photo_path):
+        return photo_path
+
+    file_id = context.user_data.get(PHOTO_FILE_ID_KEY)
+    if not file_id:
+        return photo_path
+
+    file = await context.bot.get_file(file_id)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
+        await file.download_to_drive(temp_file.name)
+        photo_path = temp_file.name
+    context.user_data["last_photo_path"] = photo_path
+    print(f"📥 Фото перекачано по file_id (другой воркер): {photo_path}")
+    return photo_path
 
 
-async def run_generation_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def run_generation_task(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              reservation: credits.Reservation | None = None):
     q = update.callback_query
     try:
         await q.answer()
@@ -195,152 +226,148 @@ async def run_generation_task(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     user_id = q.from_user.id
     prompt_text = context.user_data.get(PROMPT_KEY)
-    photo_path = context.user_data.get("last_photo_path")
+    photo_path = None
 
 
-    async with get_session() as session:
-        from sqlalchemy import select
-        result = await session.execute(select(User).where(User.id == user_id))
-        user = result.scalar_one_or_none()
-        if not user:
-            await context.bot.send_message(chat_id=update.effective_chat.id, text="❌ Пользователь не найден в базе.")
-            return  
-        
-        # 💰 Проверка баланса
-        if user.balance <= 0:
+    # 💰 Кредит резервируется короткой транзакцией (обычно уже в do_animate);
+    # соединение сразу возвращается в пул
+    if reservation is None:
+        _, reservation = await credits.reserve(user_id)
+    if reservation is None:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="⚠️ У тебя закончились генерации.\nПополните баланс 👇",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 Пополнить баланс", callback_data="balance")],
+                [InlineKeyboardButton("🔙 В меню", callback_data="back_menu")]
+            ])
+        )
+        return
+
+    balance_after = reservation.balance_after
+    start_time = time.time()
+    delivered = False
+
+    try:
+        # 📥 фото — внутри try: ошибка скачивания (сеть, протухший file_id) тоже возвращает кредит
+        photo_path = await ensure_local_photo(context)
+        if not photo_path or not os.path.isfile(photo_path):
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text="⚠️ У тебя закончились генерации.\nПополните баланс 👇",
+                text="⚠️ Фото не найдено. Загрузите его ещё раз 👇",
                 reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="balance")],
-                    [InlineKeyboardButton("🔙 В меню", callback_data="back_menu")]
+                    [InlineKeyboardButton("✨ Оживить фото", callback_data="animate")],
+                    [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")]
                 ])
             )
             return
 
-        start_time = time.time()
+        # 🎬 Генерация видео (без открытой сессии БД)
+        async for status in generate_video_from_photo(photo_path, duration=4, prompt=prompt_text):
+            if status["status"] == "processing":
+                continue
+
+            # === Fal не сработал → пробуем Replicate ===
+            if status["status"] == "failed" and "Fal.ai" in status.get("error", ""):
+                print("⚠️ Fal.ai не сработал — переключаемся на Replicate...")
+                os.environ["ENGINE"] = "replicate"
+                async for backup in generate_video_from_photo(photo_path, duration=4, prompt=prompt_text):
+                    status = backup
+                    break
+
+            # === Успешно ===
+            if status["status"] == "succeeded":
+                video_url = status["url"]
+                engine_name = os.getenv("ENGINE", "replicate").upper()
+                gen_secs = int(time.time() - start_time)
+
+                primary_row = (
+                    [InlineKeyboardButton("✨ Оживить ещё фото", callback_data="animate")]
+                    if balance_after > 0 else
+                    [InlineKeyboardButton("💳 Пополнить баланс", callback_data="balance")]
+                )
+
+                kb = InlineKeyboardMarkup([
+                    primary_row,
+                    [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")]
+                ])
 
-        try:
-            # 🎬 Генерация видео
-            async for status in generate_video_from_photo(photo_path, duration=4, prompt=prompt_text):
-                if status["status"] == "processing":
-                    continue
-
-                # === Fal не сработал → пробуем Replicate ===
-                if status["status"] == "failed" and "Fal.ai" in status.get("error", ""):
-                    print("⚠️ Fal.ai не сработал — переключаемся на Replicate...")
-                    os.environ["ENGINE"] = "replicate"
-                    async for backup in generate_video_from_photo(photo_path, duration=4, prompt=prompt_text):
-                        status = backup
-                        break
-
-                # === Успешно ===
-                if status["status"] == "succeeded":
-                    video_url = status["url"]
-                    engine_name = os.getenv("ENGINE", "replicate").upper()
-                    gen_secs = int(time.time() - start_time)
-
-                    new_balance_after = max(0, int(user.balance) - 1)
-                    primary_row = (
-                        [InlineKeyboardButton("✨ Оживить ещё фото", callback_data="animate")]
-                        if new_balance_after > 0 else
-                        [InlineKeyboardButton("💳 Пополнить баланс", callback_data="balance")]
+                msg = await context.bot.send_video(
+                    chat_id=update.effective_chat.id,
+                    video=video_url,
+                    caption=(
+                        f"✅ *Видео готово!*\n\n"
+                        f"🎬 Движок: *{engine_name}*\n"
+                        f"✨ Промпт: {prompt_text}\n"
+                        f"⏱ Время генерации: {gen_secs} сек."
+                    ),
+                    parse_mode="Markdown",
+                    reply_markup=kb
+                )
+                delivered = True
+
+                video_file_id = msg.video.file_id if msg and msg.video else ""
+
+                # 💾 Фиксируем резерв + запись генерации
+                await credits.commit(reservation, prompt_text, video_file_id)
+
+                invited_total, invited_paid = await get_referral_stats(user_id)
+                referral_bonus = invited_paid * settings.bonus_per_friend
+
+                asyncio.create_task(gsheets.log_balance_change(
+                    user_id=user_id,
+                    old_balance=balance_after + 1,
+                    delta=-1,
+                    new_balance=balance_after,
+                    reason="consume_generation",
+                    referral_bonus=referral_bonus
+                ))
+
+                asyncio.create_task(gsheets.log_generation(
+                    user_id=user_id,
+                    username=q.from_user.username or "",
+                    price_rub=float(settings.price_rub),
+                    input_type="photo",
+                    prompt=prompt_text,
+                    file_id=video_file_id
+                ))
+
+                return
+
+            elif status["status"] == "failed":
+                raw_error = status.get('error', 'Неизвестная ошибка')
+
+                if "content_policy_violation" in raw_error:
+                    error_text = (
+                        "🚫 Видео не может быть создано.\n\n"
+                        "❗️Причина: контент нарушает политику безопасности модели "
+                        "(например, политика, лица известных людей, насилие и т.д.).\n\n"
+                        "🪄 Попробуй другое фото или измени описание (prompt)."
                     )
-
-                    kb = InlineKeyboardMarkup([
-                        primary_row,
+                else:
+                    error_text = f"❌ Ошибка при генерации видео:\n{raw_error[:4000]}"
+
+                await context.bot.send_message(
+                    chat_id=update.effective_chat.id,
+                    text=error_text,
+                    parse_mode="Markdown",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🔁 Попробовать снова", callback_data="do_animate")],
                         [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")]
                     ])
-
-                    msg = await context.bot.send_video(
-                        chat_id=update.effective_chat.id,
-                        video=video_url,
-                        caption=(
-                            f"✅ *Видео готово!*\n\n"
-                            f"🎬 Движок: *{engine_name}*\n"
-                            f"✨ Промпт: {prompt_text}\n"
-                            f"⏱ Время генерации: {gen_secs} сек."
-                        ),
-                        parse_mode="Markdown",
-                        reply_markup=kb
-                    )
-
-                    video_file_id = msg.video.file_id if msg and msg.video else ""
-
-
-                    # 💾 Списание и логирование
-                    old = int(user.balance)
-                    user.balance -= 1
-                    user.total_generations = (user.total_generations or 0) + 1
-                    await session.commit()  # ✅ фиксируем изменение баланса
-
-
-                    # 💾 Запись генерации
-                    gen_entry = GenerationRaw(
-                        user_id=user.id,
-                        price_rub=float(settings.price_rub),
-                        input_type="photo",
-                        prompt=prompt_text[:1024],
-                        file_id=video_file_id,
-                    )
-                    session.add(gen_entry)
-                    await session.commit()  # ✅ фиксируем запись генерации
-
-
-
-
-                    invited_total, invited_paid = await get_referral_stats(user.id)
-                    referral_bonus = invited_paid * settings.bonus_per_friend
-
-                    asyncio.create_task(gsheets.log_balance_change(
-                        user_id=user.id,
-                        old_balance=old,
-                        delta=-1,
-                        new_balance=int(user.balance),
-                        reason="consume_generation",
-                        referral_bonus=referral_bonus
-                    ))
-
-                    asyncio.create_task(gsheets.log_generation(
-                        user_id=user.id,
-                        username=user.username or "",
-                        price_rub=float(settings.price_rub),
-                        input_type="photo",
-                        prompt=prompt_text,
-                        file_id=video_file_id
-                    ))
-
-                    return
-
-                elif status["status"] == "failed":
-                    raw_error = status.get('error', 'Неизвестная ошибка')
-
-                    if "content_policy_violation" in raw_error:
-                        error_text = (
-                            "🚫 Видео не может быть создано.\n\n"
-                            "❗️Причина: контент нарушает политику безопасности модели "
-                            "(например, политика, лица известных людей, насилие и т.д.).\n\n"
-                            "🪄 Попробуй другое фото или измени описание (prompt)."
-                        )
-                    else:
-                        error_text = f"❌ Ошибка при генерации видео:\n{raw_error[:4000]}"
-
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=error_text,
-                        parse_mode="Markdown",
-                        reply_markup=InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🔁 Попробовать снова", callback_data="do_animate")],
-                            [InlineKeyboardButton("🏠 В меню", callback_data="back_menu")]
-                        ])
-                    )
-                    return
-
-        finally:
-            if os.path.isfile(photo_path):
-                os.remove(photo_path)
-            for key in ["last_photo_path", PROMPT_KEY]:
-                context.user_data.pop(key, None)
+                )
+                return
+
+    finally:
+        if not delivered:
+            # ↩️ видео не доставлено (ошибка, исключение, отмена при остановке) — возвращаем генерацию
+            await credits.refund(reservation)
+        if photo_path and os.path.isfile(photo_path):
+            os.remove(photo_path)
+        for key in ["last_photo_path", PHOTO_FILE_ID_KEY, PROMPT_KEY]:
+            context.user_data.pop(key, None)
+        # задача фоновая — сами помечаем user_data для сохранения в persistence
+        context.application.mark_data_for_update_persistence(user_ids=user_id)
 
 # Вызываем основную генерацию при нажатии кнопки
 async def do_animate(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -350,8 +377,15 @@ async def do_animate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception:
         pass
 
-    # проверяем, есть ли генерации
-    if not await has_generations(q.from_user.id):
+    # атомарно занимаем кредит — второй клик, пока идёт генерация, получит BUSY
+    status, reservation = await credits.reserve(q.from_user.id)
+    if status == credits.BUSY:
+        await context.bot.send_message(
+            chat_id=q.message.chat_id,
+            text="⏳ Генерация уже идёт — пришлю видео, как только оно будет готово 🙌",
+        )
+        return
+    if status != credits.OK:
         await context.bot.send_message(
             chat_id=q.message.chat_id,
             text="⚠️ У тебя закончились генерации.\nПополните баланс 👇",
@@ -362,5 +396,5 @@ async def do_animate(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return   # стоп, не идём дальше
 
-    # если генерации есть → запускаем основной пайплайн
-    await on_animate_click(update, context)
+    # кредит занят → запускаем основной пайплайн
+    await on_animate_click(update, context, reservation)
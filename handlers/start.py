@@ -5,22 +5,31 @@ import time
 
 from services.performance_logger import measure_time
 from sqlalchemy import select
-from sqlalchemy import text as sql_text
-
 
 from config import settings
-from db.database import get_session
+from db.database import end_scope, get_session
 from db.models import User
 from .utils import send_or_replace_text
 from services import gsheets
+from services import webhook_reply
 
 from services.billing_core import calc_generations
-from services import billing_core
-from db.repo import get_referral_stats, has_generations
+from db.repo import has_generations, get_user_stats, invalidate_user, upsert_user, UserProfile
 
 from pathlib import Path
 FILE_ID_PATH = Path("assets/main_menu_video.id")
 
+# file_id приветственного видео держим в памяти (загружается на warm-up)
+_menu_video_id: str | None = None
+
+
+def load_menu_video_id() -> str | None:
+    """Читает file_id видео главного меню в память (один раз)."""
+    global _menu_video_id
+    if _menu_video_id is None and FILE_ID_PATH.exists():
+        _menu_video_id = FILE_ID_PATH.read_text().strip() or None
+    return _menu_video_id
+
 
 
 
@@ -39,36 +48,10 @@ def main_menu_kb(user) -> InlineKeyboardMarkup:
 
 # Проверка/создание пользователя
 @measure_time
-async def ensure_user(update: Update) -> User:
+async def ensure_user(update: Update, context: ContextTypes.DEFAULT_TYPE | None = None) -> UserProfile:
     user_tg = update.effective_user
-
-    async with get_session() as session:
-
-        result = await session.execute(select(User).where(User.id == user_tg.id))
-        user = result.scalar_one_or_none()
-
-        if not user:
-            # 🔹 Новый пользователь
-            user = User(
-                id=user_tg.id,
-                full_name=user_tg.full_name,
-                username=user_tg.username,
-                balance=0,
-                consent_accepted=False,
-            )
-            session.add(user)
-            await session.commit()
-
-
-
-        else:
-            # 🔹 Обновляем данные
-            user.full_name = user_tg.full_name
-            user.username = user_tg.username
-            await session.commit()
-
-        # ✅ всегда возвращаем billing_core-юзера
-        return billing_core.get_user(user_tg.id)
+    # один INSERT ... ON CONFLICT ... RETURNING вместо select → insert/update → commit
+    return await upsert_user(user_tg.id, user_tg.username, user_tg.full_name)
 
 
 # Ссылки на документы
@@ -88,10 +71,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         send = update.effective_chat.send_message
 
-    await send("👋 Бот запущен, проверяем связь с сервером... 🔥")
+    # результат не нужен → может уйти прямо в ответе webhook
+    with webhook_reply.allow_inline("sendMessage"):
+        await send("👋 Бот запущен, проверяем связь с сервером... 🔥")
 
-    # ⚙️ создаём или обновляем пользователя в фоне
-    asyncio.create_task(billing_core.upsert_user(tg_user.id, tg_user.username))
+    # ⚙️ создаём или обновляем пользователя — до рефералки (FK referrals → users)
+    user_db = await upsert_user(tg_user.id, tg_user.username, tg_user.full_name)
     asyncio.create_task(gsheets.log_user_event(
         user_id=tg_user.id, username=tg_user.username or "", event="start_pressed"
     ))
@@ -107,51 +92,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 referrer_id=referrer_id, new_user_id=tg_user.id, status="registered"
             ))
 
-    # --- Создаём или обновляем запись в Postgres ---
-    async with get_session() as session:
-        result = await session.execute(select(User).where(User.id == tg_user.id))
-        user_db = result.scalar_one_or_none()
-
-        if not user_db:
-            # 🔹 если юзера нет — создаём
-            user_db = User(
-                id=tg_user.id,
-                full_name=tg_user.full_name,
-                username=tg_user.username,
-                balance=0,
-                consent_accepted=False,
-            )
-            session.add(user_db)
-            print(f"🆕 Создан новый пользователь {tg_user.username or tg_user.id}")
-        else:
-            # 🔹 если есть — обновляем данные
-            user_db.full_name = tg_user.full_name
-            user_db.username = tg_user.username
-            print(f"♻️ Обновлён пользователь {tg_user.username or tg_user.id}")
-
-        await session.commit()
-
-        # 🔹 возвращаем финальный объект после сохранения
-        result = await session.execute(select(User).where(User.id == tg_user.id))
-        user_db = result.scalar_one()
-
-
-        # === AUTO UPSERT USER (создание/обновление в основной таблице) ===
-        await session.execute(sql_text("""
-            INSERT INTO users (id, username, full_name, created_at)
-            VALUES (:id, :username, :full_name, NOW())
-            ON CONFLICT (id) DO UPDATE 
-            SET username = EXCLUDED.username,
-                full_name = EXCLUDED.full_name,
-                last_active_at = NOW();
-        """), {
-            "id": tg_user.id,
-            "username": tg_user.username,
-            "full_name": tg_user.full_name
-        })
-        await session.commit()
-
-
     # === ПОСЛЕ СОХРАНЕНИЯ user_db ===
     if user_db.consent_accepted:
         # ⚡ Если согласие уже есть — сразу показываем меню
@@ -177,6 +117,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Главное меню
 @measure_time
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, user):
+    global _menu_video_id
     start_time = time.perf_counter()
     gen_price = settings.price_rub
     packs = settings.packs
@@ -184,18 +125,12 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, use
 
     # ---- реальные цифры из БД (а не из billing_core) ----
     
-    async with get_session() as session:
-
-        udb = (await session.execute(
-            select(User).where(User.id == update.effective_user.id)
-        )).scalar_one()
-
-        paid_balance = int(udb.balance)                # что реально списывается
+    # баланс и рефералка — один запрос
+    udb = await get_user_stats(update.effective_user.id)
+    paid_balance = int(udb.balance)                # что реально списывается
 
     # сколько всего начислено за рефералов (информативно, не "остаток")
-    invited_total, invited_paid = await get_referral_stats(user.id)
-
-    bonus_total = invited_paid * settings.bonus_per_friend
+    bonus_total = udb.invited_paid * settings.bonus_per_friend
 
     total_available = paid_balance + bonus_total
 
@@ -247,20 +182,20 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, use
         )],
     ])
 
+    # 🔓 данные меню уже прочитаны — commit апдейта до паузы и отправки видео
+    await end_scope()
+
     # === Быстрое приветственное видео ===
     try:
-        import aiofiles
         video_id_path = FILE_ID_PATH
         video_path = FILE_ID_PATH.with_suffix(".mp4")
 
         await asyncio.sleep(1.5)
         await update.effective_chat.send_chat_action("upload_video")
 
-        if video_id_path.exists():
-            # ⚡ используем кэшированный file_id (мгновенно)
-            async with aiofiles.open(video_id_path, "r") as f:
-                file_id = (await f.read()).strip()
-
+        file_id = load_menu_video_id()
+        if file_id:
+            # ⚡ используем file_id из памяти (мгновенно)
             await update.effective_chat.send_video(
                 video=file_id,
                 caption=text,
@@ -279,6 +214,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, use
             try:
                 fid = msg.video.file_id
                 video_id_path.write_text(fid)
+                _menu_video_id = fid
                 print(f"💾 Saved new video file_id: {fid}")
             except Exception as e:
                 print(f"⚠️ Ошибка сохранения file_id: {e}")
@@ -308,6 +244,7 @@ async def handle_consent_yes(update: Update, context: ContextTypes.DEFAULT_TYPE)
         if user and not user.consent_accepted:
             user.consent_accepted = True
             await session.commit()
+            invalidate_user(user.id)
             print(f"✅ Пользователь {user.id} принял соглашение")
 
 
@@ -367,6 +304,7 @@ async def reset_consent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = result.scalar_one()
         user.consent_accepted = False
         await session.commit()
+    invalidate_user(update.effective_user.id)
 
     
     await send_or_replace_text(update, context, "✅ Согласие сброшено. Используйте /start для повторного показа соглашения.")
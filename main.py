@@ -2,7 +2,7 @@
 import time
 start_time = time.perf_counter()
 
-import os, json, asyncio, signal, logging
+import os, json, asyncio, logging
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -36,34 +36,45 @@ else:
     print("⚠️ GCP_SA_JSON не найден в окружении.")
 
 
-from services.performance_logger import measure_time
-from config import settings
-from middlewares.safe_callbacks import SafeCallbackMiddleware
+from utils import startup_timeline
+startup_timeline.set_origin(start_time)
 
+with startup_timeline.step("config", kind="import"):
+    from services.performance_logger import measure_time
+    from config import settings
+    from middlewares.safe_callbacks import SafeCallbackMiddleware
 
-from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-)
-from db.database import init_db
-from services import gsheets
+with startup_timeline.step("telegram.ext", kind="import"):
+    from telegram.ext import (
+        Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+    )
 
-auto_loop = None
-sync_dashboard_once = None
-if os.getenv("GSHEETS_ENABLE", "0") == "1":
-    from services.auto_sync_dashboard import auto_loop, sync_dashboard_once
+with startup_timeline.step("db", kind="import"):
+    from db.database import init_db, request_scope
 
-from handlers.start import (
-    start, handle_consent_yes, ensure_user,
-    check_balance_and_animate, reset_consent, show_main_menu
-)
-from handlers.photo import on_photo, on_prompt_text, do_animate
-from handlers.balance import (
-    open_balance, check_payment, add_balance,
-    reset_balance, handle_topup, compensate,
-    get_balance, handle_balance, reset_all
-)
-from handlers.instruction import show_instruction
-from handlers.support import open_support
+with startup_timeline.step("services", kind="import"):
+    from services import gsheets
+    from services import update_ingress
+    from services import webhook_reply
+    from services import leader
+    from services import background_jobs
+    from services import activity_tracker
+
+# Dashboard (gspread) импортируется в on_startup, только если включён
+
+with startup_timeline.step("handlers", kind="import"):
+    from handlers.start import (
+        start, handle_consent_yes, ensure_user,
+        check_balance_and_animate, reset_consent, show_main_menu
+    )
+    from handlers.photo import on_photo, on_prompt_text, do_animate
+    from handlers.balance import (
+        open_balance, check_payment, add_balance,
+        reset_balance, handle_topup, compensate,
+        get_balance, handle_balance, reset_all
+    )
+    from handlers.instruction import show_instruction
+    from handlers.support import open_support
 
 
 # === 3. Отладочный вывод при старте ===
@@ -85,7 +96,16 @@ print("DEBUG PRICE:", settings.price_rub)
 
 # === 4. Построение Telegram-приложения ===
 def build_app() -> Application:
-    app = Application.builder().token(settings.telegram_bot_token).build()
+    builder = Application.builder().token(settings.telegram_bot_token)
+    if webhook_reply.ENABLED:
+        # первый вызов Bot API из хендлера может уйти прямо в ответе webhook
+        builder = builder.request(webhook_reply.InlineReplyRequest(connection_pool_size=256))
+    # Состояние диалога: в памяти процесса или в БД (несколько воркеров)
+    from db.persistence import build_persistence
+    persistence = build_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    app = builder.build()
 
     # Глобальная защита от "Query is too old"
     async def safe_callback_answer(update, context):
@@ -138,19 +158,37 @@ def build_app() -> Application:
 
     from utils.metrics import wrap_all_handlers
     wrap_all_handlers(app)
+
+    # Типы апдейтов, которые реально обрабатываются — остальные отсекаем ещё в webhook
+    update_ingress.set_allowed_kinds(allowed_updates_for(app))
     return app
 
 
+# Какие типы апдейтов Telegram слушает каждый вид хендлера.
+# Команды и сообщения обрабатываем только новые (edited_message не нужен).
+_HANDLER_UPDATE_TYPES = {
+    CommandHandler: ("message",),
+    MessageHandler: ("message",),
+    CallbackQueryHandler: ("callback_query",),
+}
 
-# === 5. Speed test ===
-async def speed_test():
-    t0 = time.time()
-    for _ in range(5):
-        await asyncio.sleep(0.1)
-    print(f"⚡️ Event loop OK — {time.time() - t0:.2f} сек")
 
+def allowed_updates_for(app: Application) -> list[str]:
+    """allowed_updates для set_webhook — по хендлерам, зарегистрированным в build_app()."""
+    kinds = set()
+    for handlers in app.handlers.values():
+        for h in handlers:
+            for handler_type, types in _HANDLER_UPDATE_TYPES.items():
+                if isinstance(h, handler_type):
+                    kinds.update(types)
+                    break
+            else:
+                print(f"⚠️ allowed_updates: неизвестный тип хендлера {type(h).__name__}")
+    return sorted(kinds)
 
-# === 6. Startup: инициализация сервисов ===
+
+
+# === 5. Startup: инициализация сервисов ===
 async def on_startup(app: Application):
     # ⚡️ Не ждём инициализацию базы — сразу запускаем в фоне
     asyncio.create_task(init_db())
@@ -163,17 +201,30 @@ async def on_startup(app: Application):
     else:
         print("⚠️ Google Sheets выключены (GSHEETS_ENABLE=0)")
 
-    # === Dashboard ===
+    # === Dashboard (только на лидере кластера) ===
     if gsheets.ENABLED:
-        asyncio.create_task(auto_loop())
+        with startup_timeline.step("services.auto_sync_dashboard", kind="import"):
+            from services.auto_sync_dashboard import auto_loop
+        leader.register("dashboard", auto_loop)
         print("✅ Dashboard включен (GSHEETS_ENABLE=1)")
     else:
         print("⚠️ Dashboard выключен (GSHEETS_ENABLE=0)")
 
+    # === Архив *_raw (только на лидере кластера) ===
+    if settings.raw_retention_months > 0:
+        from services import raw_retention
+        leader.register("raw_retention", raw_retention.auto_loop)
+        print(f"✅ Архив *_raw включен (храним {settings.raw_retention_months} мес.)")
+
+    # === last_active_at: буфер + пакетная запись ===
+    activity_tracker.start()
+
     # 🚀 Убираем задержки от debug-loop
     asyncio.get_event_loop().set_debug(False)
 
-    await speed_test()
+    # === Warm-up: пул БД, OAuth-токен, keep-alive к провайдерам, file_id видео ===
+    from services.warmup import run_warmup
+    await run_warmup()
     print("🚀 Startup complete")
 
     # === Сводка статусов при старте ===
@@ -191,45 +242,66 @@ async def on_startup(app: Application):
 
 
 
-# === 7. Корректное завершение ===
-async def shutdown_tasks():
-    print("🛑 Shutting down gracefully...")
-    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    for t in tasks:
-        t.cancel()
-    await asyncio.gather(*tasks, return_exceptions=True)
-    print("✅ All tasks cancelled")
+# === 6. Корректное завершение (drain) ===
+async def drain_and_stop():
+    """Остановка без потери оплаченной работы.
 
+    1) закрываем приём апдейтов (503 → Telegram отдаст их другому инстансу);
+    2) дообрабатываем принятые апдейты и ждём генерации — до SHUTDOWN_DRAIN_SEC;
+    3) сбрасываем буферы: last_active_at и очередь Google Sheets;
+    4) останавливаем PTB (persistence), отдаём лидерство, закрываем HTTP-сессию.
+    """
+    from services import http_client
 
-def setup_shutdown_signal():
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    else:
-        # если уже есть — просто добавляем хендлеры
-        pass
+    print("🛑 Shutdown: drain...")
+    t0 = time.monotonic()
+    deadline = t0 + settings.shutdown_drain_sec
 
-    for sig in (signal.SIGINT, signal.SIGTERM):
-        loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown_tasks()))
+    updates = await update_ingress.drain(deadline)
+    generations = await background_jobs.drain(deadline)
 
-async def auto_set_webhook(app: Application):
-    RAILWAY_URL = os.getenv("RAILWAY_STATIC_URL") or "https://photo-live.up.railway.app"
-    webhook_url = f"{RAILWAY_URL}/webhook"
+    await asyncio.sleep(0)  # строки, которые хендлеры только что поставили в очередь
+    active = await activity_tracker.stop()
 
+    try:
+        rows = await gsheets.flush_now()
+    except Exception as e:
+        rows = 0
+        print(f"⚠️ GSHEETS flush при остановке не удался: {e}")
+
+    if ptb_app is not None and ptb_app.running:
+        await ptb_app.stop()
+        await ptb_app.shutdown()
+    await leader.stop()
+    await http_client.close()
+
+    print("\n================= SHUTDOWN REPORT =================")
+    print(f"📥 Апдейты........: {updates['drained']}/{updates['pending']} дообработано, брошено {updates['abandoned']}")
+    print(f"🎬 Генерации......: {generations['drained']}/{generations['pending']} завершено, брошено {len(generations['abandoned'])}")
+    for name in generations["abandoned"]:
+        print(f"   ⚠️ не успела: {name}")
+    print(f"📊 Google Sheets..: отправлено {rows} строк")
+    print(f"👣 Активность.....: записано {active} юзеров")
+    print(f"⏱ Drain..........: {time.monotonic() - t0:.1f} сек (лимит {settings.shutdown_drain_sec:.0f} сек)")
+    print("===================================================\n")
+
+
+async def auto_set_webhook(app: Application, webhook_url: str):
+    """Ставит webhook только если он отличается. Очередь апдейтов Telegram не сбрасываем."""
+    allowed = allowed_updates_for(app)
     current = await app.bot.get_webhook_info()
-    if current.url != webhook_url:
-        await app.bot.set_webhook(url=webhook_url)
-        print(f"✅ Webhook обновлён: {webhook_url}")
+    if current.url != webhook_url or sorted(current.allowed_updates or ()) != allowed:
+        await app.bot.set_webhook(url=webhook_url, allowed_updates=allowed)
+        print(f"✅ Webhook обновлён: {webhook_url} (allowed_updates={allowed})")
     else:
-        print(f"✅ Webhook уже актуален: {webhook_url}")
+        print(f"✅ Webhook уже актуален: {webhook_url} (в очереди Telegram: {current.pending_update_count})")
 
 
 
-# === 8. Точка входа (финальная, безопасная для Railway) ===
-# === 8. Точка входа (Render PROD) ===
+# === 7. Точка входа (финальная, безопасная для Railway) ===
+# === 7. Точка входа (Render PROD) ===
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from telegram import Update as TgUpdate
 import asyncio
 
@@ -242,19 +314,30 @@ async def on_fastapi_start():
     """Запуск Telegram-приложения при старте FastAPI (Render)."""
     asyncio.create_task(start_telegram_app())
 
+@fastapi_app.on_event("shutdown")
+async def on_fastapi_shutdown():
+    """SIGTERM от Render / uvicorn: дообрабатываем работу вместо отмены всех задач."""
+    await drain_and_stop()
+
 async def start_telegram_app():
     global ptb_app
     try:
-        ptb_app = build_app()
-        ptb_app.post_init = on_startup
+        with startup_timeline.step("build_app"):
+            ptb_app = build_app()
+
+        with startup_timeline.step("ptb.initialize"):
+            await ptb_app.initialize()
+        with startup_timeline.step("ptb.start"):
+            await ptb_app.start()
 
-        await ptb_app.initialize()
-        await ptb_app.start()
+        # Бот готов обрабатывать — сразу проигрываем всё, что пришло во время старта
+        _ptb_ready.set()
+        update_ingress.start_worker(process_raw_update)
+        print("🚀 Telegram бот полностью готов к работе!")
 
-        # Ждём, пока PTB реально запустится
-        while not ptb_app.running:
-            print("⏳ Ожидаем запуск Telegram-приложения...")
-            await asyncio.sleep(2)
+        # post_init вызывается только из run_polling/run_webhook — запускаем сами
+        with startup_timeline.step("on_startup"):
+            await on_startup(ptb_app)
 
         # === Настройка Webhook ===
         public_url = (
@@ -262,46 +345,84 @@ async def start_telegram_app():
             or os.getenv("BASE_PUBLIC_URL")
             or "https://photo-live.onrender.com"
         )
-        webhook_url = f"{public_url}/webhook"
+        leader.register("set_webhook", lambda: auto_set_webhook(ptb_app, f"{public_url}/webhook"))
 
-        try:
-            await ptb_app.bot.delete_webhook(drop_pending_updates=True)
-        except Exception as e:
-            print("⚠️ delete_webhook error:", e)
-
-        await ptb_app.bot.set_webhook(url=webhook_url)
-        print(f"✅ Webhook установлен: {webhook_url}")
+        # Регистрация webhook и периодические задачи — один раз на кластер
+        with startup_timeline.step("leader.start"):
+            await leader.start()
 
-        _ptb_ready.set()
-        print("🚀 Telegram бот полностью готов к работе!")
+        startup_timeline.emit()
 
     except Exception as e:
         print(f"❌ Ошибка при запуске Telegram-приложения: {e}")
 
-@fastapi_app.post("/webhook")
-async def webhook_handler(req: Request):
-    """Обработка апдейтов от Telegram."""
-    data = await req.json()
-    print("📩 Webhook hit:", data.get("message", {}).get("text"))
+async def process_raw_update(data: dict) -> None:
+    """Разбор и обработка одного апдейта из очереди ingress."""
+    update = TgUpdate.de_json(data, ptb_app.bot)
+    # одна сессия БД (одно соединение из пула, одна транзакция) на весь апдейт
+    async with request_scope():
+        with webhook_reply.bound(data.get("update_id")):
+            await ptb_app.process_update(update)
 
-    if not _ptb_ready.is_set():
-        await asyncio.sleep(1)
 
-    if ptb_app and ptb_app.bot:
-        update = TgUpdate.de_json(data, ptb_app.bot)
-        await ptb_app.update_queue.put(update)
-    else:
-        print("⚠️ ptb_app not ready yet")
+@fastapi_app.post("/webhook")
+async def webhook_handler(req: Request):
+    """Приём апдейтов от Telegram: кладём в очередь и сразу отвечаем."""
+    try:
+        data = update_ingress.decode(await req.body())
+    except ValueError:
+        print("⚠️ Webhook: невалидный JSON или не объект — пропускаем")
+        return {"ok": True}
+
+    update_id = data.get("update_id")
+    slot = webhook_reply.open_slot(update_id) if webhook_reply.ENABLED and update_id is not None else None
+
+    status = update_ingress.offer(data)
+    if status == update_ingress.REJECTED:
+        webhook_reply.discard(update_id)
+        # очередь переполнена → 503, Telegram доставит апдейт повторно
+        return JSONResponse({"ok": False, "error": "overloaded"}, status_code=503)
+
+    if slot is not None:
+        if status != update_ingress.QUEUED:
+            webhook_reply.discard(update_id)
+        elif payload := await webhook_reply.wait(update_id, slot):
+            # метод Bot API в теле ответа — Telegram выполнит его сам
+            return JSONResponse(payload)
 
     return {"ok": True}
 
+@fastapi_app.get("/metrics")
+async def metrics():
+    """Очередь апдейтов и счётчики отброшенных."""
+    from db.repo import user_cache_snapshot
+    from db import migrations
+    from services import raw_retention
+
+    return {
+        "ingress": update_ingress.snapshot(),
+        "webhook_reply": dict(webhook_reply.stats, enabled=webhook_reply.ENABLED),
+        "leader": leader.snapshot(),
+        "activity": activity_tracker.snapshot(),
+        "user_cache": user_cache_snapshot(),
+        "background_jobs": {"running": background_jobs.running(), **background_jobs.stats},
+        "persistence": getattr(ptb_app and ptb_app.persistence, "stats", None),
+        "startup": startup_timeline.snapshot(),
+        "schema": migrations.snapshot(),
+        "raw_retention": raw_retention.snapshot() if settings.raw_retention_months > 0 else None,
+    }
+
 @fastapi_app.get("/")
 async def root():
-    """Проверка статуса на Render."""
+    """Проверка статуса на Render. Схема БД отстаёт / init упал — 503."""
+    from db import migrations
+
+    if not migrations.healthy():
+        return JSONResponse({"status": "error", "schema": migrations.snapshot()}, status_code=503)
     return {"status": "ok", "message": "Bot is running on Render 🚀"}
 
 
-# === 9. Точка входа для Render (запуск FastAPI сервера) ===
+# === 8. Точка входа для Render (запуск FastAPI сервера) ===
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8080))
@@ -0,0 +1,45 @@
+# scripts/archive_raw.py
+# =========================================================
+# РАЗОВЫЙ АРХИВ *_raw (то же, что задача лидера services/raw_retention.py)
+#
+# 🧩 Что делает:
+#   - показывает, сколько строк в каждой *_raw старше границы;
+#   - выгружает их помесячно в RAW_ARCHIVE_DIR/<table>/<YYYY-MM>.jsonl.gz
+#     и удаляет из базы (сначала файл, потом DELETE).
+#
+# 🚀 Как запускать:
+#        python scripts/archive_raw.py --dry-run            # только посчитать
+#        python scripts/archive_raw.py --months 6           # оставить 6 полных месяцев + текущий
+#    Без --months берётся RAW_RETENTION_MONTHS (0 — скрипт ничего не делает).
+# =========================================================
+
+import sys
+import os
+import asyncio
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from db.database import get_engine, init_db
+from services import raw_retention
+
+
+async def main(months: int, dry_run: bool):
+    if months <= 0:
+        print("⚠️ Не задано, сколько месяцев хранить: --months N или RAW_RETENTION_MONTHS")
+        return
+    await init_db(migrate=True)
+    before = raw_retention.cutoff(months)
+    print(f"🗄 Граница: {before:%Y-%m-%d} (всё раньше — в архив {raw_retention.ARCHIVE_DIR})")
+    for table, count in (await raw_retention.pending(before)).items():
+        print(f"   {table:<20} {count}")
+
+    if not dry_run:
+        done = await raw_retention.run_once(before)
+        print(f"✅ Архивировано месяцев: {len(done)}, строк: {sum(done.values())}")
+    await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    months = int(args[args.index("--months") + 1]) if "--months" in args else raw_retention.MONTHS
+    asyncio.run(main(months, dry_run="--dry-run" in args))
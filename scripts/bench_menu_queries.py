@@ -0,0 +1,139 @@
+# scripts/bench_menu_queries.py
+# =========================================================
+# БЕНЧМАРК: БАЛАНС + РЕФЕРАЛКА ДЛЯ МЕНЮ / ПОПОЛНЕНИЯ / /balance
+#
+# ⚡ Что сравнивает (round trips к БД и мс на вызов):
+#   - old: select(User) + get_referral_stats (2 × COUNT, своя сессия)
+#          + отдельный запрос username пригласившего (как было в /balance)
+#   - new: db.repo.get_user_stats — один агрегирующий SQL-запрос; отдельно
+#          холодный вызов (кэш снимков сброшен) и тёплый (из кэша)
+#   Рефералы заводятся через add_referral / mark_referral_paid; оба пути
+#   обязаны вернуть одинаковые (ненулевые) счётчики.
+#
+# 🚀 Как запускать:
+#        python scripts/bench_menu_queries.py                 # временная SQLite
+#        DATABASE_URL=postgresql+asyncpg://... python scripts/bench_menu_queries.py
+#   На Postgres пишет в таблицы — только тестовая база!
+# =========================================================
+
+import sys
+import os
+import asyncio
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+_db_file = None
+if not os.getenv("DATABASE_URL"):
+    _db_file = os.path.join(tempfile.mkdtemp(), "bench_menu.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_file}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+
+from sqlalchemy import event, func, select, delete
+
+from db.database import get_engine, get_session, init_db
+from db.models import User, Referral
+from db import repo
+from db.repo import add_referral, get_referral_stats, get_user_stats, mark_referral_paid
+
+ROUNDS = 300
+INVITER_ID = 9_000_000
+USER_ID = INVITER_ID + 1
+FRIENDS = 50
+
+
+async def seed():
+    """Рефералы — через db.repo (add_referral / mark_referral_paid), как в боте:
+    счётчики users.invited_total / invited_paid заполняет тот же код."""
+    await init_db(migrate=True)
+    async with get_session() as session:
+        ids = [INVITER_ID, USER_ID] + [USER_ID + 1 + i for i in range(FRIENDS)]
+        await session.execute(delete(Referral).where(Referral.invited_id.in_(ids)))
+        await session.execute(delete(User).where(User.id.in_(ids)))
+        session.add(User(id=INVITER_ID, username="inviter", balance=0))
+        session.add(User(id=USER_ID, username="tester", balance=5))
+        for i in range(FRIENDS):
+            session.add(User(id=USER_ID + 1 + i, username=f"friend{i}", balance=0))
+        await session.commit()
+
+    await add_referral(INVITER_ID, USER_ID)
+    for i in range(FRIENDS):
+        await add_referral(USER_ID, USER_ID + 1 + i)
+    async with get_session() as session:
+        for i in range(0, FRIENDS, 3):
+            await mark_referral_paid(session, USER_ID + 1 + i)
+        await session.commit()
+
+    # счётчики должны совпадать с самими строками referrals
+    async with get_session() as session:
+        total = await session.scalar(select(func.count()).where(Referral.inviter_id == USER_ID))
+        paid = await session.scalar(select(func.count()).where(
+            Referral.inviter_id == USER_ID, Referral.bonus_awarded.is_(True)
+        ))
+    assert total == FRIENDS and paid == len(range(0, FRIENDS, 3)), f"referrals: {total}/{paid}"
+    return total, paid
+
+
+async def old_way():
+    async with get_session() as session:
+        user = (await session.execute(select(User).where(User.id == USER_ID))).scalar_one()
+        invited_total, invited_paid = await get_referral_stats(USER_ID)
+        referrer = (await session.execute(
+            select(User.username)
+            .join_from(User, Referral, Referral.inviter_id == User.id)
+            .where(Referral.invited_id == USER_ID)
+        )).scalar_one_or_none()
+    return int(user.balance), invited_total, invited_paid, referrer
+
+
+async def new_way():
+    s = await get_user_stats(USER_ID)
+    return int(s.balance), s.invited_total, s.invited_paid, s.referrer_username
+
+
+async def measure(fn, queries: list, cold: bool = True) -> tuple[float, float, tuple]:
+    """cold — кэш снимков (db.repo._user_cache) сбрасывается перед каждым вызовом,
+    иначе new отдаётся из памяти и round trips = 0."""
+    result = await fn()  # прогрев
+    queries.clear()
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS):
+        if cold:
+            repo._user_cache.clear()
+        await fn()
+    ms = (time.perf_counter() - t0) / ROUNDS * 1000
+    return len(queries) / ROUNDS, ms, result
+
+
+async def main():
+    expected_total, expected_paid = await seed()
+    queries: list[str] = []
+    event.listen(
+        get_engine().sync_engine, "before_cursor_execute",
+        lambda conn, cursor, statement, *args: queries.append(statement),
+    )
+
+    q_old, ms_old, r_old = await measure(old_way, queries)
+    q_new, ms_new, r_new = await measure(new_way, queries)
+    q_warm, ms_warm, _ = await measure(new_way, queries, cold=False)
+    assert r_old == r_new, f"результаты расходятся: {r_old} != {r_new}"
+    assert r_new[1:3] == (expected_total, expected_paid), (
+        f"счётчики рефералки {r_new[1:3]}, ожидали {(expected_total, expected_paid)}"
+    )
+
+    print(f"\n🚀 Menu stats benchmark — {ROUNDS} раундов, {get_engine().dialect.name}")
+    print(f"{'':<6} {'round trips':>12} {'мс/вызов':>10}")
+    print(f"{'old':<6} {q_old:>12.0f} {ms_old:>10.2f}")
+    print(f"{'new':<6} {q_new:>12.0f} {ms_new:>10.2f}   (кэш пуст)")
+    print(f"{'new':<6} {q_warm:>12.0f} {ms_warm:>10.2f}   (из кэша, USER_CACHE_TTL_SEC)")
+    print(f"✅ Результаты совпадают: balance={r_new[0]} invited={r_new[1]} paid={r_new[2]} referrer={r_new[3]}")
+
+    if _db_file:
+        os.remove(_db_file)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,205 @@
+# scripts/bench_sync_users.py
+# =========================================================
+# БЕНЧМАРК: sync_users_from_raw на синтетике (по умолчанию 100k пользователей)
+#
+# ⚡ Что сравнивает:
+#   - old: прежний цикл — 7 запросов + UPDATE/INSERT на каждого пользователя
+#          (копия ниже; на всех юзерах слишком долго — меряем на выборке
+#          и экстраполируем);
+#   - new: services.sync_users_from_raw.sync_users — пачки set-based операторов.
+#   Сверяет результат: на выборке old и new дают одинаковые строки users,
+#   а снимок баланса совпадает с журналом (db/ledger.find_drift).
+#
+# 🚀 Как запускать:
+#        python scripts/bench_sync_users.py                          # временная SQLite, 100k
+#        python scripts/bench_sync_users.py --users 20000 --sample 1000
+#        DATABASE_URL=postgresql+asyncpg://.../scratch python scripts/bench_sync_users.py
+#   На Postgres пишет в таблицы — только пустая тестовая база!
+# =========================================================
+
+import sys
+import os
+import asyncio
+import datetime as dt
+import random
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+_db_file = None
+if not os.getenv("DATABASE_URL"):
+    _db_file = os.path.join(tempfile.mkdtemp(), "bench_sync.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_file}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+os.environ["GSHEETS_ENABLE"] = "0"
+
+from sqlalchemy import event, insert, select, text
+
+from db.database import get_engine, get_session, init_db
+from db.models import BalanceEntry, GenerationRaw, PaymentRaw, ReferralRaw, ReferralSummary, User
+from db import ledger
+from services.sync_users_from_raw import raw_user_ids, sync_users
+
+BASE_ID = 10_000_000
+COMPARED = ("balance", "generations_balance", "total_spent", "total_generations",
+            "last_payment_at", "last_active_at", "referrals_count")
+
+queries = 0
+
+
+def _count(*_):
+    global queries
+    queries += 1
+
+
+# === Синтетика ===
+async def seed(users: int):
+    await init_db(migrate=True)
+    rnd = random.Random(42)
+    now = dt.datetime.now(dt.timezone.utc)
+    ids = [BASE_ID + i for i in range(users)]
+
+    def ts():
+        return now - dt.timedelta(seconds=rnd.randrange(90 * 86400), microseconds=rnd.randrange(1, 10**6))
+
+    async with get_engine().begin() as conn:
+        # треть пользователей уже есть в users (ветка UPDATE), у части — баланс
+        await conn.execute(insert(User), [
+            {"id": uid, "balance": uid % 4, "last_payment_at": None} for uid in ids[::3]
+        ])
+        await conn.execute(insert(BalanceEntry), [
+            {"user_id": uid, "delta": uid % 4, "balance_after": uid % 4, "reason": "opening_balance"}
+            for uid in ids[::3] if uid % 4
+        ])
+        await conn.execute(insert(GenerationRaw), [
+            {"user_id": uid, "price_rub": 100, "ts": ts()} for uid in ids for _ in range(rnd.randrange(0, 4))
+        ])
+        await conn.execute(insert(PaymentRaw), [
+            {"user_id": uid, "amount_rub": rnd.choice([99.5, 100, 490.9]), "ts": ts()}
+            for uid in ids if uid % 2 for _ in range(rnd.randrange(1, 3))
+        ])
+        await conn.execute(insert(ReferralRaw), [
+            {"referrer_id": uid, "new_user_id": uid + 1, "status": "registered", "ts": ts()}
+            for uid in ids[::5] if uid + 1 < BASE_ID + users
+        ])
+        await conn.execute(insert(ReferralSummary), [
+            {"user_id": uid, "invited_total": 1, "invited_paid": 0, "bonus_total": rnd.randrange(0, 3), "ts": ts()}
+            for uid in ids[::5]
+        ])
+    print(f"🌱 Синтетика: {users} пользователей")
+
+
+async def users_rows(ids: list[int]) -> dict[int, tuple]:
+    async with get_engine().connect() as conn:
+        rows = await conn.execute(select(User.id, *[getattr(User, c) for c in COMPARED]).where(User.id.in_(ids)))
+        return {r[0]: tuple(_norm(v) for v in r[1:]) for r in rows}
+
+
+def _norm(v):
+    # last_*_at: строка ISO — сравниваем как момент времени, а не как формат
+    if isinstance(v, str):
+        parsed = dt.datetime.fromisoformat(v)
+        return parsed.replace(tzinfo=parsed.tzinfo or dt.timezone.utc)
+    return v
+
+
+# === Прежняя реализация (как было до set-based; NOW() → CURRENT_TIMESTAMP для SQLite) ===
+async def legacy_sync(conn, user_ids: list[int]):
+    for uid in user_ids:
+        check = await conn.execute(text("SELECT id FROM users WHERE id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        exists = check.first()
+        pay_sum = await conn.scalar(text("SELECT COALESCE(SUM(amount_rub), 0) FROM payments_raw WHERE user_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        gens = await conn.scalar(text("SELECT COUNT(*) FROM generations_raw WHERE user_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        ref_count = await conn.scalar(text("SELECT COUNT(*) FROM referrals_raw WHERE referrer_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        bonus = await conn.scalar(text("SELECT COALESCE(SUM(bonus_total), 0) FROM referrals_summary WHERE user_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        balance = max(0, (bonus or 0))
+        last_pay = await conn.scalar(text("SELECT MAX(ts) FROM payments_raw WHERE user_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        last_gen = await conn.scalar(text("SELECT MAX(ts) FROM generations_raw WHERE user_id = CAST(:uid AS BIGINT)"), {"uid": uid})
+        last_active = last_gen or last_pay
+
+        def to_str(v):
+            if v is None or isinstance(v, str):
+                return v
+            return v.isoformat()
+
+        params = {
+            "spent": int(pay_sum or 0), "gens": int(gens or 0), "balance": int(balance), "refs": int(ref_count or 0),
+            "bonus": int(bonus or 0), "last_pay": to_str(last_pay), "last_active": to_str(last_active), "uid": uid,
+        }
+        if exists:
+            await conn.execute(text("""
+                UPDATE users
+                SET total_spent = :spent, total_generations = :gens, balance = :balance,
+                    referrals_count = :refs, generations_balance = :bonus,
+                    last_payment_at = COALESCE(:last_pay, last_payment_at),
+                    last_active_at = COALESCE(:last_active, last_active_at)
+                WHERE id = CAST(:uid AS BIGINT)
+            """), params)
+        else:
+            await conn.execute(text("""
+                INSERT INTO users (id, balance, generations_balance, total_spent, total_generations,
+                    last_payment_at, last_active_at, free_trial_used, referrals_count, consent_accepted, created_at)
+                VALUES (CAST(:uid AS BIGINT), :balance, :bonus, :spent, :gens,
+                    :last_pay, :last_active, FALSE, :refs, TRUE, CURRENT_TIMESTAMP)
+            """), params)
+
+
+# === Прогон ===
+async def main(users: int, sample_size: int):
+    global queries
+    await seed(users)
+    event.listen(get_engine().sync_engine, "before_cursor_execute", _count)
+
+    # --- old: выборка, откат — база остаётся исходной для new ---
+    rnd = random.Random(7)
+    async with get_engine().connect() as conn:
+        raw_ids = await raw_user_ids(conn)
+    sample = sorted(rnd.sample(raw_ids, min(sample_size, len(raw_ids))))
+    queries = 0
+    t0 = time.perf_counter()
+    async with get_engine().connect() as conn:
+        trans = await conn.begin()
+        await legacy_sync(conn, sample)
+        old_sec = time.perf_counter() - t0
+        old_queries = queries
+        rows = await conn.execute(select(User.id, *[getattr(User, c) for c in COMPARED]).where(User.id.in_(sample)))
+        expected = {r[0]: tuple(_norm(v) for v in r[1:]) for r in rows}
+        await trans.rollback()
+
+    # --- new: все пользователи ---
+    queries = 0
+    t0 = time.perf_counter()
+    stats = await sync_users()
+    new_sec = time.perf_counter() - t0
+    new_queries = queries
+
+    actual = await users_rows(sample)
+    mismatched = [uid for uid in sample if expected.get(uid) != actual.get(uid)]
+    async with get_session() as session:
+        drift = await ledger.find_drift(session)
+
+    per_user = old_sec / len(sample)
+    print(f"\n{'':<6}{'юзеров':>10}{'запросов':>12}{'сек':>10}")
+    print(f"{'old':<6}{len(sample):>10}{old_queries:>12}{old_sec:>10.2f}   (выборка)")
+    print(f"{'old*':<6}{stats['users']:>10}{old_queries // len(sample) * stats['users']:>12}"
+          f"{per_user * stats['users']:>10.1f}   (экстраполяция)")
+    print(f"{'new':<6}{stats['users']:>10}{new_queries:>12}{new_sec:>10.2f}")
+    print(f"\n🧮 Сверка old/new на выборке: {'✅ совпадает' if not mismatched else f'❌ {len(mismatched)} расхождений'}")
+    for uid in mismatched[:5]:
+        print(f"   {uid}: old {expected.get(uid)}\n   {'':<{len(str(uid))}}  new {actual.get(uid)}")
+    print(f"📒 Снимок ≠ журнал: {'✅ 0' if not drift else f'❌ {len(drift)}'}")
+
+    await get_engine().dispose()
+    if _db_file:
+        os.remove(_db_file)
+    sys.exit(1 if mismatched or drift else 0)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    users = int(args[args.index("--users") + 1]) if "--users" in args else 100_000
+    sample = int(args[args.index("--sample") + 1]) if "--sample" in args else 2000
+    asyncio.run(main(users, sample))
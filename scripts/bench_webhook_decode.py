@@ -0,0 +1,85 @@
+# scripts/bench_webhook_decode.py
+# =========================================================
+# БЕНЧМАРК РАЗБОРА WEBHOOK-АПДЕЙТОВ
+#
+# ⚡ Что меряет (мкс на апдейт):
+#   - old:  json.loads + Update.de_json для любого апдейта (как было)
+#   - new:  update_ingress.decode + отсев по типу + de_json только для
+#           обрабатываемых типов (как сейчас)
+#
+# 🚀 Как запускать:
+#        python scripts/bench_webhook_decode.py
+# =========================================================
+
+import sys
+import os
+import json
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+# минимальный конфиг, чтобы импортировать модули бота без .env
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+
+from telegram import Bot, Update
+from services import update_ingress
+
+ROUNDS = 20000
+
+_user = {"id": 2101512357, "is_bot": False, "first_name": "Test", "username": "tester", "language_code": "ru"}
+_chat = {"id": 2101512357, "type": "private", "first_name": "Test", "username": "tester"}
+_message = {"message_id": 10, "from": _user, "chat": _chat, "date": 1700000000, "text": "улыбается и машет рукой"}
+
+SAMPLES = {
+    "message": {"update_id": 1, "message": _message},
+    "callback_query": {
+        "update_id": 2,
+        "callback_query": {
+            "id": "42", "from": _user, "chat_instance": "1",
+            "data": "balance", "message": {**_message, "text": "меню"},
+        },
+    },
+    "edited_message": {"update_id": 3, "edited_message": {**_message, "edit_date": 1700000100}},
+    "my_chat_member": {
+        "update_id": 4,
+        "my_chat_member": {
+            "chat": _chat, "from": _user, "date": 1700000000,
+            "old_chat_member": {"user": _user, "status": "member"},
+            "new_chat_member": {"user": _user, "status": "kicked", "until_date": 0},
+        },
+    },
+}
+
+
+def bench(fn, body: bytes) -> float:
+    t0 = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn(body)
+    return (time.perf_counter() - t0) / ROUNDS * 1e6
+
+
+def main():
+    bot = Bot("123456:bench")
+    update_ingress.set_allowed_kinds(["message", "callback_query"])
+
+    def old(body: bytes):
+        Update.de_json(json.loads(body), bot)
+
+    def new(body: bytes):
+        data = update_ingress.decode(body)
+        if update_ingress.is_handled(data):
+            Update.de_json(data, bot)
+
+    decoder = "orjson" if update_ingress.orjson is not None else "json (orjson не установлен)"
+    print(f"🚀 Decode benchmark — {ROUNDS} раундов, декодер: {decoder}\n")
+    print(f"{'update type':<16} {'old, мкс':>10} {'new, мкс':>10} {'x':>6}")
+    for kind, payload in SAMPLES.items():
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        t_old, t_new = bench(old, body), bench(new, body)
+        print(f"{kind:<16} {t_old:>10.1f} {t_new:>10.1f} {t_old / t_new:>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# scripts/check_query_counts.py
+# =========================================================
+# ПРОВЕРКА ЧИСЛА SQL-ЗАПРОСОВ НА ЭКРАН
+#
+# 🧩 Что делает:
+#   - поднимает временную SQLite-базу с пользователем, у которого есть
+#     платежи и рефералы (чтобы лишние подгрузки истории были видны);
+#   - вызывает хендлеры экранов с фейковыми update/context;
+#   - считает SQL-запросы и сравнивает с бюджетом BUDGETS.
+#
+# 🚀 Как запускать (код выхода 1, если бюджет превышен):
+#        python scripts/check_query_counts.py
+# =========================================================
+
+import sys
+import os
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+_db_file = os.path.join(tempfile.mkdtemp(), "query_counts.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_file}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:check")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+os.environ["GSHEETS_ENABLE"] = "0"
+
+from sqlalchemy import event
+
+from db.database import get_engine, get_session, init_db
+from db.models import User, Referral, Payment
+from db import repo
+from db.repo import has_generations
+from handlers import photo
+from handlers.start import handle_consent_yes, show_main_menu, start
+from handlers.balance import open_balance, cmd_balance
+from handlers.instruction import show_instruction
+
+USER_ID = 1001
+
+# Сколько SQL-запросов допускается на экран
+BUDGETS = {
+    "show_main_menu": 1,
+    "open_balance": 1,
+    "show_instruction": 1,
+    "has_generations": 1,
+    "cmd_balance": 1,
+    "handle_consent_yes": 3,   # select + UPDATE consent + меню
+    "start": 2,                # upsert_user ... RETURNING + меню
+    # reserve (зависшие + резерв + UPDATE баланса + журнал) + commit (резерв + users + generations_raw)
+    # + рефералка для лога
+    "run_generation_task": 8,
+}
+
+
+class Stub:
+    """Заглушка объектов Telegram: любой атрибут/вызов/await возвращает заглушку."""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+    def __getattr__(self, name):
+        return Stub()
+
+    def __call__(self, *args, **kwargs):
+        return Stub()
+
+    def __await__(self):
+        if False:
+            yield
+        return self
+
+
+def fake_update(command: bool = False):
+    user = SimpleNamespace(id=USER_ID, first_name="Test", username="tester", full_name="Test User")
+    return SimpleNamespace(
+        effective_user=user,
+        effective_chat=Stub(id=USER_ID),
+        callback_query=None if command else Stub(from_user=user, message=Stub(chat_id=USER_ID, video=None, photo=None)),
+        message=Stub(chat_id=USER_ID) if command else None,
+    )
+
+
+def fake_context():
+    return SimpleNamespace(bot=Stub(send_video=_send_video), user_data={}, args=[], application=Stub())
+
+
+def generation_context():
+    # фото на диске воркера — генерация удалит его сама
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as f:
+        f.write(b"jpg")
+    context = fake_context()
+    context.user_data.update({"last_photo_path": f.name, photo.PROMPT_KEY: "smile"})
+    return context
+
+
+async def _send_video(**kwargs):
+    return SimpleNamespace(video=SimpleNamespace(file_id="video-file-id"))
+
+
+async def _fake_generate(photo_path, duration=4, prompt=None):
+    # провайдер видео — не БД: сразу готово
+    yield {"status": "succeeded", "url": "https://example.com/video.mp4"}
+
+
+async def seed():
+    await init_db()
+    async with get_session() as session:
+        session.add(User(id=USER_ID, username="tester", full_name="Test User", balance=3))
+        session.add(User(id=USER_ID + 1, username="friend", balance=0))
+        session.add(User(id=USER_ID + 2, username="friend2", balance=0))
+        await session.flush()
+        session.add(Referral(inviter_id=USER_ID, invited_id=USER_ID + 1, bonus_awarded=True))
+        session.add(Referral(inviter_id=USER_ID, invited_id=USER_ID + 2, bonus_awarded=False))
+        for i in range(5):
+            session.add(Payment(user_id=USER_ID, amount=100, provider_payment_id=f"p{i}", status="CONFIRMED"))
+        await session.commit()
+
+
+async def main():
+    await seed()
+    photo.generate_video_from_photo = _fake_generate
+
+    queries: list[str] = []
+    event.listen(
+        get_engine().sync_engine, "before_cursor_execute",
+        lambda conn, cursor, statement, *args: queries.append(statement),
+    )
+
+    screens = {
+        "show_main_menu": lambda: show_main_menu(fake_update(), fake_context(), fake_update().effective_user),
+        "open_balance": lambda: open_balance(fake_update(), fake_context()),
+        "show_instruction": lambda: show_instruction(fake_update(), fake_context()),
+        "has_generations": lambda: has_generations(USER_ID),
+        "cmd_balance": lambda: cmd_balance(fake_update(command=True), fake_context()),
+        # согласие ещё не дано (seed) → после него /start — сразу меню
+        "handle_consent_yes": lambda: handle_consent_yes(fake_update(), fake_context()),
+        "start": lambda: start(fake_update(command=True), fake_context()),
+        "run_generation_task": lambda: photo.run_generation_task(fake_update(), generation_context()),
+    }
+
+    failed = False
+    print(f"\n{'screen':<20} {'queries':>8} {'budget':>8}")
+    for name, call in screens.items():
+        queries.clear()
+        repo._user_cache.clear()  # меряем холодный путь, без кэша снимков
+        await call()
+        count, budget = len(queries), BUDGETS[name]
+        mark = "✅" if count <= budget else "❌"
+        failed |= count > budget
+        print(f"{name:<20} {count:>8} {budget:>8}  {mark}")
+        if count > budget:
+            for q in queries:
+                print("     ·", " ".join(q.split())[:120])
+
+    os.remove(_db_file)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
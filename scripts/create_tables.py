@@ -4,7 +4,7 @@ from db.database import init_db
 
 async def main():
     print("▶️ Создаём таблицы в базе...")
-    await init_db()
+    await init_db(migrate=True)
     print("✅ Таблицы успешно созданы!")
 
 if __name__ == "__main__":
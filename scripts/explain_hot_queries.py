@@ -0,0 +1,279 @@
+# scripts/explain_hot_queries.py
+# =========================================================
+# EXPLAIN ДЛЯ ГОРЯЧИХ ЗАПРОСОВ
+#
+# 🧩 Что делает:
+#   - поднимает базу через миграции (init_db → db/migrations.py) и заполняет её
+#     данными (пользователи, платежи, рефералы, *_raw, журнал баланса);
+#   - вызывает сам код из HOT_CALLS (db/repo, db/credits, db/ledger,
+#     db/persistence, activity_tracker, sync-скрипты, архив *_raw) и
+#     перехватывает каждый выполненный SQL (before_cursor_execute) — SQL не
+#     копируется руками и не расходится с кодом;
+#   - для каждого перехваченного оператора снимает план и падает (код выхода 1),
+#     если в плане полный проход по таблице, которого не ждали
+#     (SQLite: «SCAN <table>», Postgres: «Seq Scan on <table>»).
+#
+# 🚀 Как запускать:
+#        python scripts/explain_hot_queries.py               # временная SQLite
+#        EXPLAIN_DATABASE_URL=postgresql+asyncpg://.../scratch python scripts/explain_hot_queries.py
+#    ⚠️ Postgres — только пустая тестовая база: скрипт пишет в неё данные.
+#    На Postgres выполняется SET enable_seqscan = off: на маленьких таблицах
+#    планировщик и так выбрал бы seq scan, а проверяем мы наличие индекса.
+# =========================================================
+
+import sys
+import os
+import re
+import asyncio
+import shutil
+import tempfile
+import datetime as dt
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+_pg_url = os.getenv("EXPLAIN_DATABASE_URL", "")
+_db_file = None
+if _pg_url:
+    os.environ["DATABASE_URL"] = _pg_url
+else:
+    _db_file = os.path.join(tempfile.mkdtemp(), "explain.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_file}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:check")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+os.environ["GSHEETS_ENABLE"] = "0"
+
+from sqlalchemy import delete, event, insert, or_, select, text
+
+from db.database import Base, get_engine, get_session, init_db
+from db.models import (
+    User, Referral, Payment, PaymentRaw, ResultRaw, GenerationRaw, BalanceRaw,
+    ReferralRaw, ReferralSummary, BalanceEntry, CreditReservation, BotState,
+)
+from db import credits, ledger, repo
+from db.persistence import DbPersistence
+from services import activity_tracker, raw_retention
+from services.sync_dashboard_to_db import apply_batch
+from services.sync_users_from_raw import BATCH as SYNC_BATCH, raw_user_ids, sync_batch
+
+USERS = 2000
+ROWS_PER_USER = 3
+UID = 1234
+SINCE = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=7))
+
+raw_retention.ARCHIVE_DIR = tempfile.mkdtemp()
+
+
+# === Обёртки: вызов кода так, как его вызывают хендлеры / задачи ===
+async def _in_session(fn, *args):
+    async with get_session() as session:
+        result = await fn(session, *args)
+        await session.commit()
+    return result
+
+
+async def _in_tx(fn, *args):
+    async with get_engine().begin() as conn:
+        return await fn(conn, *args)
+
+
+async def _rolled_back(stmt):
+    async with get_engine().connect() as conn:
+        await conn.execute(stmt)
+        await conn.rollback()
+
+
+async def _reserve_commit():
+    status, reservation = await credits.reserve(UID)
+    assert status == credits.OK, status
+    await credits.commit(reservation, "explain", "file")
+
+
+async def _reserve_refund():
+    status, reservation = await credits.reserve(UID)
+    assert status == credits.OK, status
+    await credits.refund(reservation)
+
+
+async def _activity_flush():
+    for uid in (1, 2, 3):
+        activity_tracker.touch(uid)
+    await activity_tracker.flush()
+
+
+async def _bot_state_refresh():
+    await DbPersistence().refresh_user_data(UID, {})
+
+
+async def _bot_state_write():
+    persistence = DbPersistence()
+    await persistence.refresh_user_data(UID, {})
+    await persistence.update_user_data(UID, {"step": "explain"})      # UPDATE ... WHERE version = :known
+    await persistence.update_user_data(USERS * 3, {"step": "explain"})  # новая строка: INSERT ... ON CONFLICT
+
+
+def _dashboard_row(uid: int) -> dict:
+    return {"total_generations": 3, "total_spent": 300, "balance": uid % 7, "referrals_count": 1}
+
+
+# (имя, вызов кода, таблицы, по которым полный проход ожидаем)
+# Кэш снимков сбрасывается перед каждым вызовом — иначе запроса не будет.
+HOT_CALLS = [
+    # --- пользователь / меню (db/repo) ---
+    ("user_snapshot", lambda: repo.get_user_snapshot(UID, repo.UserBalance), ()),
+    ("user_stats", lambda: repo.get_user_stats(UID), ()),
+    ("upsert_user", lambda: repo.upsert_user(UID, "explain", "Explain User"), ()),
+    ("referral_stats", lambda: repo.get_referral_stats(UID), ()),
+    ("has_generations", lambda: repo.has_generations(UID), ()),
+    ("activity_flush", _activity_flush, ()),
+    # --- рефералка ---
+    ("add_referral", lambda: repo.add_referral(UID, USERS * 2), ()),
+    ("mark_referral_paid", lambda: _in_session(repo.mark_referral_paid, UID + 1), ()),
+    ("recount_referrals", lambda: _in_session(repo.recount_referrals, [UID, UID + 1]), ()),
+    # --- генерации / журнал (db/credits, db/ledger) ---
+    ("credits_reserve_commit", _reserve_commit, ()),
+    ("credits_reserve_refund", _reserve_refund, ()),
+    ("ledger_set_balance", lambda: _in_session(ledger.set_balance, UID, 3, "explain"), ()),
+    ("ledger_history", lambda: _in_session(ledger.history, UID), ()),
+    ("ledger_drift", lambda: _in_session(ledger.find_drift), ("users",)),
+    # --- persistence (db/persistence) ---
+    ("bot_state_refresh", _bot_state_refresh, ()),
+    ("bot_state_write", _bot_state_write, ()),
+    # --- платежи: запросы прямо в хендлерах (handlers/balance.py) ---
+    ("payment_by_provider_id", lambda: _rolled_back(
+        select(Payment).where(Payment.provider_payment_id == f"pay-{UID}-1")), ()),
+    ("payments_of_user", lambda: _rolled_back(
+        select(Payment).where(Payment.user_id.in_([UID]))), ()),  # selectinload(User.payments)
+    ("reset_all_referrals", lambda: _rolled_back(
+        delete(Referral).where(or_(Referral.inviter_id == UID, Referral.invited_id == UID))), ()),
+    # зависшие PENDING (индекс ix_payments_status_created_at, миграция 0006)
+    ("pending_payments", lambda: _rolled_back(
+        select(Payment.id).where(Payment.status == "PENDING", Payment.created_at < SINCE)), ()),
+    # --- sync-скрипты (services/sync_users_from_raw, services/sync_dashboard_to_db) ---
+    # все user_id из *_raw — по смыслу читает индексы целиком
+    ("sync_users_ids", lambda: _in_tx(raw_user_ids), ("generations_raw", "payments_raw", "referrals_raw")),
+    ("sync_users_batch", lambda: _in_tx(sync_batch, 1, SYNC_BATCH), ()),
+    ("dashboard_apply_batch", lambda: _in_tx(apply_batch, {uid: _dashboard_row(uid) for uid in (UID, UID + 1)}), ()),
+    # --- архив *_raw (services/raw_retention) — последним: удаляет строки ---
+    ("raw_retention_pending", lambda: raw_retention.pending(dt.datetime.now(dt.timezone.utc)), ()),
+    ("raw_retention_run", lambda: raw_retention.run_once(dt.datetime.now(dt.timezone.utc)), ()),
+]
+
+DML = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+captured: list[tuple[str, object]] | None = None
+
+
+def _capture(conn, cursor, statement, parameters, context, executemany):
+    if captured is None or not statement.lstrip().upper().startswith(DML):
+        return
+    if executemany:
+        parameters = parameters[0]
+    captured.append((statement, parameters))
+
+
+def _ts(i: int) -> dt.datetime:
+    return dt.datetime.now(dt.timezone.utc) - dt.timedelta(minutes=i)
+
+
+async def seed():
+    await init_db(migrate=True)
+    ids = range(1, USERS + 1)
+    rows = [(uid, k) for uid in ids for k in range(ROWS_PER_USER)]
+    async with get_engine().begin() as conn:
+        await conn.execute(insert(User), [{"id": uid, "username": f"u{uid}", "balance": uid % 5} for uid in ids])
+        await conn.execute(insert(Referral), [
+            {"inviter_id": uid, "invited_id": uid + 1, "bonus_awarded": uid % 2 == 0} for uid in ids if uid < USERS
+        ])
+        await conn.execute(insert(Payment), [
+            {"user_id": uid, "amount": 100, "provider_payment_id": f"pay-{uid}-{k}",
+             "status": "PENDING" if k == 0 else "CONFIRMED", "provider": "YOOKASSA", "created_at": _ts(uid + k)}
+            for uid, k in rows
+        ])
+        await conn.execute(insert(PaymentRaw), [{"user_id": uid, "amount_rub": 100, "ts": _ts(uid + k)} for uid, k in rows])
+        await conn.execute(insert(ResultRaw), [{"user_id": uid, "status": "CONFIRMED", "ts": _ts(uid + k)} for uid, k in rows])
+        await conn.execute(insert(GenerationRaw), [{"user_id": uid, "price_rub": 100, "ts": _ts(uid + k)} for uid, k in rows])
+        await conn.execute(insert(BalanceRaw), [
+            {"user_id": uid, "old_balance": k, "delta": 1, "new_balance": k + 1, "ts": _ts(uid + k)} for uid, k in rows
+        ])
+        await conn.execute(insert(ReferralRaw), [
+            {"referrer_id": uid, "new_user_id": uid + USERS, "status": "registered", "ts": _ts(uid + k)} for uid, k in rows
+        ])
+        await conn.execute(insert(ReferralSummary), [
+            {"user_id": uid, "invited_total": 1, "invited_paid": 0, "bonus_total": 0, "ts": _ts(uid + k)} for uid, k in rows
+        ])
+        await conn.execute(insert(BalanceEntry), [
+            {"user_id": uid, "delta": 1, "balance_after": k + 1, "reason": "seed", "ts": _ts(uid + k)} for uid, k in rows
+        ])
+        await conn.execute(insert(CreditReservation), [
+            {"user_id": uid, "status": "committed", "created_at": _ts(uid)} for uid in ids
+        ])
+        await conn.execute(insert(BotState), [{"kind": "user", "key": uid, "data": "{}", "version": 1} for uid in ids])
+        await conn.execute(text("ANALYZE"))
+
+
+async def explain(conn, sql: str, params) -> list[str]:
+    if conn.dialect.name == "postgresql":
+        rows = await conn.exec_driver_sql(f"EXPLAIN {sql}", params)
+        return [r[0] for r in rows]
+    rows = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [r[-1] for r in rows]
+
+
+def full_scans(plan: list[str]) -> set[str]:
+    found = set()
+    for line in plan:
+        # SQLite: «SCAN users» / «SCAN users_1» (алиас) / «SCAN users USING COVERING INDEX ...» — всё это проход по всей таблице
+        m = re.search(r"^SCAN (\w+)", line.strip()) or re.search(r"Seq Scan on (\w+)", line)
+        if m:
+            found.add(m.group(1))
+    return found
+
+
+def table_scans(sql: str, plan: list[str]) -> set[str]:
+    """Полные проходы по настоящим таблицам: алиасы → таблицы, подзапросы (agg, ids, ...) не в счёт."""
+    aliases = {alias: table for table, alias in re.findall(r"\b(\w+) AS (\w+)\b", sql)}
+    return {aliases.get(name, name) for name in full_scans(plan)} & set(Base.metadata.tables)
+
+
+async def main():
+    global captured
+    await seed()
+    event.listen(get_engine().sync_engine, "before_cursor_execute", _capture)
+
+    failed = False
+    print(f"\n{'query':<28} plan")
+    for name, call, allowed in HOT_CALLS:
+        repo._user_cache.clear()
+        captured = []
+        await call()
+        # один и тот же оператор (повтор в цикле, executemany) — один план
+        statements, captured = dict(captured), None
+        if not statements:
+            print(f"{name:<28} ❌ SQL не выполнялся")
+            failed = True
+            continue
+
+        async with get_engine().connect() as conn:
+            if conn.dialect.name == "postgresql":
+                await conn.execute(text("SET enable_seqscan = off"))
+            for k, (sql, params) in enumerate(statements.items(), 1):
+                plan = await explain(conn, sql, params)
+                scans = table_scans(sql, plan) - set(allowed)
+                mark = "✅" if not scans else "❌"
+                failed |= bool(scans)
+                label = name if len(statements) == 1 else f"{name}#{k}"
+                print(f"{label:<28} {mark} {' | '.join(line.strip() for line in plan)[:150]}")
+                if scans:
+                    print(f"{'':<28}    полный проход: {', '.join(sorted(scans))}")
+                    print(f"{'':<28}    {' '.join(sql.split())[:300]}")
+            await conn.rollback()
+
+    await get_engine().dispose()
+    shutil.rmtree(raw_retention.ARCHIVE_DIR, ignore_errors=True)
+    if _db_file:
+        os.remove(_db_file)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
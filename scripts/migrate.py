@@ -0,0 +1,45 @@
+# scripts/migrate.py
+# =========================================================
+# МИГРАЦИИ СХЕМЫ — отдельный шаг деплоя (db/migrations.py)
+#
+# 🧩 Что делает:
+#   - показывает версию схемы в базе и версию кода;
+#   - применяет недостающие миграции (каждая — своя транзакция).
+#     Воркеры при старте сверяют версию одним запросом; отстаёт — мигрируют
+#     сами (под advisory lock), а с DB_AUTO_MIGRATE=0 не стартуют (/ → 503).
+#
+# 🚀 Как запускать до старта web:
+#    Render — Settings → Pre-Deploy Command: python scripts/migrate.py
+#    Heroku-подобные — release-фаза в Procfile.
+#        python scripts/migrate.py            # применить
+#        python scripts/migrate.py --status   # только показать, что применено / ожидает
+# =========================================================
+
+import sys
+import os
+import asyncio
+import logging
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from db.database import get_engine
+from db import migrations
+
+
+async def main(status_only: bool):
+    version = await migrations.stored_version()
+    pending = [f"{v:04d}_{name}" for v, name, _ in migrations.MIGRATIONS if v > version]
+    print(f"🧱 Схема в базе: v{version}, в коде: v{migrations.LATEST}")
+    print(f"⏳ Ожидают: {', '.join(pending) or '—'}")
+
+    if not status_only and pending:
+        applied = await migrations.migrate()
+        print(f"✅ Применено: {', '.join(applied) or '—'}")
+        print(f"🧱 Схема в базе: v{await migrations.stored_version()}")
+
+    await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    asyncio.run(main(status_only="--status" in sys.argv))
@@ -0,0 +1,80 @@
+# scripts/reconcile_balances.py
+# =========================================================
+# СВЕРКА БАЛАНСОВ: users.balance ↔ журнал balance_ledger
+#
+# 🧩 Что делает:
+#   - создаёт журнал, если его ещё нет (init_db открывает его текущими балансами);
+#   - сравнивает снимок users.balance с balance_after последней записи
+#     пользователя — по индексу (user_id, id), без перебора всего журнала;
+#   - расхождение = баланс меняли мимо db/ledger.py (ручной SQL, легаси-код):
+#     дописывает запись reconcile с разницей (снимок считаем верным);
+#   - --deep: дополнительно проверяет, что SUM(delta) = последнему balance_after
+#     (один проход по журналу — для разовых проверок, не для cron).
+#
+# 🚀 Как запускать:
+#        python scripts/reconcile_balances.py            # сверить и дописать reconcile
+#        python scripts/reconcile_balances.py --dry-run  # только показать расхождения
+#        python scripts/reconcile_balances.py --deep --dry-run
+# =========================================================
+
+import sys
+import os
+import asyncio
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select, func, insert
+
+from db.database import get_session, init_db
+from db.models import BalanceEntry, ts_now
+from db import ledger
+
+
+async def check_chain(session) -> list:
+    """Пользователи, у которых сумма дельт не сходится с последним balance_after."""
+    last_id = (
+        select(BalanceEntry.user_id, func.sum(BalanceEntry.delta).label("total"), func.max(BalanceEntry.id).label("last_id"))
+        .group_by(BalanceEntry.user_id)
+        .subquery()
+    )
+    return (await session.execute(
+        select(last_id.c.user_id, last_id.c.total, BalanceEntry.balance_after)
+        .join(BalanceEntry, BalanceEntry.id == last_id.c.last_id)
+        .where(last_id.c.total != BalanceEntry.balance_after)
+    )).all()
+
+
+async def main(dry_run: bool, deep: bool):
+    await init_db(migrate=True)
+    async with get_session() as session:
+        drift = await ledger.find_drift(session)
+        print(f"🔎 Снимок ≠ журнал: {len(drift)}")
+        for row in drift[:20]:
+            print(f"   user {row.id}: users.balance {row.balance}, журнал {row.ledger_balance}")
+
+        if deep:
+            broken = await check_chain(session)
+            print(f"🔗 SUM(delta) ≠ balance_after: {len(broken)}")
+            for row in broken[:20]:
+                print(f"   user {row.user_id}: сумма {row.total}, последняя запись {row.balance_after}")
+
+        if dry_run or not drift:
+            return
+
+        now = ts_now()
+        await session.execute(insert(BalanceEntry), [
+            {
+                "user_id": row.id,
+                "delta": (row.balance or 0) - (row.ledger_balance or 0),
+                "balance_after": row.balance or 0,
+                "reason": "reconcile",
+                "ts": now,
+            }
+            for row in drift
+        ])
+        await session.commit()
+        print(f"✅ Дописано записей reconcile: {len(drift)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(dry_run="--dry-run" in sys.argv, deep="--deep" in sys.argv))
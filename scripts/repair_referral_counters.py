@@ -0,0 +1,62 @@
+# scripts/repair_referral_counters.py
+# =========================================================
+# ПЕРЕСЧЁТ СЧЁТЧИКОВ РЕФЕРАЛКИ (users.invited_total / invited_paid)
+#
+# 🧩 Что делает:
+#   - добавляет колонки / индексы, если их ещё нет (init_db);
+#   - показывает, у скольких юзеров счётчики расходятся с referrals;
+#   - пересчитывает их из referrals одним UPDATE.
+#
+# 🚀 Как запускать:
+#        python scripts/repair_referral_counters.py            # пересчитать
+#        python scripts/repair_referral_counters.py --dry-run  # только показать расхождения
+# =========================================================
+
+import sys
+import os
+import asyncio
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select, func, or_
+
+from db.database import get_session, init_db
+from db.models import User, Referral
+from db.repo import recount_referrals
+
+
+async def find_drift(session) -> list:
+    total = func.count(Referral.id)
+    paid = func.count(Referral.id).filter(Referral.bonus_awarded.is_(True))
+    actual = (
+        select(User.id, User.invited_total, User.invited_paid, total.label("total"), paid.label("paid"))
+        .outerjoin(Referral, Referral.inviter_id == User.id)
+        .group_by(User.id, User.invited_total, User.invited_paid)
+        .subquery()
+    )
+    return (await session.execute(
+        select(actual).where(or_(
+            func.coalesce(actual.c.invited_total, 0) != actual.c.total,
+            func.coalesce(actual.c.invited_paid, 0) != actual.c.paid,
+        ))
+    )).all()
+
+
+async def main(dry_run: bool):
+    await init_db(migrate=True)
+    async with get_session() as session:
+        drift = await find_drift(session)
+        print(f"🔎 Расхождений: {len(drift)}")
+        for row in drift[:20]:
+            print(f"   user {row.id}: total {row.invited_total} → {row.total}, paid {row.invited_paid} → {row.paid}")
+
+        if dry_run or not drift:
+            return
+
+        updated = await recount_referrals(session)
+        await session.commit()
+        print(f"✅ Пересчитано: {updated} юзеров")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(dry_run="--dry-run" in sys.argv))
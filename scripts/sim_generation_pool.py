@@ -0,0 +1,213 @@
+# scripts/sim_generation_pool.py
+# =========================================================
+# ПУЛ СОЕДИНЕНИЙ ПРИ МАССОВЫХ ГЕНЕРАЦИЯХ
+#
+# 🧩 Что делает:
+#   - временная SQLite-база, пул как в проде (pool_size=20, max_overflow=10);
+#   - JOBS пользователей одновременно запускают run_generation_task,
+#     провайдер подменён задержкой GEN_SEC (без сети);
+#   - считает занятые соединения (события checkout/checkin): пик и сколько
+#     задач держат соединение, пока провайдер «генерирует», плюс задержку
+#     обычного запроса (как из хендлера меню) под нагрузкой;
+#   - для сравнения — старая схема: сессия открыта всё время генерации.
+#
+# 🚀 Как запускать (код выхода 1, если соединения держатся во время генерации):
+#        python scripts/sim_generation_pool.py
+#        python scripts/sim_generation_pool.py --jobs 100 --gen-sec 2
+# =========================================================
+
+import sys
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+_db_file = os.path.join(tempfile.mkdtemp(), "generation_pool.db")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_db_file}"
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:check")
+os.environ.setdefault("PRICE_RUB", "100")
+os.environ.setdefault("PAYMENT_PROVIDER", "TINKOFF")
+os.environ["GSHEETS_ENABLE"] = "0"
+
+from sqlalchemy import event, select
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+
+from db import database
+from db.database import get_session, init_db
+from db.models import User
+from handlers import photo
+
+POOL_SIZE, MAX_OVERFLOW = 20, 10
+FIRST_USER = 5000
+
+
+class PoolWatch:
+    """Сколько соединений выдано из пула, пик и какие задачи их держат."""
+
+    def __init__(self, sync_engine):
+        self.out = 0
+        self.peak = 0
+        self.holders: dict[asyncio.Task, int] = {}
+        self.during_generation: list[int] = []
+        event.listen(sync_engine, "checkout", self._checkout)
+        event.listen(sync_engine, "checkin", self._checkin)
+
+    def _checkout(self, *args):
+        self.out += 1
+        self.peak = max(self.peak, self.out)
+        task = asyncio.current_task()
+        self.holders[task] = self.holders.get(task, 0) + 1
+
+    def _checkin(self, *args):
+        self.out -= 1
+        task = asyncio.current_task()
+        if self.holders.get(task, 0) > 1:
+            self.holders[task] -= 1
+        else:
+            self.holders.pop(task, None)
+
+    def reset(self):
+        self.peak = self.out
+        self.during_generation = []
+
+
+watch: PoolWatch | None = None
+
+
+async def provider_wait(gen_sec: float) -> None:
+    # середина «генерации» — держит ли эта задача соединение из пула
+    await asyncio.sleep(gen_sec / 2)
+    watch.during_generation.append(watch.holders.get(asyncio.current_task(), 0))
+    await asyncio.sleep(gen_sec / 2)
+
+
+def use_prod_like_pool():
+    # тот же движок, что в проде, только на файле SQLite
+    engine = create_async_engine(
+        os.environ["DATABASE_URL"],
+        poolclass=AsyncAdaptedQueuePool,  # у aiosqlite по умолчанию NullPool
+        pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=15,
+    )
+    database._engine = engine
+    database._session_factory = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    return engine
+
+
+def fake_provider(gen_sec: float):
+    async def generate_video_from_photo(photo_path, duration=4, prompt=""):
+        yield {"status": "processing"}
+        await provider_wait(gen_sec)
+        yield {"status": "succeeded", "url": "https://example.com/video.mp4"}
+    return generate_video_from_photo
+
+
+async def _send_video(**kwargs):
+    return SimpleNamespace(video=SimpleNamespace(file_id="video-file-id"))
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def fake_job(user_id: int):
+    user = SimpleNamespace(id=user_id, username=f"u{user_id}", full_name="Load Test")
+    update = SimpleNamespace(
+        callback_query=SimpleNamespace(from_user=user, answer=_noop),
+        effective_chat=SimpleNamespace(id=user_id),
+        effective_user=user,
+    )
+    context = SimpleNamespace(
+        bot=SimpleNamespace(send_video=_send_video, send_message=_noop),
+        user_data={"last_photo_path": "/nonexistent.jpg", photo.PROMPT_KEY: "smile"},
+        application=SimpleNamespace(mark_data_for_update_persistence=lambda **kw: None),
+    )
+    return update, context
+
+
+async def old_style_job(user_id: int, gen_sec: float):
+    # как было: сессия (и соединение) держится всю генерацию
+    async with get_session() as session:
+        await session.execute(select(User).where(User.id == user_id))
+        await provider_wait(gen_sec)
+        await session.commit()
+
+
+async def probe_latency(stop: asyncio.Event) -> list[float]:
+    """Пока идут генерации — раз в 100 мс обычный запрос, как у хендлера меню."""
+    samples = []
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        async with get_session() as session:
+            await session.execute(select(User.balance).where(User.id == FIRST_USER))
+        samples.append(time.perf_counter() - t0)
+        await asyncio.sleep(0.1)
+    return samples
+
+
+async def run(label: str, jobs) -> bool:
+    watch.reset()
+    stop = asyncio.Event()
+    probe = asyncio.create_task(probe_latency(stop))
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    wall = time.perf_counter() - t0
+    stop.set()
+    samples = await probe
+
+    errors = [r for r in results if isinstance(r, Exception)]
+    worst = max(samples) * 1000 if samples else 0.0
+    held = sum(watch.during_generation)
+    print(f"{label:<5} jobs={len(results):<4} wall={wall:6.2f}s  pool peak={watch.peak:<3} "
+          f"held while generating={held:<4} probe max={worst:7.1f}ms  errors={len(errors)}")
+    for e in errors[:3]:
+        print("     ·", repr(e)[:160])
+    return not errors
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--gen-sec", type=float, default=2.0)
+    args = parser.parse_args()
+
+    engine = use_prod_like_pool()
+    await init_db()
+    async with get_session() as session:
+        for i in range(args.jobs):
+            session.add(User(id=FIRST_USER + i, username=f"u{i}", balance=2))
+        await session.commit()
+
+    global watch
+    watch = PoolWatch(engine.sync_engine)
+    photo.generate_video_from_photo = fake_provider(args.gen_sec)
+    users = range(FIRST_USER, FIRST_USER + args.jobs)
+
+    print(f"\npool_size={POOL_SIZE} max_overflow={MAX_OVERFLOW} gen_sec={args.gen_sec}")
+    await run("old", [old_style_job(u, args.gen_sec) for u in users])
+    ok = await run("new", [photo.run_generation_task(*fake_job(u)) for u in users])
+    held = sum(watch.during_generation)
+
+    async with get_session() as session:
+        charged = (await session.execute(
+            select(User.id).where(User.id.in_(list(users)), User.balance == 1)
+        )).scalars().all()
+    ok &= len(charged) == args.jobs
+    print(f"списано ровно по 1 генерации: {len(charged)}/{args.jobs}")
+
+    # пока провайдер работает, задача генерации не держит соединение;
+    # короткие пики на списании/записи (пул × секунды) — норма
+    flat = held == 0
+    print(f"пул во время генерации {'✅ свободен' if flat else f'❌ занято {held}'}")
+
+    await engine.dispose()
+    os.remove(_db_file)
+    sys.exit(0 if ok and flat else 1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
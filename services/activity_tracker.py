@@ -0,0 +1,110 @@
+# services/activity_tracker.py
+# last_active_at без записи в БД на каждое нажатие кнопки.
+# Хендлеры только отмечают user_id в буфере (в памяти процесса), фоновый
+# цикл раз в ACTIVITY_FLUSH_SEC пишет всех одним UPDATE ... WHERE id = ANY(:ids).
+# Буфер ограничен: при ACTIVITY_BUFFER_MAX пользователей flush идёт досрочно,
+# UPDATE уходит пачками по ACTIVITY_BUFFER_MAX id. Пока БД недоступна, буфер
+# не растёт выше ACTIVITY_PENDING_MAX: лишние отметки отбрасываются (stats["dropped"]) —
+# last_active_at лишь приблизительное время, пользователь отметится снова.
+import asyncio
+import datetime as dt
+
+from config import settings
+
+FLUSH_SEC = settings.activity_flush_sec
+BUFFER_MAX = max(1, settings.activity_buffer_max)
+PENDING_MAX = max(BUFFER_MAX, settings.activity_pending_max)
+
+_pending: set[int] = set()
+_wakeup = asyncio.Event()
+_flush_task: asyncio.Task | None = None
+stats = {"touched": 0, "flushes": 0, "flushed_users": 0, "errors": 0, "dropped": 0}
+
+
+def touch(user_id: int) -> None:
+    """Отметить активность пользователя (без I/O)."""
+    stats["touched"] += 1
+    if len(_pending) >= PENDING_MAX and user_id not in _pending:
+        stats["dropped"] += 1  # БД давно не принимает flush — не копим без предела
+        return
+    _pending.add(user_id)
+    if len(_pending) >= BUFFER_MAX:
+        _wakeup.set()
+
+
+def _requeue(ids: list[int]) -> None:
+    """Вернуть неотправленные id в буфер, но не выше PENDING_MAX."""
+    room = max(0, PENDING_MAX - len(_pending))
+    fresh = [uid for uid in ids if uid not in _pending]
+    _pending.update(fresh[:room])
+    stats["dropped"] += max(0, len(fresh) - room)
+
+
+async def flush() -> int:
+    """UPDATE пачками по BUFFER_MAX на всех накопленных пользователей. Возвращает число записанных."""
+    from sqlalchemy import text, update
+    from db.database import get_engine
+    from db.models import User
+
+    if not _pending:
+        return 0
+    ids = list(_pending)
+    _pending.clear()
+    ts = dt.datetime.now(dt.timezone.utc).isoformat()
+
+    engine = get_engine()
+    done = 0
+    for start in range(0, len(ids), BUFFER_MAX):
+        chunk = ids[start:start + BUFFER_MAX]
+        try:
+            async with engine.begin() as conn:
+                if engine.dialect.name == "postgresql":
+                    await conn.execute(
+                        text("UPDATE users SET last_active_at = :ts WHERE id = ANY(:ids)"),
+                        {"ts": ts, "ids": chunk},
+                    )
+                else:
+                    await conn.execute(update(User).where(User.id.in_(chunk)).values(last_active_at=ts))
+        except Exception as e:
+            stats["errors"] += 1
+            # вернём в буфер (с пределом) — запишем в следующий раз; остальные пачки не пробуем
+            _requeue(ids[start:])
+            print(f"⚠️ Activity flush error ({len(ids) - start} users): {e}")
+            break
+        done += len(chunk)
+
+    if done:
+        stats["flushes"] += 1
+        stats["flushed_users"] += done
+    return done
+
+
+async def _flush_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=FLUSH_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        await flush()
+
+
+def start() -> None:
+    global _flush_task
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.get_running_loop().create_task(_flush_loop(), name="activity-flush")
+
+
+async def stop() -> int:
+    """Остановить цикл и записать остаток (при остановке узла)."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        await asyncio.gather(_flush_task, return_exceptions=True)
+        _flush_task = None
+    return await flush()
+
+
+def snapshot() -> dict:
+    return {**stats, "pending": len(_pending), "buffer_max": BUFFER_MAX,
+            "pending_max": PENDING_MAX, "flush_sec": FLUSH_SEC}
@@ -1,7 +1,6 @@
 # 🚀 Auto Dashboard (фикс финал)
 import os
 import asyncio
-import gspread
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from collections import defaultdict
@@ -16,8 +15,16 @@ load_dotenv()
 GCP_CREDENTIALS_FILE = os.getenv("GSHEETS_CREDENTIALS_FILE", "gcp_sa.json")
 SPREADSHEET_ID = os.getenv("GSHEETS_SPREADSHEET_ID")
 
-gc = gspread.service_account(filename=GCP_CREDENTIALS_FILE)
-sh = gc.open_by_key(SPREADSHEET_ID)
+_sh = None  # таблица открывается при первом обращении, а не при импорте
+
+
+def _spreadsheet():
+    global _sh
+    if _sh is None:
+        import gspread
+        gc = gspread.service_account(filename=GCP_CREDENTIALS_FILE)
+        _sh = gc.open_by_key(SPREADSHEET_ID)
+    return _sh
 
 MOSCOW_TZ = timezone(timedelta(hours=3))
 
@@ -93,6 +100,8 @@ def init_dashboard_headers(ws):
 
 
 def get_or_create_dashboard():
+    import gspread
+    sh = _spreadsheet()
     try:
         ws = sh.worksheet(SHEET_NAME)
     except gspread.exceptions.WorksheetNotFound:
@@ -105,6 +114,7 @@ def get_or_create_dashboard():
 
 def _sync_dashboard_once_sync():
     ws = get_or_create_dashboard()
+    sh = _spreadsheet()
 
     # === Данные из других листов ===
     users = sh.worksheet("users").get_all_records()
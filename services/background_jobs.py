@@ -0,0 +1,50 @@
+# services/background_jobs.py
+# Реестр фоновых задач, которые нельзя просто отменить при остановке
+# (генерации видео — провайдер уже берёт за них деньги).
+# track() вместо asyncio.create_task(); drain() ждёт их до дедлайна.
+import asyncio
+import time
+import typing as t
+
+_tasks: dict[asyncio.Task, tuple[str, float]] = {}  # task → (имя, время старта)
+stats = {"started": 0, "finished": 0, "failed": 0, "abandoned": 0}
+
+
+def _on_done(task: asyncio.Task) -> None:
+    _tasks.pop(task, None)
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        stats["failed"] += 1
+    else:
+        stats["finished"] += 1
+
+
+def track(coro: t.Coroutine, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _tasks[task] = (name, time.monotonic())
+    stats["started"] += 1
+    task.add_done_callback(_on_done)
+    return task
+
+
+def running() -> list[dict]:
+    now = time.monotonic()
+    return [{"name": name, "age_sec": round(now - started, 1)} for name, started in _tasks.values()]
+
+
+async def drain(deadline: float) -> dict:
+    """Ждёт текущие задачи до deadline (time.monotonic()); что не успело — отменяет и возвращает списком."""
+    pending = list(_tasks)
+    if not pending:
+        return {"pending": 0, "drained": 0, "abandoned": []}
+
+    timeout = max(0.0, deadline - time.monotonic())
+    done, not_done = await asyncio.wait(pending, timeout=timeout)
+
+    abandoned = [_tasks[task][0] for task in not_done if task in _tasks]
+    for task in not_done:
+        task.cancel()
+    await asyncio.gather(*not_done, return_exceptions=True)
+    stats["abandoned"] += len(abandoned)
+    return {"pending": len(pending), "drained": len(done), "abandoned": abandoned}
@@ -351,18 +351,19 @@ def add_package(user_id: int, amount_rub: int) -> Tuple[int, int, int]:
     from db.database import get_session
 
     async def apply_referral_bonus():
+        from db.repo import mark_referral_paid
+
         async with get_session() as session:
-            result = await session.execute(select(Referral).where(Referral.invited_id == user_id))
-            ref = result.scalar_one_or_none()
-            if ref and not ref.bonus_awarded:
-                ref.bonus_awarded = True
+            # флаг бонуса + invited_paid атомарно (повторный вызов ничего не сделает)
+            inviter_id = await mark_referral_paid(session, user_id)
+            if inviter_id is not None:
                 await session.execute(text("""
                     UPDATE users
                     SET 
                         generations_balance = COALESCE(generations_balance, 0) + :bonus,
                         total_generations = COALESCE(total_generations, 0) + :bonus
                     WHERE id = :referrer_id
-                """), {"referrer_id": ref.inviter_id, "bonus": settings.bonus_per_friend})
+                """), {"referrer_id": inviter_id, "bonus": settings.bonus_per_friend})
                 await session.commit()
 
     try:
@@ -5,14 +5,13 @@ from services.performance_logger import measure_time
 
 import json
 import time
-import aiohttp
 import asyncio
 import typing as t
-import jwt
 from collections import defaultdict
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
 from config import settings
+from services import http_client
 
 
 # === Загружаем .env и включаем флаг ===
@@ -85,6 +84,8 @@ async def _get_access_token() -> str:
         if _token_cache["access_token"] and _token_cache["expires_at"] - 60 > now:
             return _token_cache["access_token"]
 
+        import jwt  # PyJWT/cryptography грузим только при первой авторизации
+
         sa = _load_sa()
         iat = int(time.time())
         exp = iat + 3600
@@ -102,7 +103,7 @@ async def _get_access_token() -> str:
 
         data = {"grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer", "assertion": assertion}
 
-        async with aiohttp.ClientSession() as session:
+        async with http_client.session() as session:
             async with session.post(TOKEN_URL, data=data, timeout=30) as resp:
                 j = await resp.json()
                 if resp.status != 200:
@@ -116,8 +117,8 @@ async def _get_access_token() -> str:
 async def _request_json(method: str, url: str, *, params=None, json_body=None):
     token = await _get_access_token()
     headers = {"Authorization": f"Bearer {token}"}
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.request(method, url, params=params, json=json_body, timeout=30) as resp:
+    async with http_client.session() as session:
+        async with session.request(method, url, params=params, json=json_body, headers=headers, timeout=30) as resp:
             data = await resp.json()
             print(f"📡 SHEETS API {method} {url} -> {resp.status}")
             if resp.status >= 400:
@@ -171,6 +172,17 @@ async def _flush_once() -> None:
         print(f"📤 FLUSH → {sheet}: {len(rows)} строк (каждые {_FLUSH_INTERVAL} сек)")
         await append_rows_async(rows=rows, sheet_name=sheet, headers=headers, use_queue=False)
 
+async def flush_now() -> int:
+    """Останавливает фоновый flush и сразу отправляет всё из очереди (при остановке)."""
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        await asyncio.gather(_flush_task, return_exceptions=True)
+        _flush_task = None
+    rows = sum(len(r) for r in _queue_rows.values())
+    await _flush_once()
+    return rows
+
 @measure_time
 async def _flush_loop() -> None:
     while True:
@@ -0,0 +1,37 @@
+# services/http_client.py
+# Общая aiohttp-сессия: keep-alive соединения к Fal / Replicate / Google
+# переиспользуются между запросами, а не открываются заново на каждый вызов.
+from contextlib import asynccontextmanager
+
+_session = None
+
+
+def get_http():
+    """Общая ClientSession (создаётся при первом обращении внутри event loop)."""
+    global _session
+    if _session is None or _session.closed:
+        import aiohttp
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=75, ttl_dns_cache=300),
+        )
+    return _session
+
+
+@asynccontextmanager
+async def session():
+    """`async with http_client.session() as s:` — как ClientSession, но без закрытия."""
+    yield get_http()
+
+
+async def warm(url: str, timeout: float = 5.0) -> int:
+    """Открывает keep-alive соединение к хосту (DNS + TCP + TLS) лёгким HEAD-запросом."""
+    import aiohttp
+    async with get_http().head(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        return resp.status
+
+
+async def close() -> None:
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
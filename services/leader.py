@@ -0,0 +1,182 @@
+# services/leader.py
+# Выбор лидера среди инстансов / воркеров через Postgres advisory lock.
+#
+# Работа «один раз на кластер» (регистрация webhook, dashboard-loop и другие
+# периодические задачи) регистрируется через leader.register() и выполняется
+# только на лидере. Лидер держит pg_try_advisory_lock на отдельном соединении;
+# если процесс умер или соединение оборвалось — Postgres снимает лок, и
+# следующий опрос другого узла забирает лидерство (не дольше LEADER_POLL_SEC).
+#
+# На SQLite (локально, один процесс) узел всегда лидер.
+import asyncio
+import os
+import socket
+import time
+
+from config import settings
+
+LOCK_ID = settings.leader_lock_id
+POLL_SEC = settings.leader_poll_sec
+NODE = f"{socket.gethostname()}:{os.getpid()}"
+
+_jobs: dict[str, object] = {}              # name → фабрика корутины
+_running: dict[str, asyncio.Task] = {}
+_conn = None                               # соединение, которое держит лок
+_leader = False
+_loop_task: asyncio.Task | None = None
+_stats = {"elected": 0, "stepped_down": 0, "leader_since": None}
+
+
+def is_leader() -> bool:
+    return _leader
+
+
+def register(name: str, factory) -> None:
+    """Задача, которая должна идти ровно на одном узле. factory() → корутина."""
+    _jobs[name] = factory
+    if _leader:
+        _start_job(name)
+
+
+# === Задачи лидера ===
+def _start_job(name: str) -> None:
+    task = _running.get(name)
+    if task is not None and not task.done():
+        return
+    _running[name] = asyncio.create_task(_run_job(name), name=f"leader-{name}")
+
+
+async def _run_job(name: str) -> None:
+    try:
+        await _jobs[name]()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"⚠️ Leader job {name} упала: {e}")
+
+
+async def _cancel_jobs() -> None:
+    tasks = [t for t in _running.values() if not t.done()]
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _running.clear()
+
+
+async def _become_leader() -> None:
+    global _leader
+    _leader = True
+    _stats["elected"] += 1
+    _stats["leader_since"] = time.time()
+    print(f"👑 {NODE} — лидер (jobs: {', '.join(_jobs) or '—'})")
+    for name in _jobs:
+        _start_job(name)
+
+
+async def _step_down(reason: str) -> None:
+    global _leader, _conn
+    if _leader:
+        _stats["stepped_down"] += 1
+        print(f"⚠️ {NODE} больше не лидер: {reason}")
+    _leader = False
+    _stats["leader_since"] = None
+    await _cancel_jobs()
+
+    conn, _conn = _conn, None
+    if conn is not None:
+        try:
+            from sqlalchemy import text
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": LOCK_ID})
+            await conn.close()
+        except Exception:
+            # соединение уже мёртвое — лок снят сервером, в пул его не возвращаем
+            try:
+                await conn.invalidate()
+            except Exception:
+                pass
+
+
+# === Выборы ===
+async def _try_acquire() -> bool:
+    global _conn
+    from sqlalchemy import text
+    from db.database import get_engine
+
+    conn = await get_engine().connect()
+    try:
+        got = await conn.scalar(text("SELECT pg_try_advisory_lock(:id)"), {"id": LOCK_ID})
+        # autobegin открыл транзакцию — закрываем, лок сессионный и останется
+        await conn.commit()
+    except Exception:
+        await conn.invalidate()
+        raise
+    if got:
+        _conn = conn
+        return True
+    await conn.close()
+    return False
+
+
+async def _still_holding() -> bool:
+    from sqlalchemy import text
+
+    try:
+        await _conn.scalar(text("SELECT 1"))
+        await _conn.commit()
+        return True
+    except Exception:
+        return False
+
+
+async def _election_loop() -> None:
+    while True:
+        try:
+            if _leader:
+                if not await _still_holding():
+                    await _step_down("соединение с локом потеряно")
+            elif await _try_acquire():
+                await _become_leader()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Leader election: {e}")
+        await asyncio.sleep(POLL_SEC)
+
+
+async def start() -> None:
+    """Первая попытка стать лидером сразу, дальше — фоновый опрос."""
+    global _loop_task
+    from db.database import get_engine
+
+    if get_engine().dialect.name != "postgresql":
+        print("👑 Не Postgres — этот узел всегда лидер")
+        await _become_leader()
+        return
+
+    try:
+        if await _try_acquire():
+            await _become_leader()
+        else:
+            print(f"👥 {NODE} — ведомый, лидер уже есть")
+    except Exception as e:
+        print(f"⚠️ Leader election: {e}")
+    _loop_task = asyncio.create_task(_election_loop(), name="leader-election")
+
+
+async def stop() -> None:
+    """Отдать лидерство сразу (при остановке), а не ждать разрыва соединения."""
+    global _loop_task
+    if _loop_task is not None:
+        _loop_task.cancel()
+        await asyncio.gather(_loop_task, return_exceptions=True)
+        _loop_task = None
+    await _step_down("остановка узла")
+
+
+def snapshot() -> dict:
+    return {
+        "node": NODE,
+        "leader": _leader,
+        "jobs": {name: ("running" if name in _running and not _running[name].done() else "idle") for name in _jobs},
+        **_stats,
+    }
@@ -0,0 +1,178 @@
+# services/raw_retention.py
+# Архив и очистка *_raw (payments_raw, results_raw, generations_raw,
+# balances_raw, referrals_raw, referrals_summary).
+#
+# Таблицы событий только растут. Задача лидера раз в RAW_RETENTION_INTERVAL_SEC
+# берёт всё, что старше RAW_RETENTION_MONTHS полных месяцев, и по одному
+# месяцу за раз:
+#   1) читает строки пачками по id (keyset) в <RAW_ARCHIVE_DIR>/<table>/<YYYY-MM>.jsonl.gz
+#      (сначала .tmp, fsync, потом rename — полуфайл архивом не станет);
+#   2) только после этого удаляет те же диапазоны id короткими транзакциями.
+# Диапазон месяца находится по BRIN-индексу на ts (миграция 0007).
+#
+# ⚠️ sync_users_from_raw считает итоги по *_raw — после архивации это итоги
+#    за хранимое окно. Поэтому по умолчанию выключено (RAW_RETENTION_MONTHS=0).
+# Прогон прервали посреди удаления — следующий допишет остаток месяца в
+# <YYYY-MM>.1.jsonl.gz; строка может оказаться в двух файлах, id у неё один.
+import asyncio
+import datetime as dt
+import gzip
+import json
+import os
+import time
+
+from config import settings
+
+MONTHS = settings.raw_retention_months
+ARCHIVE_DIR = settings.raw_archive_dir
+BATCH = max(1, settings.raw_retention_batch)
+INTERVAL_SEC = settings.raw_retention_interval_sec
+
+stats = {"runs": 0, "archived": 0, "deleted": 0, "files": 0, "errors": 0, "last_run": None}
+
+
+def _tables() -> list:
+    from db.models import BalanceRaw, GenerationRaw, PaymentRaw, ReferralRaw, ReferralSummary, ResultRaw
+    return [PaymentRaw, ResultRaw, GenerationRaw, BalanceRaw, ReferralRaw, ReferralSummary]
+
+
+# === Месяцы ===
+def _month_start(year: int, month0: int) -> dt.datetime:
+    """month0 — месяц от нуля, может выходить за 0..11."""
+    year, month0 = year + month0 // 12, month0 % 12
+    return dt.datetime(year, month0 + 1, 1, tzinfo=dt.timezone.utc)
+
+
+def cutoff(months: int | None = None, now: dt.datetime | None = None) -> dt.datetime:
+    """Начало самого старого месяца, который остаётся в базе (текущий + months полных)."""
+    now = now or dt.datetime.now(dt.timezone.utc)
+    return _month_start(now.year, now.month - 1 - (MONTHS if months is None else months))
+
+
+def _archive_path(table: str, month: dt.datetime) -> str:
+    base = os.path.join(ARCHIVE_DIR, table, month.strftime("%Y-%m"))
+    path, k = f"{base}.jsonl.gz", 1
+    while os.path.exists(path):
+        path = f"{base}.{k}.jsonl.gz"
+        k += 1
+    return path
+
+
+def _row_json(row) -> bytes:
+    data = {k: (v.isoformat() if isinstance(v, dt.datetime) else v) for k, v in row.items()}
+    return (json.dumps(data, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+# === Один месяц одной таблицы ===
+async def _oldest_month(model, before: dt.datetime) -> dt.datetime | None:
+    from sqlalchemy import func, select
+    from db.database import get_engine
+
+    async with get_engine().connect() as conn:
+        ts = await conn.scalar(select(func.min(model.ts)).where(model.ts < before))
+    if ts is None:
+        return None
+    return _month_start(ts.year, ts.month - 1)
+
+
+async def archive_month(model, month: dt.datetime) -> int:
+    """Выгрузить месяц в gzip JSONL и удалить из базы. Возвращает число строк."""
+    from sqlalchemy import delete, select
+    from db.database import get_engine
+
+    table = model.__table__
+    end = _month_start(month.year, month.month)
+    in_month = (table.c.ts >= month, table.c.ts < end)
+    path = _archive_path(table.name, month)
+    tmp = path + ".tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # 1️⃣ выгрузка: пачки по id, без долгой транзакции
+    ranges, last_id, total = [], 0, 0
+    with open(tmp, "wb") as raw:
+        with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+            while True:
+                async with get_engine().connect() as conn:
+                    rows = (await conn.execute(
+                        select(table).where(*in_month, table.c.id > last_id).order_by(table.c.id).limit(BATCH)
+                    )).mappings().all()
+                if not rows:
+                    break
+                gz.write(b"".join(_row_json(r) for r in rows))
+                ranges.append((last_id, rows[-1]["id"]))
+                last_id = rows[-1]["id"]
+                total += len(rows)
+        raw.flush()
+        os.fsync(raw.fileno())
+
+    if not total:
+        os.remove(tmp)
+        return 0
+    os.replace(tmp, path)
+    stats["files"] += 1
+    stats["archived"] += total
+
+    # 2️⃣ удаление: файл уже на диске, удаляем ровно выгруженные диапазоны
+    deleted = 0
+    for lo, hi in ranges:
+        async with get_engine().begin() as conn:
+            deleted += (await conn.execute(
+                delete(table).where(*in_month, table.c.id > lo, table.c.id <= hi)
+            )).rowcount
+        await asyncio.sleep(0)
+    stats["deleted"] += deleted
+    print(f"🗄 {table.name} {month:%Y-%m}: {total} строк → {path}, удалено {deleted}")
+    return total
+
+
+# === Прогон ===
+async def pending(before: dt.datetime | None = None) -> dict[str, int]:
+    """Сколько строк в каждой таблице старше границы (для --dry-run)."""
+    from sqlalchemy import func, select
+    from db.database import get_engine
+
+    before = before or cutoff()
+    counts = {}
+    async with get_engine().connect() as conn:
+        for model in _tables():
+            counts[model.__tablename__] = await conn.scalar(
+                select(func.count()).select_from(model).where(model.ts < before)
+            )
+    return counts
+
+
+async def run_once(before: dt.datetime | None = None) -> dict[str, int]:
+    """Архивировать всё старше границы. {"table/YYYY-MM": строк}."""
+    before = before or cutoff()
+    done = {}
+    t0 = time.perf_counter()
+    for model in _tables():
+        while (month := await _oldest_month(model, before)) is not None:
+            count = await archive_month(model, month)
+            done[f"{model.__tablename__}/{month:%Y-%m}"] = count
+            if not count:
+                break
+    stats["runs"] += 1
+    stats["last_run"] = time.time()
+    print(f"🗄 Архив *_raw до {before:%Y-%m}: {sum(done.values())} строк за {time.perf_counter() - t0:.1f} сек")
+    return done
+
+
+async def auto_loop():
+    print(f"🗄 Архив *_raw: храним {MONTHS} мес. + текущий, раз в {INTERVAL_SEC / 3600:.0f} ч → {ARCHIVE_DIR}")
+    # 💤 после старта не мешаем прогреву и первым апдейтам
+    await asyncio.sleep(60)
+
+    while True:
+        try:
+            await run_once()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"❌ Ошибка архива *_raw: {e}")
+        await asyncio.sleep(INTERVAL_SEC)
+
+
+def snapshot() -> dict:
+    return {"months": MONTHS, "dir": ARCHIVE_DIR, **stats}
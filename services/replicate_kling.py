@@ -1,11 +1,12 @@
 import os
-import aiohttp
 import asyncio
 import base64
 import json
 from dotenv import load_dotenv
 from typing import Optional, AsyncGenerator
 
+from services import http_client
+
 # === Загружаем .env ===
 load_dotenv()
 
@@ -79,7 +80,7 @@ async def _generate_replicate(photo_path: str, duration: int, prompt: Optional[s
     }
     headers = {"Authorization": f"Token {REPLICATE_TOKEN}", "Content-Type": "application/json"}
 
-    async with aiohttp.ClientSession() as session:
+    async with http_client.session() as session:
         async with session.post(f"{REPLICATE_API_BASE}/predictions", headers=headers, json=payload) as r:
             if r.status >= 300:
                 err = await r.text()
@@ -135,7 +136,7 @@ async def _generate_fal(photo_path: str, prompt: Optional[str]):
         "logs": True
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with http_client.session() as session:
         async with session.post(FAL_API_URL, headers=headers, json=payload) as r:
             raw = await r.text()
             print("🌐 FAL response:", raw)
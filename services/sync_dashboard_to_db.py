@@ -1,66 +1,132 @@
 #берет данные из гугл таблицы дашборда и обновляет юзеров в бд
-
+#
+# ⚙️ Как работает:
+#   - диапазон читается через Sheets REST API (services/gsheets._request_json:
+#     aiohttp + кэшированный OAuth-токен) — event loop не блокируется;
+#   - строки применяются пачками по BATCH: один SELECT ... FOR UPDATE текущих
+#     значений, затем один executemany UPDATE только по изменившимся строкам
+#     (diff=False — писать все найденные), изменения баланса — в журнал
+#     (db/ledger.py) одним пакетным INSERT.
+#   Раньше — синхронный googleapiclient внутри корутины и UPDATE на каждую строку.
 
 import asyncio
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-from sqlalchemy import text
-from db.database import engine
+import os
+import sys
+from urllib.parse import quote
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import bindparam, insert, select, update
+
+from db.database import get_engine
+from db.models import BalanceEntry, User, ts_now
+from db.repo import invalidate_user
+from services import gsheets
 
 # 🔹 Настройки напрямую в коде (без .env)
 SPREADSHEET_ID = "12X5nOZROvpFZwDbO0Q4Te_8jqz3H-oB03yUiX878oe8"
 RANGE_NAME = "Dashboard_Live!B3:Q1000"  # диапазон с данными
-CREDENTIALS_FILE = "./gcp_sa.json"
-
-async def sync_dashboard_to_db():
-    # === Подключение к Google Sheets ===
-    creds = Credentials.from_service_account_file(
-        CREDENTIALS_FILE,
-        scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"],
-    )
-    service = build("sheets", "v4", credentials=creds)
-    sheet = service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=RANGE_NAME
-    ).execute()
-
-    rows = sheet.get("values", [])
+BATCH = 1000
+LEDGER_REASON = "sync_dashboard"
+
+# колонки users, которые приходят из дашборда
+FIELDS = ("total_generations", "total_spent", "balance", "referrals_count")
+
+
+async def fetch_rows() -> list[list[str]]:
+    """Значения диапазона дашборда (как их показывает таблица)."""
+    url = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}/values/{quote(RANGE_NAME, safe='!:')}"
+    data = await gsheets._request_json("GET", url)
+    return data.get("values", [])
+
+
+def parse_rows(rows: list[list[str]]) -> dict[int, dict]:
+    """user_id → значения FIELDS. Битые строки пропускаются, при повторе id побеждает последняя."""
+    parsed = {}
+    for row in rows:
+        if len(row) < 11:
+            continue
+
+        try:
+            user_id = int(row[0])  # ID пользователя
+            gens = int(row[5] or 0)  # Кол-во генераций
+            paid = float(row[7] or 0)  # Сумма оплат
+            balance = int(row[10] or 0)  # Баланс генераций
+            refs = int(row[13] or 0)  # Приглашенные
+        except Exception:
+            continue
+
+        parsed[user_id] = {
+            "total_generations": gens,
+            "total_spent": int(paid),  # колонка целочисленная, как в sync_users_from_raw
+            "balance": balance,
+            "referrals_count": refs,
+        }
+    return parsed
+
+
+async def apply_batch(conn, batch: dict[int, dict], diff: bool = True) -> tuple[list[int], int]:
+    """Одна пачка в транзакции conn. Возвращает (id обновлённых, записей журнала)."""
+    current = {
+        r.id: r for r in await conn.execute(
+            select(User.id, *[getattr(User, f) for f in FIELDS])
+            .where(User.id.in_(list(batch)))
+            .with_for_update()
+        )
+    }
+
+    changed, entries = [], []
+    for user_id, values in batch.items():
+        row = current.get(user_id)
+        if row is None:
+            continue  # пользователя в базе нет — как и раньше, не создаём
+        if diff and all(getattr(row, f) == values[f] for f in FIELDS):
+            continue
+        changed.append({"b_id": user_id, **values})
+        old_balance = row.balance or 0
+        if values["balance"] != old_balance:
+            entries.append({
+                "user_id": user_id, "delta": values["balance"] - old_balance,
+                "balance_after": values["balance"], "reason": LEDGER_REASON, "ts": ts_now(),
+            })
+
+    if changed:
+        await conn.execute(update(User).where(User.id == bindparam("b_id")), changed)
+    if entries:
+        await conn.execute(insert(BalanceEntry), entries)
+    return [c["b_id"] for c in changed], len(entries)
+
+
+async def sync_dashboard_to_db(diff: bool = True) -> dict:
+    # === Чтение Google Sheets (async) ===
+    rows = await fetch_rows()
     if not rows:
         print("⚠️ Нет данных в Dashboard.")
-        return
-
-    async with engine.begin() as conn:
-        updated = 0
-        for row in rows:
-            if len(row) < 11:
-                continue
-
-            try:
-                user_id = int(row[0])  # ID пользователя
-                gens = int(row[5] or 0)  # Кол-во генераций
-                paid = float(row[7] or 0)  # Сумма оплат
-                balance = int(row[10] or 0)  # Баланс генераций
-                refs = int(row[13] or 0)  # Приглашенные
-            except Exception:
-                continue
-
-            await conn.execute(text("""
-                UPDATE users
-                SET total_generations = :gens,
-                    total_spent = :paid,
-                    balance = :balance,
-                    referrals_count = :refs
-                WHERE id = :user_id
-            """), dict(
-                gens=gens,
-                paid=paid,
-                balance=balance,
-                refs=refs,
-                user_id=user_id
-            ))
-            updated += 1
-
-        print(f"✅ Синхронизировано {updated} пользователей с Dashboard")
+        return {"rows": 0, "updated": 0, "ledger": 0}
+
+    parsed = parse_rows(rows)
+    ids = list(parsed)
+
+    # === Применение пачками ===
+    updated = ledger_rows = 0
+    engine = get_engine()
+    for start in range(0, len(ids), BATCH):
+        batch = {uid: parsed[uid] for uid in ids[start:start + BATCH]}
+        async with engine.begin() as conn:
+            changed, entries = await apply_batch(conn, batch, diff=diff)
+        invalidate_user(*changed)  # после commit — снимки в кэше больше не актуальны
+        updated += len(changed)
+        ledger_rows += entries
+
+    skipped = len(parsed) - updated
+    print(f"✅ Синхронизировано {updated} пользователей с Dashboard "
+          f"(строк {len(rows)}, {'без изменений / нет в базе' if diff else 'нет в базе'}: {skipped})")
+    return {"rows": len(rows), "updated": updated, "ledger": ledger_rows}
+
 
 if __name__ == "__main__":
-    asyncio.run(sync_dashboard_to_db())
+    async def main():
+        await sync_dashboard_to_db(diff="--all" not in sys.argv)
+        await get_engine().dispose()
+
+    asyncio.run(main())
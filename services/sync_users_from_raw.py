@@ -1,131 +1,212 @@
 # синхронизирует пользователей из гугл таблиц в базу - основную таблицу users
+#
+# ⚙️ Как работает (set-based, без запросов на каждого пользователя):
+#   1) один SELECT — все user_id из *_raw (UNION), по возрастанию;
+#   2) пачками по диапазону id (BATCH юзеров, своя транзакция на пачку):
+#        - агрегаты GROUP BY по каждой raw-таблице (индексы user_id, ts),
+#          склеенные по user_id;
+#        - записи журнала баланса (db/ledger.py) для тех, у кого баланс меняется;
+#        - INSERT ... SELECT ... ON CONFLICT (id) DO UPDATE — новые и
+#          существующие пользователи одним оператором.
+#   Раньше было ~8 запросов на пользователя в одной транзакции.
+#   Прогон идемпотентен: упал посреди — следующий просто пройдёт заново.
+#
+# 🚀 python services/sync_users_from_raw.py [--batch 5000]
+#    Бенчмарк: scripts/bench_sync_users.py
 
 import os
+import sys
+import time
 import asyncio
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy import text
-from dotenv import load_dotenv
 
-load_dotenv()
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-DATABASE_URL = os.getenv("DATABASE_URL")
+from sqlalchemy import Integer, case, cast, exists, false, func, insert, literal, select, true, union
 
-async def sync_users():
+from db.database import dialect_insert, get_engine
+from db.models import BalanceEntry, GenerationRaw, PaymentRaw, ReferralRaw, ReferralSummary, User
+
+BATCH = 5000
+LEDGER_REASON = "sync_users_from_raw"
+
+
+# === SQL-помощники (Postgres / SQLite) ===
+def _is_pg() -> bool:
+    return get_engine().dialect.name == "postgresql"
+
+
+def _iso(ts):
+    """Метка времени → строка, как раньше давал datetime.isoformat() (колонки last_*_at строковые)."""
+    if _is_pg():
+        return func.to_char(func.timezone("UTC", ts), 'YYYY-MM-DD"T"HH24:MI:SS.US') + "+00:00"
+    return func.replace(ts, " ", "T")
+
+
+def _to_int(value):
+    """int(float) из Python: отбрасываем дробную часть (суммы неотрицательные)."""
+    return cast(func.floor(value), Integer) if _is_pg() else cast(value, Integer)
+
+
+# === Агрегаты по пачке ===
+def _aggregates(lo: int, hi: int):
+    """По строке на user_id из [lo, hi]: те же значения, что раньше считались 7 запросами."""
+    pay = (
+        select(PaymentRaw.user_id.label("uid"),
+               func.sum(PaymentRaw.amount_rub).label("spent"),
+               func.max(PaymentRaw.ts).label("last_pay"))
+        .where(PaymentRaw.user_id.between(lo, hi))
+        .group_by(PaymentRaw.user_id)
+        .subquery("pay")
+    )
+    gen = (
+        select(GenerationRaw.user_id.label("uid"),
+               func.count().label("gens"),
+               func.max(GenerationRaw.ts).label("last_gen"))
+        .where(GenerationRaw.user_id.between(lo, hi))
+        .group_by(GenerationRaw.user_id)
+        .subquery("gen")
+    )
+    ref = (
+        select(ReferralRaw.referrer_id.label("uid"), func.count().label("refs"))
+        .where(ReferralRaw.referrer_id.between(lo, hi))
+        .group_by(ReferralRaw.referrer_id)
+        .subquery("ref")
+    )
+    bon = (
+        select(ReferralSummary.user_id.label("uid"), func.sum(ReferralSummary.bonus_total).label("bonus"))
+        .where(ReferralSummary.user_id.between(lo, hi))
+        .group_by(ReferralSummary.user_id)
+        .subquery("bon")
+    )
+    ids = union(
+        select(GenerationRaw.user_id.label("uid")).where(GenerationRaw.user_id.between(lo, hi)),
+        select(PaymentRaw.user_id).where(PaymentRaw.user_id.between(lo, hi)),
+        select(ReferralRaw.referrer_id).where(ReferralRaw.referrer_id.between(lo, hi)),
+        select(ReferralRaw.new_user_id).where(ReferralRaw.new_user_id.between(lo, hi)),
+    ).subquery("ids")
+
+    bonus = func.coalesce(bon.c.bonus, 0)
+    return (
+        select(
+            ids.c.uid.label("id"),
+            case((bonus > 0, bonus), else_=0).label("balance"),
+            bonus.label("generations_balance"),
+            _to_int(func.coalesce(pay.c.spent, 0)).label("total_spent"),
+            func.coalesce(gen.c.gens, 0).label("total_generations"),
+            _iso(pay.c.last_pay).label("last_payment_at"),
+            _iso(func.coalesce(gen.c.last_gen, pay.c.last_pay)).label("last_active_at"),
+            func.coalesce(ref.c.refs, 0).label("referrals_count"),
+        )
+        .select_from(ids)
+        .outerjoin(pay, pay.c.uid == ids.c.uid)
+        .outerjoin(gen, gen.c.uid == ids.c.uid)
+        .outerjoin(ref, ref.c.uid == ids.c.uid)
+        .outerjoin(bon, bon.c.uid == ids.c.uid)
+        .where(ids.c.uid != 0)
+        .subquery("agg")
+    )
+
+
+# === Операторы пачки ===
+def _ledger_changed_stmt(agg):
+    """Существующие пользователи, у которых баланс меняется: запись с разницей (до upsert)."""
+    old = func.coalesce(User.balance, 0)
+    return insert(BalanceEntry).from_select(
+        ["user_id", "delta", "balance_after", "reason", "ts"],
+        select(agg.c.id, agg.c.balance - old, agg.c.balance, literal(LEDGER_REASON), func.now())
+        .join(User, User.id == agg.c.id)
+        .where(agg.c.balance != old),
+    )
+
+
+def _ledger_opening_stmt(agg):
+    """Новые пользователи с ненулевым балансом: первая запись журнала (после upsert)."""
+    return insert(BalanceEntry).from_select(
+        ["user_id", "delta", "balance_after", "reason", "ts"],
+        select(agg.c.id, agg.c.balance, agg.c.balance, literal(LEDGER_REASON), func.now())
+        .where(agg.c.balance != 0, ~exists().where(BalanceEntry.user_id == agg.c.id)),
+    )
+
+
+def _upsert_stmt(agg):
+    columns = [
+        "id", "balance", "generations_balance", "total_spent", "total_generations",
+        "last_payment_at", "last_active_at", "referrals_count",
+    ]
+    stmt = dialect_insert()(User).from_select(
+        columns + ["free_trial_used", "consent_accepted", "created_at"],
+        # WHERE обязателен: иначе SQLite путает ON CONFLICT с JOIN ... ON
+        select(*[agg.c[name] for name in columns], false(), true(), func.now()).where(true()),
+    )
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[User.id],
+        set_={
+            "total_spent": excluded.total_spent,
+            "total_generations": excluded.total_generations,
+            "balance": excluded.balance,
+            "referrals_count": excluded.referrals_count,
+            "generations_balance": excluded.generations_balance,
+            "last_payment_at": func.coalesce(excluded.last_payment_at, User.last_payment_at),
+            "last_active_at": func.coalesce(excluded.last_active_at, User.last_active_at),
+        },
+    )
+
+
+async def raw_user_ids(conn) -> list[int]:
+    """Все user_id из *_raw (без NULL и 0), по возрастанию — границы пачек."""
+    ids = union(
+        select(GenerationRaw.user_id.label("uid")),
+        select(PaymentRaw.user_id),
+        select(ReferralRaw.referrer_id),
+        select(ReferralRaw.new_user_id),
+    ).subquery()
+    rows = await conn.execute(select(ids.c.uid).where(ids.c.uid.is_not(None), ids.c.uid != 0).order_by(ids.c.uid))
+    return [r[0] for r in rows]
+
+
+async def sync_batch(conn, lo: int, hi: int) -> int:
+    """Одна пачка id [lo, hi] в транзакции conn: журнал + upsert. Возвращает число записей журнала."""
+    agg = _aggregates(lo, hi)
+    ledger_rows = (await conn.execute(_ledger_changed_stmt(agg))).rowcount
+    await conn.execute(_upsert_stmt(agg))
+    ledger_rows += (await conn.execute(_ledger_opening_stmt(agg))).rowcount
+    return ledger_rows
+
+
+# === Синхронизация ===
+async def sync_users(batch_size: int = BATCH) -> dict:
     print("\n🚀 Синхронизация пользователей с raw-таблиц...\n")
-    engine = create_async_engine(DATABASE_URL, echo=False)
-
-    async with engine.begin() as conn:
-        # 1️⃣ Собираем всех уникальных user_id
-        result = await conn.execute(text("""
-            SELECT DISTINCT user_id FROM generations_raw
-            UNION
-            SELECT DISTINCT user_id FROM payments_raw
-            UNION
-            SELECT DISTINCT referrer_id FROM referrals_raw
-            UNION
-            SELECT DISTINCT new_user_id FROM referrals_raw
-        """))
-        user_ids = [r[0] for r in result if r[0]]
-        print(f"Найдено уникальных user_id: {len(user_ids)}")
-
-        for uid in user_ids:
-            # Пропускаем некорректные ID
-            try:
-                uid = int(uid)
-            except Exception:
-                continue
-
-            # 2️⃣ Проверяем, есть ли уже такой пользователь
-            check = await conn.execute(
-                text("SELECT id FROM users WHERE id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            exists = check.first()
-
-            # 3️⃣ Считаем статистику
-            pay_sum = await conn.scalar(
-                text("SELECT COALESCE(SUM(amount_rub), 0) FROM payments_raw WHERE user_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            gens = await conn.scalar(
-                text("SELECT COUNT(*) FROM generations_raw WHERE user_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            ref_count = await conn.scalar(
-                text("SELECT COUNT(*) FROM referrals_raw WHERE referrer_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            bonus = await conn.scalar(
-                text("SELECT COALESCE(SUM(bonus_total), 0) FROM referrals_summary WHERE user_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            balance = max(0, (bonus or 0))  # можно потом дополнить логикой
-
-            # 4️⃣ Последняя оплата и активность
-            last_pay = await conn.scalar(
-                text("SELECT MAX(ts) FROM payments_raw WHERE user_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            last_gen = await conn.scalar(
-                text("SELECT MAX(ts) FROM generations_raw WHERE user_id = CAST(:uid AS BIGINT)"),
-                {"uid": uid}
-            )
-            last_active = last_gen or last_pay
-
-            # 🧩 Преобразуем даты в строки
-            def to_str(v):
-                if v is None:
-                    return None
-                if isinstance(v, str):
-                    return v
-                return v.isoformat()
-
-            last_pay = to_str(last_pay)
-            last_active = to_str(last_active)
-
-            if exists:
-                # === Обновляем ===
-                await conn.execute(text("""
-                    UPDATE users
-                    SET total_spent = :spent,
-                        total_generations = :gens,
-                        balance = :balance,
-                        referrals_count = :refs,
-                        generations_balance = :bonus,
-                        last_payment_at = COALESCE(:last_pay, last_payment_at),
-                        last_active_at = COALESCE(:last_active, last_active_at)
-                    WHERE id = CAST(:uid AS BIGINT)
-                """), {
-                    "spent": int(pay_sum or 0),
-                    "gens": int(gens or 0),
-                    "balance": int(balance),
-                    "refs": int(ref_count or 0),
-                    "bonus": int(bonus or 0),
-                    "last_pay": last_pay,
-                    "last_active": last_active,
-                    "uid": uid
-                })
-            else:
-                # === Добавляем нового ===
-                await conn.execute(text("""
-                    INSERT INTO users (id, balance, generations_balance, total_spent, total_generations,
-                        last_payment_at, last_active_at, free_trial_used, referrals_count, consent_accepted, created_at)
-                    VALUES (CAST(:uid AS BIGINT), :balance, :bonus, :spent, :gens,
-                        :last_pay, :last_active, FALSE, :refs, TRUE, NOW())
-                """), {
-                    "uid": uid,
-                    "balance": int(balance),
-                    "bonus": int(bonus or 0),
-                    "spent": int(pay_sum or 0),
-                    "gens": int(gens or 0),
-                    "last_pay": last_pay,
-                    "last_active": last_active,
-                    "refs": int(ref_count or 0)
-                })
-
-        print("\n✅ Синхронизация завершена успешно!")
-    await engine.dispose()
+    engine = get_engine()
+    t0 = time.perf_counter()
+
+    # 1️⃣ Собираем всех уникальных user_id
+    async with engine.connect() as conn:
+        user_ids = await raw_user_ids(conn)
+    print(f"Найдено уникальных user_id: {len(user_ids)}")
+
+    # 2️⃣ Пачки по диапазону id: агрегаты + журнал + upsert
+    ledger_rows = 0
+    for start in range(0, len(user_ids), batch_size):
+        chunk = user_ids[start:start + batch_size]
+        async with engine.begin() as conn:
+            ledger_rows += await sync_batch(conn, chunk[0], chunk[-1])
+
+        done = start + len(chunk)
+        elapsed = time.perf_counter() - t0
+        print(f"📦 {done}/{len(user_ids)} ({done * 100 // len(user_ids)}%) · {done / elapsed:.0f} юзеров/с")
+
+    stats = {"users": len(user_ids), "ledger": ledger_rows, "sec": round(time.perf_counter() - t0, 2)}
+    print(f"\n✅ Синхронизация завершена успешно! {stats}")
+    return stats
 
 
 if __name__ == "__main__":
-    asyncio.run(sync_users())
+    args = sys.argv[1:]
+    batch = int(args[args.index("--batch") + 1]) if "--batch" in args else BATCH
+
+    async def main():
+        await sync_users(batch)
+        await get_engine().dispose()
+
+    asyncio.run(main())
@@ -5,6 +5,18 @@ import os
 from typing import Dict, Any, Optional
 from config import settings
 
+# Общая requests-сессия: keep-alive соединение к API Тинькофф переиспользуется
+_http = requests.Session()
+
+
+def _base_url() -> str:
+    return settings.tinkoff_test_url if settings.payment_mode.upper() == "TEST" else settings.tinkoff_prod_url
+
+
+def warm_connection() -> int:
+    """Открывает соединение к API заранее (вызывается из warm-up, в потоке)."""
+    return _http.head(_base_url(), timeout=5).status_code
+
 
 def _build_token(params: Dict[str, Any], password: str) -> str:
     """Генерация токена по алгоритму Тинькофф"""
@@ -33,8 +45,7 @@ def create_payment(amount: float, description: str, user_id: int, order_id: Opti
     }
     payload["Token"] = _build_token(payload, settings.tinkoff_secret_key)
 
-    base_url = settings.tinkoff_test_url if settings.payment_mode.upper() == "TEST" else settings.tinkoff_prod_url
-    r = requests.post(f"{base_url}/Init", json=payload, timeout=30)
+    r = _http.post(f"{_base_url()}/Init", json=payload, timeout=30)
 
     print("➡️ TINKOFF INIT REQUEST:", payload)
     print("⬅️ TINKOFF INIT RESPONSE:", r.status_code, r.text)
@@ -58,8 +69,7 @@ def get_payment_status(payment_id: str) -> str:
     }
     payload["Token"] = _build_token(payload, settings.tinkoff_secret_key)
 
-    base_url = settings.tinkoff_test_url if settings.payment_mode.upper() == "TEST" else settings.tinkoff_prod_url
-    r = requests.post(f"{base_url}/GetState", json=payload, timeout=30)
+    r = _http.post(f"{_base_url()}/GetState", json=payload, timeout=30)
 
     print("➡️ TINKOFF GETSTATE REQUEST:", payload)
     print("⬅️ TINKOFF GETSTATE RESPONSE:", r.status_code, r.text)
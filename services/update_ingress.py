@@ -0,0 +1,309 @@
+# services/update_ingress.py
+# Приём апдейтов от Telegram: webhook только кладёт сырой JSON в очередь
+# и сразу отвечает 200, а обработка идёт в фоновом воркере.
+#   - дубли отсекаются по update_id (скользящее окно последних N id);
+#   - очередь ограничена, при переполнении действует явная политика;
+#   - счётчики и глубина очереди отдаются в /metrics;
+#   - обработка идёт в N «полосах» (lanes): полоса выбирается по user_id,
+#     поэтому разные пользователи обрабатываются параллельно, а апдейты
+#     одного пользователя — строго по порядку;
+#   - до готовности PTB апдейты копятся в полосах и после старта
+#     проигрываются по возрастанию update_id;
+#   - тело разбирается orjson (если установлен), а типы апдейтов, для
+#     которых нет хендлеров, отбрасываются до сборки объектов PTB;
+#   - при остановке приём закрывается (503 → Telegram отдаст апдейт другому
+#     инстансу), а уже принятые апдейты дообрабатываются до дедлайна.
+import asyncio
+import json
+import logging
+import time
+import typing as t
+from collections import deque
+
+from config import settings
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательная зависимость, fallback на stdlib
+    orjson = None
+
+
+# === Настройки ===
+MAX_QUEUE = max(1, settings.ingress_max_queue)
+OVERFLOW_POLICY = settings.ingress_overflow_policy.lower()  # reject | drop_oldest | drop_new
+DEDUP_WINDOW = max(1, settings.ingress_dedup_window)
+LANES = max(1, settings.ingress_lanes)
+
+# === Результаты offer() ===
+QUEUED = "queued"
+DUPLICATE = "duplicate"
+FILTERED = "filtered"    # для такого типа апдейта нет хендлеров
+DROPPED = "dropped"      # апдейт потерян (drop_new / drop_oldest)
+REJECTED = "rejected"    # отвечаем 503 — Telegram доставит повторно
+
+# Ключи апдейта, в которых Telegram передаёт автора (поле "from")
+_USER_KEYS = (
+    "message", "edited_message", "callback_query", "inline_query",
+    "chosen_inline_result", "shipping_query", "pre_checkout_query",
+    "my_chat_member", "chat_member", "chat_join_request",
+)
+
+# === Состояние ===
+# общий лимит MAX_QUEUE считается по сумме всех полос (_depth)
+_lanes: list[deque[tuple[dict, float]]] = [deque() for _ in range(LANES)]
+_lane_wakeup: list[asyncio.Event] = [asyncio.Event() for _ in range(LANES)]
+_depth = 0
+_seen_ids: set[int] = set()
+_seen_order: deque[int] = deque()
+_worker_tasks: list[asyncio.Task] = []
+_accepting = True
+_created_at = time.perf_counter()
+
+lane_stats: list[dict[str, float]] = [
+    {"processed": 0, "errors": 0, "busy": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0}
+    for _ in range(LANES)
+]
+
+# Типы апдейтов, для которых есть хендлеры (None — пока не знаем, принимаем всё)
+_allowed_kinds: frozenset[str] | None = None
+
+stats: dict[str, int] = {
+    "received": 0,
+    "filtered": 0,
+    "queued": 0,
+    "duplicates": 0,
+    "dropped_new": 0,
+    "dropped_oldest": 0,
+    "rejected": 0,
+    "processed": 0,
+    "errors": 0,
+}
+
+
+def decode(body: bytes) -> dict:
+    """Быстрый разбор тела webhook (orjson → json). Не JSON-объект — ValueError."""
+    data = orjson.loads(body) if orjson is not None else json.loads(body)
+    if not isinstance(data, dict):
+        # валидный JSON, но не апдейт ([], 1, "x") — как и битый JSON
+        raise ValueError(f"ожидался JSON-объект, получено {type(data).__name__}")
+    return data
+
+
+def update_kind(data: dict) -> str | None:
+    """Тип апдейта: единственный ключ кроме update_id (message, callback_query, ...)."""
+    for key in data:
+        if key != "update_id":
+            return key
+    return None
+
+
+def set_allowed_kinds(kinds: t.Iterable[str]) -> None:
+    global _allowed_kinds
+    _allowed_kinds = frozenset(kinds)
+
+
+def is_handled(data: dict) -> bool:
+    return _allowed_kinds is None or update_kind(data) in _allowed_kinds
+
+
+def _remember(update_id: int) -> bool:
+    """Запоминает update_id. False — если такой уже был в окне."""
+    if update_id in _seen_ids:
+        return False
+    _seen_ids.add(update_id)
+    _seen_order.append(update_id)
+    while len(_seen_order) > DEDUP_WINDOW:
+        _seen_ids.discard(_seen_order.popleft())
+    return True
+
+
+def shard_key(data: dict) -> int:
+    """user_id автора апдейта (или chat_id / update_id, если автора нет)."""
+    for key in _USER_KEYS:
+        obj = data.get(key)
+        if not isinstance(obj, dict):
+            continue
+        user = obj.get("from")
+        if isinstance(user, dict) and isinstance(user.get("id"), int):
+            return user["id"]
+        chat = obj.get("chat")
+        if isinstance(chat, dict) and isinstance(chat.get("id"), int):
+            return chat["id"]
+    return int(data.get("update_id") or 0)
+
+
+def lane_of(data: dict) -> int:
+    return shard_key(data) % LANES
+
+
+def _push(lane: int, data: dict) -> None:
+    global _depth
+    _lanes[lane].append((data, time.perf_counter()))
+    _depth += 1
+    _lane_wakeup[lane].set()
+
+
+def _drop_oldest() -> bool:
+    """Выкидывает самый старый апдейт из самой длинной полосы."""
+    global _depth
+    victim = max(_lanes, key=len)
+    if not victim:
+        return False
+    victim.popleft()
+    _depth -= 1
+    return True
+
+
+def offer(data: dict) -> str:
+    """Неблокирующая постановка апдейта в очередь. Возвращает QUEUED / DUPLICATE / FILTERED / DROPPED / REJECTED."""
+    stats["received"] += 1
+
+    if not _accepting:
+        # узел останавливается — Telegram повторит доставку
+        stats["rejected"] += 1
+        return REJECTED
+
+    if not is_handled(data):
+        stats["filtered"] += 1
+        return FILTERED
+
+    update_id = data.get("update_id")
+    if isinstance(update_id, int) and update_id in _seen_ids:
+        stats["duplicates"] += 1
+        return DUPLICATE
+
+    if _depth >= MAX_QUEUE:
+        if not _worker_tasks:
+            # бот ещё не готов: ничего не теряем, Telegram повторит доставку
+            stats["rejected"] += 1
+            return REJECTED
+        if OVERFLOW_POLICY == "drop_new":
+            stats["dropped_new"] += 1
+            return DROPPED
+        if OVERFLOW_POLICY == "drop_oldest":
+            if _drop_oldest():
+                stats["dropped_oldest"] += 1
+        else:
+            # reject: id не запоминаем, чтобы повторная доставка прошла
+            stats["rejected"] += 1
+            return REJECTED
+
+    if isinstance(update_id, int):
+        _remember(update_id)
+    _push(lane_of(data), data)
+    stats["queued"] += 1
+    return QUEUED
+
+
+async def _lane_worker(lane: int, process: t.Callable[[dict], t.Awaitable[None]]) -> None:
+    """Одна полоса: апдейты обрабатываются строго по очереди."""
+    global _depth
+    queue, wakeup, st = _lanes[lane], _lane_wakeup[lane], lane_stats[lane]
+    while True:
+        if not queue:
+            wakeup.clear()
+            await wakeup.wait()
+            continue
+
+        data, enqueued_at = queue.popleft()
+        _depth -= 1
+        st["busy"] = 1
+        try:
+            await process(data)
+            st["processed"] += 1
+            stats["processed"] += 1
+        except Exception:
+            st["errors"] += 1
+            stats["errors"] += 1
+            logging.exception(f"❌ Ошибка обработки апдейта {data.get('update_id')} (lane {lane})")
+        finally:
+            st["busy"] = 0
+            latency_ms = (time.perf_counter() - enqueued_at) * 1000
+            st["latency_ms_total"] += latency_ms
+            st["latency_ms_max"] = max(st["latency_ms_max"], latency_ms)
+
+
+def _sort_pending() -> int:
+    """Упорядочивает накопленные до старта апдейты по update_id."""
+    for queue in _lanes:
+        if len(queue) > 1:
+            ordered = sorted(queue, key=lambda item: item[0].get("update_id") or 0)
+            queue.clear()
+            queue.extend(ordered)
+    return _depth
+
+
+def start_worker(process: t.Callable[[dict], t.Awaitable[None]]) -> None:
+    """Запускает обработчики полос (один раз) и проигрывает накопленный буфер."""
+    if _worker_tasks and not all(task.done() for task in _worker_tasks):
+        return
+    pending = _sort_pending()
+    if pending:
+        waited = time.perf_counter() - _created_at
+        print(f"📥 Проигрываем {pending} апдейтов, полученных до готовности бота (ждали до {waited:.1f} сек)")
+    loop = asyncio.get_running_loop()
+    _worker_tasks[:] = [
+        loop.create_task(_lane_worker(lane, process), name=f"ingress-lane-{lane}")
+        for lane in range(LANES)
+    ]
+    print(f"✅ Update ingress запущен (lanes={LANES}, queue={MAX_QUEUE}, policy={OVERFLOW_POLICY})")
+
+
+async def stop_worker() -> None:
+    for task in _worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_worker_tasks, return_exceptions=True)
+    _worker_tasks.clear()
+
+
+def close() -> None:
+    """Перестаём принимать апдейты (drain при остановке)."""
+    global _accepting
+    _accepting = False
+
+
+def _in_flight() -> int:
+    return _depth + sum(int(st["busy"]) for st in lane_stats)
+
+
+async def drain(deadline: float) -> dict:
+    """Дообрабатывает принятые апдейты до deadline (time.monotonic()), затем гасит полосы."""
+    close()
+    before = stats["processed"] + stats["errors"]
+    pending = _in_flight()
+    while _in_flight() and _worker_tasks and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    abandoned = _in_flight() if _worker_tasks else _depth
+    await stop_worker()
+    return {
+        "pending": pending,
+        "drained": stats["processed"] + stats["errors"] - before,
+        "abandoned": abandoned,
+    }
+
+
+def snapshot() -> dict:
+    """Метрики для /metrics."""
+    lanes = []
+    for lane, (queue, st) in enumerate(zip(_lanes, lane_stats)):
+        done = st["processed"] + st["errors"]
+        lanes.append({
+            "lane": lane,
+            "backlog": len(queue),
+            "busy": bool(st["busy"]),
+            "processed": int(st["processed"]),
+            "errors": int(st["errors"]),
+            "latency_ms_avg": round(st["latency_ms_total"] / done, 1) if done else 0.0,
+            "latency_ms_max": round(st["latency_ms_max"], 1),
+        })
+    return {
+        **stats,
+        "accepting": _accepting,
+        "queue_depth": _depth,
+        "queue_max": MAX_QUEUE,
+        "overflow_policy": OVERFLOW_POLICY,
+        "dedup_window": DEDUP_WINDOW,
+        "allowed_kinds": None if _allowed_kinds is None else sorted(_allowed_kinds),
+        "json_decoder": "orjson" if orjson is not None else "json",
+        "lanes": lanes,
+    }
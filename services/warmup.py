@@ -0,0 +1,92 @@
+# services/warmup.py
+# Warm-up после старта: первый пользователь после деплоя не должен платить
+# за открытие соединений к БД, OAuth-токен Google, TLS к провайдерам и т.д.
+# Каждый шаг замеряется и попадает в таймлайн старта.
+import asyncio
+import time
+from contextlib import AsyncExitStack
+
+from config import settings
+from utils import startup_timeline
+
+
+# === Шаги ===
+async def warm_db_pool() -> str:
+    """Открывает N соединений пула одновременно, чтобы они остались в пуле."""
+    from sqlalchemy import text
+    from db.database import get_engine
+
+    engine = get_engine()
+    count = max(1, settings.warmup_db_connections)
+    async with AsyncExitStack() as stack:
+        conns = await asyncio.gather(*(
+            stack.enter_async_context(engine.connect()) for _ in range(count)
+        ))
+        for conn in conns:
+            await conn.execute(text("SELECT 1"))
+    return f"{count} conn"
+
+
+async def warm_gsheets_token() -> str:
+    from services import gsheets
+
+    if not gsheets.ENABLED or not gsheets.SPREADSHEET_ID:
+        return "skip (GSHEETS_ENABLE=0)"
+    await gsheets._get_access_token()
+    return "token cached"
+
+
+async def warm_http_hosts() -> str:
+    """Keep-alive соединения к Fal / Replicate / Google Sheets / Тинькофф."""
+    from services import http_client, replicate_kling, tinkoff, gsheets
+
+    hosts = []
+    if replicate_kling.FAL_KEY:
+        hosts.append("https://fal.run")
+    if replicate_kling.REPLICATE_TOKEN:
+        hosts.append(replicate_kling.REPLICATE_API_BASE)
+    if gsheets.ENABLED and gsheets.SPREADSHEET_ID:
+        hosts.append("https://sheets.googleapis.com")
+
+    jobs = [http_client.warm(url) for url in hosts]
+    provider = settings.payment_provider.upper()
+    if provider == "TINKOFF" and settings.tinkoff_terminal_key:
+        jobs.append(asyncio.to_thread(tinkoff.warm_connection))
+    elif provider == "YOOKASSA":
+        from services import yookassa
+        yookassa._sdk()  # импорт и настройка SDK заранее
+
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    ok = sum(1 for r in results if not isinstance(r, Exception))
+    return f"{ok}/{len(jobs)} hosts"
+
+
+async def warm_menu_video() -> str:
+    from handlers.start import load_menu_video_id
+
+    return "file_id loaded" if load_menu_video_id() else "no file_id yet"
+
+
+STEPS = (
+    ("warmup.db_pool", warm_db_pool),
+    ("warmup.gsheets_token", warm_gsheets_token),
+    ("warmup.http_keepalive", warm_http_hosts),
+    ("warmup.menu_video", warm_menu_video),
+)
+
+
+async def _run_step(name: str, step) -> None:
+    t0 = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(step(), timeout=settings.warmup_timeout_sec)
+        status = f"✅ {result}"
+    except Exception as e:
+        status = f"⚠️ {type(e).__name__}: {e}"
+    dur = time.perf_counter() - t0
+    startup_timeline.record(name, dur)
+    print(f"🔥 {name:<24} {dur:>6.3f} сек  {status}")
+
+
+async def run_warmup() -> None:
+    """Все шаги параллельно; ошибки не мешают старту."""
+    await asyncio.gather(*(_run_step(name, step) for name, step in STEPS))
@@ -0,0 +1,128 @@
+# services/webhook_reply.py
+# Ответ на webhook с методом Bot API в теле (экономит один исходящий запрос).
+#
+# Telegram разрешает вернуть в HTTP-ответе webhook один вызов метода.
+# Если режим включён (WEBHOOK_INLINE_REPLY=1), webhook ждёт несколько мс
+# первый исходящий вызов хендлера. Если это answerCallbackQuery (или метод,
+# явно разрешённый через allow_inline), он уходит в ответе webhook, а
+# хендлер получает «успешный» результат. Всё остальное — обычным запросом.
+import asyncio
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from telegram.request import HTTPXRequest
+
+from config import settings
+
+ENABLED = settings.webhook_inline_reply
+WAIT_SEC = settings.webhook_reply_wait_ms / 1000
+
+# Результат этих методов хендлерам не нужен — их можно отдавать всегда
+DEFAULT_METHODS = frozenset({"answerCallbackQuery"})
+
+stats: dict[str, int] = {"inline": 0, "fallback": 0}
+
+
+class _Slot:
+    __slots__ = ("future", "closed")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.future: asyncio.Future = loop.create_future()
+        self.closed = False
+
+    def close(self, payload: dict | None = None) -> None:
+        if not self.closed:
+            self.closed = True
+            if not self.future.done():
+                self.future.set_result(payload)
+
+
+_slots: dict[int, _Slot] = {}
+_current_slot: ContextVar[_Slot | None] = ContextVar("webhook_reply_slot", default=None)
+_extra_methods: ContextVar[frozenset[str]] = ContextVar("webhook_reply_methods", default=frozenset())
+
+
+# === Сторона webhook ===
+def open_slot(update_id: int) -> _Slot:
+    slot = _Slot(asyncio.get_running_loop())
+    _slots[update_id] = slot
+    return slot
+
+
+def discard(update_id: int | None) -> None:
+    """Апдейт не попал в очередь (дубль/отсев/переполнение) — ждать нечего."""
+    slot = _slots.pop(update_id, None)
+    if slot is not None:
+        slot.close()
+
+
+async def wait(update_id: int, slot: _Slot) -> dict | None:
+    """Ждёт первый вызов хендлера не дольше WAIT_SEC. None — отвечаем обычным {"ok": true}."""
+    try:
+        payload = await asyncio.wait_for(asyncio.shield(slot.future), timeout=WAIT_SEC)
+    except asyncio.TimeoutError:
+        # хендлер мог отдать вызов в слот в тот же тик, что и таймаут: хендлеру уже
+        # вернули «успех» — вызов обязан уйти в ответе webhook, иначе он потерян
+        payload = slot.future.result() if slot.future.done() else None
+    finally:
+        slot.close()
+        _slots.pop(update_id, None)
+    stats["inline" if payload else "fallback"] += 1
+    return payload
+
+
+# === Сторона обработчика апдейта ===
+@contextmanager
+def bound(update_id: int | None):
+    """Привязывает слот апдейта к текущему контексту обработки."""
+    slot = _slots.pop(update_id, None) if update_id is not None else None
+    token = _current_slot.set(slot)
+    try:
+        yield
+    finally:
+        _current_slot.reset(token)
+        if slot is not None:
+            slot.close()
+
+
+@contextmanager
+def allow_inline(*methods: str):
+    """Разрешает отдать в ответе webhook методы, чей результат вызывающему не нужен."""
+    token = _extra_methods.set(_extra_methods.get() | frozenset(methods))
+    try:
+        yield
+    finally:
+        _extra_methods.reset(token)
+
+
+def _fake_result(method: str, params: dict):
+    """Результат, который получит хендлер вместо ответа Bot API."""
+    if method == "sendMessage":
+        # настоящий message_id неизвестен — вызывающий код его не использует
+        return {
+            "message_id": 0,
+            "date": int(time.time()),
+            "chat": {"id": params.get("chat_id"), "type": "private"},
+            "text": params.get("text", ""),
+        }
+    return True
+
+
+class InlineReplyRequest(HTTPXRequest):
+    """HTTPXRequest, который перехватывает первый вызов апдейта для ответа webhook."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        slot = _current_slot.get()
+        if slot is not None and not slot.closed:
+            api_method = url.rsplit("/", 1)[-1]
+            allowed = DEFAULT_METHODS | _extra_methods.get()
+            if api_method in allowed and not (request_data and request_data.multipart_data):
+                params = request_data.parameters if request_data else {}
+                slot.close({"method": api_method, **params})
+                body = {"ok": True, "result": _fake_result(api_method, params)}
+                return 200, json.dumps(body).encode()
+            # первый вызов не подходит — дальше всё обычными запросами
+            slot.close()
+        return await super().do_request(url, method, request_data, *args, **kwargs)
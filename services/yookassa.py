@@ -1,14 +1,22 @@
 # services/yookassa.py
+import asyncio
 from datetime import datetime, timezone
-from yookassa import Configuration, Payment
 from config import settings
-from db.database import get_session
+from db.database import end_scope, get_session
 from db.models import Payment as PaymentModel  # SQLAlchemy модель
-import asyncio
 
-# --- Инициализация SDK ---
-Configuration.account_id = settings.yookassa_shop_id
-Configuration.secret_key = settings.yookassa_secret_key
+_sdk_payment = None
+
+
+# --- Инициализация SDK (при первом платеже, а не при импорте) ---
+def _sdk():
+    global _sdk_payment
+    if _sdk_payment is None:
+        from yookassa import Configuration, Payment
+        Configuration.account_id = settings.yookassa_shop_id
+        Configuration.secret_key = settings.yookassa_secret_key
+        _sdk_payment = Payment
+    return _sdk_payment
 
 
 def _rub(val: int) -> str:
@@ -25,24 +33,10 @@ async def create_payment(
     order_id: str,
     customer_email: str = "test@example.com"
 ):
-    from sqlalchemy import select
-    from db.models import User
-    from services.billing_core import upsert_user
+    from db.repo import upsert_user
 
-    async with get_session() as session:
-        user = (await session.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
-
-        if not user:
-            print(f"⚙️ Пользователь {user_id} не найден — создаю...")
-            await upsert_user(user_id, "")
-            await asyncio.sleep(0.3)
-            # 🧩 теперь проверяем повторно уже с user_id
-            user = (await session.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
-
-            if user:
-                print(f"✅ Пользователь {user_id} успешно добавлен в users.")
-            else:
-                print(f"❌ Ошибка: пользователь {user_id} так и не появился в таблице users.")
+    # 🧩 Гарантируем строку в users (FK payments → users): один upsert, без ожиданий
+    await upsert_user(user_id)
 
 
     body = {
@@ -86,26 +80,14 @@ async def create_payment(
     print("MODE:", settings.payment_mode)
 
 
-    payment = Payment.create(body)
+    # 🔓 не держим строку users, пока ждём ответ YooKassa
+    await end_scope()
+    # 🧵 SDK синхронный (requests) — в поток, чтобы не блокировать event loop
+    payment = await asyncio.to_thread(_sdk().create, body)
     payment_id = payment.id
     confirmation_url = payment.confirmation.confirmation_url
 
-    # 🧩 Перед записью в payments — убедимся, что user реально есть
-    from sqlalchemy import select
-    from db.models import User
-
     async with get_session() as session:
-        for _ in range(10):
-            user_exists = (await session.execute(select(User).where(User.id == user_id))).scalar_one_or_none()
-            if user_exists:
-                print(f"✅ Пользователь {user_id} подтверждён в базе, создаём платёж.")
-                break
-            await asyncio.sleep(0.3)
-        else:
-            print(f"❌ Пользователь {user_id} так и не появился в users — платеж не создаётся.")
-            return None, None, None
-
-        # ✅ Теперь точно создаём платеж
         p = PaymentModel(
             user_id=user_id,
             amount=amount_rub,
@@ -130,7 +112,7 @@ def get_payment_status(payment_id: str) -> str:
       succeeded → CONFIRMED
       canceled → REJECTED
     """
-    p = Payment.find_one(payment_id)
+    p = _sdk().find_one(payment_id)
 
     if p.status in ("pending", "waiting_for_capture"):
         return "IN_PROGRESS"
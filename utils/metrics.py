@@ -6,6 +6,8 @@ import functools
 from telegram import Update
 from telegram.ext import Application
 
+from services import activity_tracker
+
 def _tag_from_update(update: Update) -> str:
     try:
         if update.callback_query:
@@ -32,21 +34,9 @@ def _timed_callback(cb, *, name: str | None = None):
         async def _async_wrapper(update: Update, context, *args, **kwargs):
             start = time.perf_counter()
             try:
-                # 🧩 Обновляем last_active_at при любом действии пользователя
-                try:
-                    from sqlalchemy import text
-                    from db.database import get_session
-
-                    if update and update.effective_user:
-                        async with get_session() as session:
-                            await session.execute(text("""
-                                UPDATE users
-                                SET last_active_at = NOW()
-                                WHERE id = :user_id
-                            """), {"user_id": update.effective_user.id})
-                            await session.commit()
-                except Exception as e:
-                    logging.warning(f"⚠️ Не удалось обновить last_active_at: {e}")
+                # 🧩 Отмечаем активность — last_active_at пишется пачкой в фоне
+                if update and update.effective_user:
+                    activity_tracker.touch(update.effective_user.id)
 
                 # 💬 Выполняем оригинальный хендлер
                 return await cb(update, context, *args, **kwargs)
@@ -0,0 +1,61 @@
+# utils/startup_timeline.py
+# Таймлайн холодного старта: сколько заняли импорты модулей и шаги инициализации.
+# Печатается один раз после запуска бота и отдаётся в /metrics.
+import time
+from contextlib import contextmanager
+
+_origin = time.perf_counter()
+_steps: list[tuple[str, str, float]] = []  # (kind, name, seconds)
+_emitted = False
+_total: float | None = None
+
+
+def set_origin(ts: float) -> None:
+    """Точка отсчёта — самое начало импорта main.py."""
+    global _origin
+    _origin = ts
+
+
+@contextmanager
+def step(name: str, kind: str = "init"):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _steps.append((kind, name, time.perf_counter() - t0))
+
+
+def record(name: str, seconds: float, kind: str = "init") -> None:
+    _steps.append((kind, name, seconds))
+
+
+def emit() -> None:
+    """Печатает таймлайн (только первый раз)."""
+    global _emitted, _total
+    from config import settings
+
+    if _emitted:
+        return
+    _emitted = True
+    _total = time.perf_counter() - _origin
+    target = settings.cold_start_target_sec
+
+    print(f"\n⏱ STARTUP TIMELINE — {_total:.2f} сек (цель {target:.0f} сек)")
+    for kind, name, seconds in _steps:
+        print(f"  {kind:<7} {name:.<36} {seconds:>7.3f} сек")
+    if _total > target:
+        print(f"⚠️ Холодный старт дольше цели на {_total - target:.2f} сек")
+    print()
+
+
+def snapshot() -> dict:
+    from config import settings
+
+    return {
+        "total_sec": None if _total is None else round(_total, 3),
+        "target_sec": settings.cold_start_target_sec,
+        "steps": [
+            {"kind": kind, "name": name, "sec": round(seconds, 3)}
+            for kind, name, seconds in _steps
+        ],
+    }